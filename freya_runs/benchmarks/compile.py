@@ -0,0 +1,92 @@
+#training steps/sec of the script models in eager mode vs torch.compile vs TorchScript (BaseModel.compile_model)
+#each configuration runs in a fresh process; the second torch_compile run shows the effect of the compile cache
+from self_supervised_halos.scripts.classification_2d import ClassificationModel as ClassificationModel2d
+from self_supervised_halos.scripts.classification_3d import ClassificationModel as ClassificationModel3d
+from self_supervised_halos.scripts.contrastive_learning_2d import ConstrativeLearningModel, SupConLoss
+from self_supervised_halos.scripts.halo_mass_embeddings import RegressionModel
+from self_supervised_halos.utils.utils import res_path
+
+import time
+import multiprocessing as mp
+import pandas as pd
+
+import torch
+import torch.nn as nn
+from torch.utils.data import DataLoader
+
+
+device = 'cuda' if torch.cuda.is_available() else 'cpu'
+backends = [None, 'torch_compile', 'torch_compile', 'torchscript']
+batch_size = 64
+n_batches = 20
+
+
+class SyntheticHalos(torch.utils.data.Dataset):
+    #HaloDataset item structure: two 2d projections, a 3d cube and a mass history of 100 snapshots
+    def __init__(self, n, load_3d=False):
+        self.n = n
+        self.load_3d = load_3d
+
+    def __len__(self):
+        return self.n
+
+    def __getitem__(self, idx):
+        map_2d = torch.rand(1, 64, 64)
+        data_2d = (map_2d, torch.rand(1, 64, 64))
+        data_3d = torch.rand(1, 64, 64, 64) if self.load_3d else torch.zeros(1)
+        mass_hist = torch.cumsum(torch.rand(100), 0) / 10 + 10
+        label = (torch.tensor(12.0), torch.randint(0, 10, ()), idx)
+        return (data_2d, data_3d, mass_hist), label
+
+
+class Single2d(SyntheticHalos):
+    #single projection, as HaloDataset with choose_two_2d=False
+    def __getitem__(self, idx):
+        (data_2d, data_3d, mass_hist), label = super().__getitem__(idx)
+        return (data_2d[0], data_3d, mass_hist), label
+
+
+model_factories = {
+    'Classification_2d': (lambda: ClassificationModel2d(optimizer_params={'lr': 1e-3}, scheduler_class=None, criterion=nn.CrossEntropyLoss()), Single2d, False),
+    'Classification_3d': (lambda: ClassificationModel3d(optimizer_params={'lr': 1e-3}, scheduler_class=None, criterion=nn.CrossEntropyLoss()), SyntheticHalos, True),
+    'SupConNetwork': (lambda: ConstrativeLearningModel(optimizer_params={'lr': 1e-3}, scheduler_class=None, criterion=SupConLoss()), SyntheticHalos, False),
+    'HaloMassHistTransformer': (lambda: RegressionModel(optimizer_params={'lr': 1e-3}, scheduler_class=None, criterion=nn.MSELoss()), SyntheticHalos, False),
+}
+
+
+def run_config(model_name, backend, queue):
+    torch.manual_seed(0)
+    make_model, dataset_class, load_3d = model_factories[model_name]
+    loader = DataLoader(dataset_class(batch_size * n_batches, load_3d=load_3d), batch_size=batch_size)
+    model = make_model()
+    model.model.to(device)
+
+    t0 = time.perf_counter()
+    model.compile_model(backend, example_batch=next(iter(loader)), device=device)
+    compile_time = time.perf_counter() - t0
+
+    model.training_loop(loader, None, num_epochs=2, device=device, instrument=True)
+    model.save_compile_cache()
+    steps_per_sec = 1 / model.timer.to_dataframe().query('epoch == 1')['step_time'].mean()
+    queue.put({'model': model_name, 'backend': model.compile_backend or 'eager', 'requested': backend or 'eager',
+               'compile_time_s': compile_time, 'steps_per_sec': steps_per_sec})
+
+
+if __name__ == '__main__':
+    ctx = mp.get_context('spawn')
+    results = []
+    for model_name in model_factories:
+        for backend in backends:
+            queue = ctx.Queue()
+            proc = ctx.Process(target=run_config, args=(model_name, backend, queue))
+            proc.start()
+            proc.join()
+            row = queue.get() if not queue.empty() else {'model': model_name, 'requested': backend, 'error': f'exit code {proc.exitcode}'}
+            print(row)
+            results.append(row)
+
+    results_df = pd.DataFrame(results)
+    eager = results_df[results_df['requested'] == 'eager'].set_index('model')['steps_per_sec']
+    results_df['speedup'] = results_df['steps_per_sec'] / results_df['model'].map(eager)
+    print(results_df.to_string())
+    results_df.to_csv(res_path + 'benchmark_compile.csv', index=False)
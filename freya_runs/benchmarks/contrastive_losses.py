@@ -0,0 +1,104 @@
+#benchmark of the matmul-based losses in scripts/losses.py against the previous implementations
+#(SimCLRLoss from simCLR_MNIST/src.py and SupConLoss from scripts/contrastive_learning_2d.py), forward + backward
+from self_supervised_halos.scripts.losses import nt_xent_loss, supcon_loss
+from self_supervised_halos.utils.utils import res_path
+
+import time
+import itertools
+import pandas as pd
+
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+
+
+device = 'cuda' if torch.cuda.is_available() else 'cpu'
+batch_sizes = [64, 256, 1024, 4096]
+embed_dims = [32, 128, 512]
+n_repeat = 10
+
+
+def legacy_simclr_loss(zis, zjs, temperature=0.5):
+    batch_size = zis.size(0)
+    zis = F.normalize(zis, dim=1)
+    zjs = F.normalize(zjs, dim=1)
+    representations = torch.cat([zis, zjs], dim=0)
+    similarity_matrix = nn.CosineSimilarity(dim=2)(representations.unsqueeze(1), representations.unsqueeze(0))
+    mask = torch.eye(similarity_matrix.shape[0], dtype=torch.bool, device=zis.device)
+    similarity_matrix = similarity_matrix[~mask].view(similarity_matrix.shape[0], -1)
+    similarity_matrix = similarity_matrix / temperature
+    target = torch.arange(batch_size, device=zis.device)
+    loss_i = F.cross_entropy(similarity_matrix[:batch_size], target)
+    loss_j = F.cross_entropy(similarity_matrix[batch_size:], target)
+    return (loss_i + loss_j) / 2
+
+
+def legacy_supcon_loss(features, labels=None, temperature=0.07, base_temperature=0.07):
+    device = features.device
+    batch_size = features.shape[0]
+    if labels is None:
+        mask = torch.eye(batch_size, dtype=torch.float32, device=device)
+    else:
+        labels = labels.contiguous().view(-1, 1)
+        mask = torch.eq(labels, labels.T).float()
+    contrast_count = features.shape[1]
+    contrast_feature = torch.cat(torch.unbind(features, dim=1), dim=0)
+    anchor_feature = contrast_feature
+    anchor_count = contrast_count
+    anchor_dot_contrast = torch.div(torch.matmul(anchor_feature, contrast_feature.T), temperature)
+    logits_max, _ = torch.max(anchor_dot_contrast, dim=1, keepdim=True)
+    logits = anchor_dot_contrast - logits_max.detach()
+    mask = mask.repeat(anchor_count, contrast_count)
+    logits_mask = torch.scatter(torch.ones_like(mask), 1,
+                                torch.arange(batch_size * anchor_count, device=device).view(-1, 1), 0)
+    mask = mask * logits_mask
+    exp_logits = torch.exp(logits) * logits_mask
+    log_prob = logits - torch.log(exp_logits.sum(1, keepdim=True))
+    mean_log_prob_pos = (mask * log_prob).sum(1) / mask.sum(1)
+    loss = - (temperature / base_temperature) * mean_log_prob_pos
+    return loss.view(anchor_count, batch_size).mean()
+
+
+def time_loss(loss_fn, *inputs):
+    if device == 'cuda':
+        torch.cuda.synchronize()
+        torch.cuda.reset_peak_memory_stats()
+    t0 = time.perf_counter()
+    for _ in range(n_repeat):
+        for x in inputs:
+            if isinstance(x, torch.Tensor) and x.requires_grad:
+                x.grad = None
+        loss = loss_fn(*inputs)
+        loss.backward()
+    if device == 'cuda':
+        torch.cuda.synchronize()
+    elapsed = (time.perf_counter() - t0) / n_repeat
+    peak_mem = torch.cuda.max_memory_allocated() / 2**20 if device == 'cuda' else float('nan')
+    return loss.item(), elapsed * 1e3, peak_mem
+
+
+results = []
+for batch_size, embed_dim in itertools.product(batch_sizes, embed_dims):
+    z_i = torch.randn(batch_size, embed_dim, device=device, requires_grad=True)
+    z_j = torch.randn(batch_size, embed_dim, device=device, requires_grad=True)
+    features = F.normalize(torch.randn(batch_size, 2, embed_dim, device=device), dim=2).requires_grad_()
+    labels = torch.randint(0, 10, (batch_size,), device=device)
+
+    cases = {
+        'nt_xent': [(legacy_simclr_loss, (z_i, z_j)), (nt_xent_loss, (z_i, z_j))],
+        'supcon': [(legacy_supcon_loss, (features, labels)), (supcon_loss, (features, labels))],
+    }
+    for loss_name, ((old_fn, old_inputs), (new_fn, new_inputs)) in cases.items():
+        old_loss, old_ms, old_mem = time_loss(old_fn, *old_inputs)
+        new_loss, new_ms, new_mem = time_loss(new_fn, *new_inputs)
+        results.append({'loss': loss_name, 'batch_size': batch_size, 'embed_dim': embed_dim,
+                        'legacy_ms': old_ms, 'new_ms': new_ms, 'speedup': old_ms / new_ms,
+                        'legacy_peak_mb': old_mem, 'new_peak_mb': new_mem,
+                        'legacy_value': old_loss, 'new_value': new_loss})
+        print(results[-1])
+
+#note: legacy and new nt_xent values differ, the legacy target indices for the first half of the
+#batch pointed one column past the positive after the diagonal was removed
+results_df = pd.DataFrame(results)
+print(results_df.to_string())
+results_df.to_csv(res_path + 'benchmark_contrastive_losses.csv', index=False)
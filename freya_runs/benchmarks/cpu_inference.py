@@ -0,0 +1,128 @@
+#CPU inference throughput and output drift of the exported/quantized networks (scripts/export.py) against eager float32:
+#TorchScript, ONNX (if onnxruntime is installed), dynamic and static int8. Uses the trained checkpoints in
+#results/models/: static int8 is calibrated on training halos and the drift is measured on the held-out 20% of the
+#halos (same split as tta.py). Networks without a checkpoint fall back to random weights on synthetic batches
+#(throughput only, their drift says nothing about the trained network)
+from self_supervised_halos.scripts.classification_2d import ClassificationModel as ClassificationModel2d
+from self_supervised_halos.scripts.classification_3d import ClassificationModel as ClassificationModel3d
+from self_supervised_halos.scripts.contrastive_learning_2d import ConstrativeLearningModel
+from self_supervised_halos.scripts.halo_mass_embeddings import RegressionModel
+from self_supervised_halos.scripts.export import inference_module, example_inputs, quantize, export, InferenceModel, check_drift
+from self_supervised_halos.scripts.base_model import models_path
+from self_supervised_halos.utils.dataloader import HaloDataset, subhalos_df
+from self_supervised_halos.utils.utils import data_preprocess_path, res_path
+
+import os
+import time
+import pandas as pd
+
+import torch
+from torch.utils.data import DataLoader
+
+
+batch_size = 256
+n_batches = 10
+
+
+class SyntheticInputs(torch.utils.data.Dataset):
+    #HaloDataset item structure, only the input at input_index is filled
+    def __init__(self, n, input_index, shape):
+        self.n = n
+        self.input_index = input_index
+        self.shape = shape
+
+    def __len__(self):
+        return self.n
+
+    def __getitem__(self, idx):
+        inputs = [torch.zeros(1), torch.zeros(1), torch.zeros(1)]
+        inputs[self.input_index] = torch.rand(self.shape)
+        if self.input_index == 2:
+            inputs[2] = torch.cumsum(inputs[2], 0) / 10 + 10 #mass-history-like
+        return tuple(inputs), (torch.tensor(12.0), torch.randint(0, 10, ()), idx)
+
+
+networks = {
+    #name: (model class, network of the model, input index, HaloDataset arguments, synthetic input shape)
+    'Encoder': (ConstrativeLearningModel, lambda model: model.eager_model.encoder, 0, dict(load_2d=True), (1, 64, 64)),
+    'Classification_2d': (ClassificationModel2d, lambda model: model.eager_model, 0, dict(load_2d=True), (1, 64, 64)),
+    'Classification_3d': (ClassificationModel3d, lambda model: model.eager_model, 1, dict(load_2d=False, load_3d=True), (1, 64, 64, 64)),
+    'HaloMassHistTransformer': (RegressionModel, lambda model: model.eager_model, 2, dict(load_2d=False, load_mass=True), (100,)),
+}
+
+
+def halo_loaders(dataset_kwargs):
+    #(calibration loader over training halos, loader over held-out halos)
+    dataset = HaloDataset(root_dir=data_preprocess_path, subhalos_df=subhalos_df, **dataset_kwargs)
+    test_size = len(dataset) // 5
+    train_ds, test_ds = torch.utils.data.random_split(dataset, [len(dataset) - test_size, test_size],
+                                                      generator=torch.Generator().manual_seed(42))
+    n = batch_size * n_batches
+    calibration_ds = torch.utils.data.Subset(train_ds, range(min(n, len(train_ds))))
+    test_ds = torch.utils.data.Subset(test_ds, range(min(n, len(test_ds))))
+    return DataLoader(calibration_ds, batch_size=batch_size), DataLoader(test_ds, batch_size=batch_size)
+
+
+def trained_network(model_class, network_of):
+    #network of the trained checkpoint, None if there is none
+    model = model_class(scheduler_class=None)
+    if not os.path.exists(models_path + model.model_name + '.pth'):
+        return None
+    model.load(model.model_name + '.pth')
+    return network_of(model).cpu().eval()
+
+
+def module_of(model):
+    return model.model if isinstance(model, InferenceModel) else model
+
+
+def throughput(model, loader, input_index):
+    batches = [torch.as_tensor(inputs[input_index]).float() for inputs, _ in loader]
+    with torch.inference_mode():
+        model(*example_inputs(module_of(model), batches[0])) #warmup
+        t0 = time.perf_counter()
+        for x in batches:
+            model(*example_inputs(module_of(model), x))
+        elapsed = time.perf_counter() - t0
+    return sum(len(x) for x in batches) / elapsed
+
+
+if __name__ == '__main__':
+    torch.manual_seed(0)
+    results = []
+    for name, (model_class, network_of, input_index, dataset_kwargs, shape) in networks.items():
+        network = trained_network(model_class, network_of)
+        trained = network is not None
+        if trained:
+            calibration_loader, loader = halo_loaders(dataset_kwargs)
+        else:
+            print(f"No checkpoint for {name}, using random weights on synthetic inputs")
+            network = network_of(model_class(scheduler_class=None)).eval()
+            loader = DataLoader(SyntheticInputs(batch_size * n_batches, input_index, shape), batch_size=batch_size)
+            calibration_loader = loader
+        reference = inference_module(network)
+        example_batch = torch.as_tensor(next(iter(loader))[0][input_index]).float()
+
+        candidates = {'eager_fp32': reference}
+        candidates['dynamic_int8'] = quantize(network, mode='dynamic')
+        candidates['static_int8'] = quantize(network, mode='static', calibration_loader=calibration_loader, input_index=input_index)
+        for variant in ['eager_fp32', 'static_int8']:
+            export(candidates[variant], example_batch, f'{name}_{variant}', format='torchscript')
+            candidates[f'torchscript_{variant}'] = InferenceModel.load(f'{name}_{variant}')
+        try:
+            export(reference, example_batch, f'{name}_fp32', format='onnx')
+            candidates['onnx_fp32'] = InferenceModel.load(f'{name}_fp32')
+        except Exception as e:
+            print(f"ONNX skipped for {name}: {e}")
+
+        for variant, model in candidates.items():
+            row = {'network': name, 'variant': variant, 'trained': trained, 'samples_per_sec': throughput(model, loader, input_index),
+                   **check_drift(network, model, loader, input_index=input_index, n_batches=3)}
+            print(row)
+            results.append(row)
+
+    results_df = pd.DataFrame(results)
+    eager = results_df[results_df['variant'] == 'eager_fp32'].set_index('network')['samples_per_sec']
+    results_df['speedup'] = results_df['samples_per_sec'] / results_df['network'].map(eager)
+    print(results_df.to_string())
+    results_df.to_csv(res_path + 'benchmark_cpu_inference.csv', index=False)
@@ -0,0 +1,73 @@
+#throughput and peak memory of ConstrativeLearningModel: plain full-batch backward vs gradient caching
+#each configuration runs in a fresh process so that ru_maxrss is the peak of that configuration only
+from self_supervised_halos.scripts.contrastive_learning_2d import ConstrativeLearningModel, SupConLoss
+from self_supervised_halos.utils.utils import res_path
+
+import time
+import resource
+import itertools
+import multiprocessing as mp
+import pandas as pd
+
+import torch
+
+
+device = 'cuda' if torch.cuda.is_available() else 'cpu'
+batch_sizes = [256, 1024, 4096, 8192]
+chunk_sizes = [None, 256] # None = plain path
+n_steps = 3
+
+
+def synthetic_batch(batch_size):
+    #same structure as a HaloDataset batch with choose_two_2d=True
+    images = (torch.rand(batch_size, 1, 64, 64), torch.rand(batch_size, 1, 64, 64))
+    labels = torch.randint(0, 10, (batch_size,))
+    return (images, torch.zeros(batch_size), torch.zeros(batch_size)), (torch.zeros(batch_size), labels, torch.arange(batch_size))
+
+
+def run_config(batch_size, chunk_size, queue):
+    torch.manual_seed(0)
+    model = ConstrativeLearningModel(optimizer_params={'lr': 1e-3}, scheduler_class=None,
+                                     criterion=SupConLoss(temperature=0.07),
+                                     grad_cache_chunk_size=chunk_size)
+    model.model.to(device)
+    model.model.train()
+    batch = synthetic_batch(batch_size)
+
+    row = {'batch_size': batch_size, 'chunk_size': chunk_size}
+    try:
+        model.optimization_step(batch, device) #warmup
+        if device == 'cuda':
+            torch.cuda.synchronize()
+            torch.cuda.reset_peak_memory_stats()
+        t0 = time.perf_counter()
+        for _ in range(n_steps):
+            model.optimization_step(batch, device)
+        if device == 'cuda':
+            torch.cuda.synchronize()
+        elapsed = (time.perf_counter() - t0) / n_steps
+        row['samples_per_sec'] = batch_size / elapsed
+        row['peak_mem_mb'] = (torch.cuda.max_memory_allocated() / 2**20 if device == 'cuda'
+                              else resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 2**10)
+    except RuntimeError as e: #out of memory
+        row['samples_per_sec'] = float('nan')
+        row['peak_mem_mb'] = float('nan')
+        row['error'] = str(e).split('\n')[0]
+    queue.put(row)
+
+
+if __name__ == '__main__':
+    ctx = mp.get_context('spawn')
+    results = []
+    for batch_size, chunk_size in itertools.product(batch_sizes, chunk_sizes):
+        queue = ctx.Queue()
+        proc = ctx.Process(target=run_config, args=(batch_size, chunk_size, queue))
+        proc.start()
+        proc.join()
+        row = queue.get() if not queue.empty() else {'batch_size': batch_size, 'chunk_size': chunk_size, 'error': f'exit code {proc.exitcode}'}
+        print(row)
+        results.append(row)
+
+    results_df = pd.DataFrame(results)
+    print(results_df.to_string())
+    results_df.to_csv(res_path + 'benchmark_grad_cache.csv', index=False)
@@ -0,0 +1,74 @@
+#training and inference throughput/peak memory of Classification_3d in float32 vs mixed precision
+#(bfloat16 autocast on CPU, float16 + GradScaler on GPU), each configuration in a fresh process
+from self_supervised_halos.scripts.classification_3d import ClassificationModel
+from self_supervised_halos.scripts.step_timer import peak_memory_mb
+from self_supervised_halos.utils.utils import res_path
+
+import time
+import itertools
+import multiprocessing as mp
+import pandas as pd
+
+import torch
+import torch.nn as nn
+from torch.utils.data import DataLoader
+
+
+device = 'cuda' if torch.cuda.is_available() else 'cpu'
+amp_dtypes = [None, 'float16' if device == 'cuda' else 'bfloat16']
+batch_sizes = [32, 128]
+n_batches = 10
+
+
+class SyntheticHalos3d(torch.utils.data.Dataset):
+    #HaloDataset item structure with random 64^3 cubes
+    def __init__(self, n):
+        self.cubes = torch.rand(n, 1, 64, 64, 64)
+        self.labels = torch.randint(0, 10, (n,))
+
+    def __len__(self):
+        return len(self.labels)
+
+    def __getitem__(self, idx):
+        return (torch.zeros(1), self.cubes[idx], torch.zeros(1)), (torch.tensor(12.0), self.labels[idx], idx)
+
+
+def run_config(amp_dtype, batch_size, queue):
+    torch.manual_seed(0)
+    loader = DataLoader(SyntheticHalos3d(batch_size * n_batches), batch_size=batch_size)
+    model = ClassificationModel(optimizer_params={'lr': 1e-3}, scheduler_class=None, criterion=nn.CrossEntropyLoss())
+    model.model.to(device)
+    model.set_mixed_precision(amp_dtype, device=device)
+
+    model.training_loop(loader, None, num_epochs=2, device=device, instrument=True)
+    row = {'amp_dtype': amp_dtype or 'float32', 'batch_size': batch_size,
+           'train_samples_per_sec': model.history['samples_per_sec'][-1],
+           'train_peak_mem_mb': model.history['peak_mem_mb'][-1]}
+
+    model.model.eval()
+    t0 = time.perf_counter()
+    with torch.inference_mode(), model.autocast():
+        for batch in loader:
+            model(batch[0][1].to(device))
+    if device == 'cuda':
+        torch.cuda.synchronize()
+    row['eval_samples_per_sec'] = len(loader.dataset) / (time.perf_counter() - t0)
+    row['peak_mem_mb'] = peak_memory_mb(device)
+    queue.put(row)
+
+
+if __name__ == '__main__':
+    ctx = mp.get_context('spawn')
+    results = []
+    for amp_dtype, batch_size in itertools.product(amp_dtypes, batch_sizes):
+        queue = ctx.Queue()
+        proc = ctx.Process(target=run_config, args=(amp_dtype, batch_size, queue))
+        proc.start()
+        proc.join()
+        row = queue.get() if not queue.empty() else {'amp_dtype': amp_dtype, 'batch_size': batch_size, 'error': f'exit code {proc.exitcode}'}
+        print(row)
+        results.append(row)
+
+    results_df = pd.DataFrame(results)
+    print(results_df.to_string())
+    results_df.to_csv(res_path + 'benchmark_mixed_precision.csv', index=False)
@@ -0,0 +1,82 @@
+#wall-clock time to a target validation accuracy of Classification_3d trained at full 64^3 resolution
+#vs progressive resizing (16^3 -> 32^3 -> 64^3, BaseModel.set_progressive_resizing), each schedule in a fresh process
+from self_supervised_halos.scripts.classification_3d import ClassificationModel
+from self_supervised_halos.utils.dataloader import HaloDataset, subhalos_df
+from self_supervised_halos.utils.utils import data_preprocess_path, res_path
+
+import time
+import multiprocessing as mp
+import pandas as pd
+
+import torch
+import torch.nn as nn
+from torch.utils.data import DataLoader
+
+
+device = 'cuda' if torch.cuda.is_available() else 'cpu'
+n_epochs = 8
+batch_size = 64
+target_accuracy = 0.5
+schedules = {
+    'full': None,
+    '16-32-64': {0: 16, 3: 32, 6: None},
+    '32-64': {0: 32, 5: None},
+}
+
+
+def accuracy(model, loader):
+    model.model.eval()
+    correct, total = 0, 0
+    with torch.no_grad(), model.autocast():
+        for inputs, targets in loader:
+            pred = model(inputs[1].float().to(device)).argmax(dim=1)
+            correct += (pred.cpu() == targets[1]).sum().item()
+            total += len(pred)
+    return correct / total
+
+
+def run_schedule(name, queue):
+    torch.manual_seed(0)
+    dataset = HaloDataset(root_dir=data_preprocess_path, subhalos_df=subhalos_df,
+                          load_2d=False, load_3d=True, load_mass=False)
+    train_size = int(0.8 * len(dataset))
+    train_ds, val_ds = torch.utils.data.random_split(dataset, [train_size, len(dataset) - train_size],
+                                                     generator=torch.Generator().manual_seed(42))
+    train_loader = DataLoader(train_ds, batch_size=batch_size, shuffle=True)
+    val_loader = DataLoader(val_ds, batch_size=batch_size)
+
+    model = ClassificationModel(optimizer_params={'lr': 1e-3}, scheduler_class=None,
+                                criterion=nn.CrossEntropyLoss(weight=dataset.mass_bins_weights.to(device)))
+    model.model.to(device)
+    model.set_progressive_resizing(schedules[name])
+
+    rows = []
+    train_time = 0
+    for epoch in range(n_epochs):
+        t0 = time.perf_counter()
+        model.training_loop(train_loader, None, num_epochs=1, device=device)
+        train_time += time.perf_counter() - t0
+        rows.append({'schedule': name, 'epoch': epoch + 1, 'resolution': model.input_resolution or 64,
+                     'train_time_s': train_time, 'val_accuracy': accuracy(model, val_loader)})
+    queue.put(rows)
+
+
+if __name__ == '__main__':
+    ctx = mp.get_context('spawn')
+    results = []
+    for name in schedules:
+        queue = ctx.Queue()
+        proc = ctx.Process(target=run_schedule, args=(name, queue))
+        proc.start()
+        proc.join()
+        rows = queue.get() if not queue.empty() else []
+        for row in rows:
+            print(row)
+        results.extend(rows)
+
+    results_df = pd.DataFrame(results)
+    print(results_df.to_string())
+    reached = results_df[results_df['val_accuracy'] >= target_accuracy].groupby('schedule')['train_time_s'].min()
+    print(f'Training time to val accuracy {target_accuracy}:')
+    print(reached.to_string())
+    results_df.to_csv(res_path + 'benchmark_progressive_resizing.csv', index=False)
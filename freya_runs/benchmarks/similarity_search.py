@@ -0,0 +1,62 @@
+#recall@k and query latency of the exact (blocked matmul) and approximate (IVF-PQ) modes of SimilarityIndex
+#on synthetic clustered embeddings of catalog sizes up to 1e6
+from self_supervised_halos.scripts.similarity_index import SimilarityIndex
+from self_supervised_halos.utils.utils import res_path
+
+import time
+import pandas as pd
+import numpy as np
+
+import torch
+
+
+catalog_sizes = [10_000, 100_000, 1_000_000]
+embed_dim = 64
+n_queries = 256
+k = 10
+nprobes = [1, 4, 16, 64]
+refines = [0, 4]
+
+
+def synthetic_embeddings(n, n_centers=200, seed=0):
+    #mixture of gaussians, closer to real embeddings than uniform noise
+    rng = np.random.default_rng(seed)
+    centers = rng.normal(size=(n_centers, embed_dim))
+    return (centers[rng.integers(n_centers, size=n)] + 0.5 * rng.normal(size=(n, embed_dim))).astype(np.float32)
+
+
+def recall(ids, true_ids):
+    return np.mean([len(set(a) & set(b)) / len(b) for a, b in zip(ids, true_ids)])
+
+
+if __name__ == '__main__':
+    results = []
+    for n in catalog_sizes:
+        embeddings = synthetic_embeddings(n + n_queries)
+        index = SimilarityIndex(embeddings[:n], np.arange(n))
+        queries = embeddings[n:] #same distribution, not in the index
+
+        t0 = time.perf_counter()
+        _, true_ids = index.search(queries, k=k, exact=True)
+        exact_time = time.perf_counter() - t0
+        row = {'n': n, 'mode': 'exact', 'nprobe': None, 'refine': None, 'recall': 1.0,
+               'ms_per_query': 1e3 * exact_time / n_queries}
+        print(row)
+        results.append(row)
+
+        t0 = time.perf_counter()
+        index.train_ivf(n_subquantizers=8)
+        train_time = time.perf_counter() - t0
+        for nprobe in nprobes:
+            for refine in refines:
+                t0 = time.perf_counter()
+                _, ids = index.search(queries, k=k, exact=False, nprobe=nprobe, refine=refine)
+                elapsed = time.perf_counter() - t0
+                row = {'n': n, 'mode': 'ivfpq', 'nprobe': nprobe, 'refine': refine, 'recall': recall(ids, true_ids),
+                       'ms_per_query': 1e3 * elapsed / n_queries, 'train_time_s': train_time}
+                print(row)
+                results.append(row)
+
+    results_df = pd.DataFrame(results)
+    print(results_df.to_string())
+    results_df.to_csv(res_path + 'benchmark_similarity_search.csv', index=False)
@@ -0,0 +1,44 @@
+#accuracy gained by test-time augmentation vs forward throughput spent, for the trained Classification_2d/3d
+#checkpoints in results/models/ on the held-out 20% of the halos
+from self_supervised_halos.scripts.classification_2d import ClassificationModel as ClassificationModel2d
+from self_supervised_halos.scripts.classification_3d import ClassificationModel as ClassificationModel3d
+from self_supervised_halos.scripts.tta import compare_tta
+from self_supervised_halos.utils.dataloader import HaloDataset, subhalos_df
+from self_supervised_halos.utils.utils import data_preprocess_path, res_path
+
+import pandas as pd
+
+import torch
+from torch.utils.data import DataLoader
+
+
+device = 'cuda' if torch.cuda.is_available() else 'cpu'
+batch_size = 64
+
+configs = {
+    #name: (model class, input index, HaloDataset arguments, cube reflections)
+    '2d_d4_x_projections': (ClassificationModel2d, 0, dict(load_2d=True, choose_all_2d=True), False),
+    '3d_rotations': (ClassificationModel3d, 1, dict(load_2d=False, load_3d=True), False),
+    '3d_rotations_reflections': (ClassificationModel3d, 1, dict(load_2d=False, load_3d=True), True),
+}
+
+
+if __name__ == '__main__':
+    reports = []
+    for name, (model_class, input_index, dataset_kwargs, reflections) in configs.items():
+        dataset = HaloDataset(root_dir=data_preprocess_path, subhalos_df=subhalos_df, **dataset_kwargs)
+        test_size = len(dataset) // 5
+        _, test_ds = torch.utils.data.random_split(dataset, [len(dataset) - test_size, test_size],
+                                                   generator=torch.Generator().manual_seed(42))
+        loader = DataLoader(test_ds, batch_size=batch_size)
+
+        model = model_class(scheduler_class=None)
+        model.load(model.model_name + '.pth')
+        model.model.to(device)
+
+        report, _ = compare_tta(model, loader, device=device, input_index=input_index, cube_reflections=reflections)
+        reports.append(report.reset_index().assign(config=name))
+
+    results_df = pd.concat(reports, ignore_index=True)
+    print(results_df.to_string())
+    results_df.to_csv(res_path + 'benchmark_tta.csv', index=False)
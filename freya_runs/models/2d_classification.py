@@ -1,5 +1,6 @@
 from self_supervised_halos.utils.utils import data_preprocess_path, check_cuda
 from scripts.classification_2d import ClassificationModel, report_classification_performance
+from self_supervised_halos.scripts.autotune import load_tuned_config
 
 
 from self_supervised_halos.utils.dataloader import HaloDataset, img2d_transform, subhalos_df, DataLoader
@@ -20,13 +21,13 @@ dataset = HaloDataset(root_dir=data_preprocess_path,subhalos_df=subhalos_df,
                       DEBUG_LIMIT_FILES = None)
 
 
-if device=='cpu':
-    batch_size = 128
-else:
-    print('dataloader on gpu')
-    batch_size = 512
+#throughput settings found by freya_runs/models/2d_classification_autotune.py for this node type
+default_config = {'batch_size': 128 if device=='cpu' else 512, 'num_workers': 0, 'num_threads': torch.get_num_threads(), 'prefetch': 0}
+config = load_tuned_config('Classification_2d', default=default_config)
+batch_size = config['batch_size']
+torch.set_num_threads(config['num_threads'])
 
-print(f'Batch size: {batch_size}')
+print(f'Batch size: {batch_size}, config: {config}')
 
 n_data = len(dataset)
 f_train = 0.6
@@ -45,8 +46,8 @@ val_size = len(trainval_ds) - train_size
 
 train_ds, val_ds = torch.utils.data.random_split(trainval_ds, [train_size, val_size])
 
-train_loader = DataLoader(train_ds, batch_size=batch_size, shuffle=True)
-val_loader = DataLoader(val_ds, batch_size=batch_size, shuffle=True)
+train_loader = DataLoader(train_ds, batch_size=batch_size, shuffle=True, num_workers=config['num_workers'])
+val_loader = DataLoader(val_ds, batch_size=batch_size, shuffle=True, num_workers=config['num_workers'])
 test_loader = DataLoader(test_ds, batch_size=batch_size, shuffle=True)
 
 
@@ -67,6 +68,7 @@ model = ClassificationModel(
 )
 
 model.load('Classification_2d.pth')
+model.set_validation_cache(seed=42) #same augmented validation views every epoch
 
 #model.trial_forward_pass(train_loader, device);
 
@@ -75,6 +77,7 @@ model.training_loop(
     train_loader=train_loader, 
     val_loader=val_loader,
     num_epochs=n_epochs, 
-    device=device)
+    device=device,
+    prefetch=config['prefetch'])
 
-model.save()
+model.save(plot=True)
@@ -0,0 +1,32 @@
+from self_supervised_halos.utils.utils import data_preprocess_path, check_cuda
+from self_supervised_halos.scripts.classification_2d import ClassificationModel
+from self_supervised_halos.scripts.autotune import autotune
+
+
+from self_supervised_halos.utils.dataloader import HaloDataset, img2d_transform, subhalos_df
+
+import torch
+import torch.nn as nn
+
+
+def build_model():
+    return ClassificationModel(
+                    optimizer_class=torch.optim.Adam,
+                    optimizer_params={'lr':1e-3},
+                    scheduler_class=None,
+                    criterion=nn.CrossEntropyLoss(weight=HaloDataset.mass_bins_weights),
+                    transform=img2d_transform,
+    )
+
+
+if __name__ == '__main__':
+    device = check_cuda()
+    dataset = HaloDataset(root_dir=data_preprocess_path, subhalos_df=subhalos_df,
+                          load_2d=True, load_3d=False, load_mass=False,
+                          choose_two_2d = False,
+                          DEBUG_LIMIT_FILES = None).share_memory()
+
+    best_config, results_df = autotune(build_model, dataset, device=device,
+                                       batch_sizes=(64, 128, 256, 512, 1024),
+                                       memory_budget_mb=32_000 if device=='cpu' else 20_000)
+    print(results_df.sort_values('samples_per_sec', ascending=False).to_string())
@@ -0,0 +1,65 @@
+from self_supervised_halos.utils.utils import data_preprocess_path
+from self_supervised_halos.scripts.classification_2d import ClassificationModel
+from self_supervised_halos.scripts.distributed import launch, distributed_loader, is_main_process
+
+
+from self_supervised_halos.utils.dataloader import HaloDataset, img2d_transform, subhalos_df
+
+import os
+import torch
+import torch.nn as nn
+
+
+world_size = int(os.environ.get('N_PROCESSES', 4))
+batch_size = 128 #per process
+lr = 1e-2
+n_epochs = 5
+
+
+def train(rank, world_size):
+    device = 'cpu'
+    dataset = HaloDataset(root_dir=data_preprocess_path, subhalos_df=subhalos_df,
+                          load_2d=True, load_3d=False, load_mass=False,
+                          choose_two_2d = False,
+                          DEBUG_LIMIT_FILES = None)
+
+    n_data = len(dataset)
+    f_train = 0.6
+    f_val = 0.2
+
+    #same split in every process
+    generator = torch.Generator().manual_seed(42)
+    train_size = int(f_train*n_data)
+    val_size = int(f_val*n_data)
+    test_size = n_data - train_size - val_size
+    train_ds, val_ds, test_ds = torch.utils.data.random_split(dataset, [train_size, val_size, test_size], generator=generator)
+
+    train_loader = distributed_loader(train_ds, batch_size=batch_size, shuffle=True)
+    val_loader = distributed_loader(val_ds, batch_size=batch_size, shuffle=False)
+
+    criterion = nn.CrossEntropyLoss(weight=dataset.mass_bins_weights.to(device)).to(device)
+
+    model = ClassificationModel(
+                        optimizer_class=torch.optim.Adam,
+                        optimizer_params={'lr':lr},
+                        scheduler_class=torch.optim.lr_scheduler.ReduceLROnPlateau,
+                        scheduler_params={'factor':0.1},
+                        criterion=criterion,
+                        history=None,
+                        transform=img2d_transform,
+    )
+    model.distribute()
+
+    model.training_loop(
+        train_loader=train_loader,
+        val_loader=val_loader,
+        num_epochs=n_epochs,
+        device=device)
+
+    model.save()
+    if is_main_process():
+        print(f'Trained with {world_size} processes')
+
+
+if __name__ == '__main__':
+    launch(train, world_size)
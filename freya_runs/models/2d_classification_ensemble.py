@@ -0,0 +1,47 @@
+from self_supervised_halos.utils.utils import data_preprocess_path, check_cuda, res_path
+from self_supervised_halos.scripts.classification_2d import Classification_2d
+from self_supervised_halos.scripts.ensemble import EnsembleTrainer
+
+
+from self_supervised_halos.utils.dataloader import HaloDataset, img2d_transform, subhalos_df, DataLoader
+
+import itertools
+import torch
+import torch.nn as nn
+
+device = check_cuda()
+
+dataset = HaloDataset(root_dir=data_preprocess_path,subhalos_df=subhalos_df,
+                      load_2d=True, load_3d=False, load_mass=False,
+                        choose_two_2d = False,
+                      DEBUG_LIMIT_FILES = None)
+
+batch_size = 128 if device=='cpu' else 512
+
+n_data = len(dataset)
+f_train = 0.6
+f_val = 0.2
+train_size = int(f_train*n_data)
+val_size = int(f_val*n_data)
+test_size = n_data - train_size - val_size
+train_ds, val_ds, test_ds = torch.utils.data.random_split(dataset, [train_size, val_size, test_size], generator=torch.Generator().manual_seed(42))
+
+train_loader = DataLoader(train_ds, batch_size=batch_size, shuffle=True)
+val_loader = DataLoader(val_ds, batch_size=batch_size, shuffle=False)
+
+#sweep: 3 learning rates x 2 weight decays x 2 seeds = 12 members trained together
+lrs, weight_decays, seeds = zip(*itertools.product([1e-3, 5e-3, 1e-2], [0.0, 1e-4], [0, 1]))
+n_epochs = 5
+
+criterion = nn.CrossEntropyLoss(weight=dataset.mass_bins_weights.to(device)).to(device)
+
+ensemble = EnsembleTrainer(Classification_2d, n_members=len(lrs),
+                           lrs=lrs, weight_decays=weight_decays, seeds=seeds,
+                           criterion=criterion, transform=img2d_transform,
+                           input_index=0, device=device)
+
+ensemble.training_loop(train_loader, val_loader, num_epochs=n_epochs, device=device)
+
+history_df = ensemble.history_dataframe()
+print(history_df.query(f'epoch == {n_epochs}').sort_values('val_loss').to_string())
+history_df.to_csv(res_path + 'ensemble_2d_classification_history.csv', index=False)
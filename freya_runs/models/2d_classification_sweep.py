@@ -0,0 +1,50 @@
+from self_supervised_halos.utils.utils import data_preprocess_path
+from self_supervised_halos.scripts.classification_2d import ClassificationModel
+from self_supervised_halos.scripts.sweep import Sweep
+
+
+from self_supervised_halos.utils.dataloader import HaloDataset, img2d_transform, subhalos_df
+
+import torch
+import torch.nn as nn
+
+
+def build_model(lr, gamma):
+    criterion = nn.CrossEntropyLoss(weight=HaloDataset.mass_bins_weights)
+    return ClassificationModel(
+                    optimizer_class=torch.optim.Adam,
+                    optimizer_params={'lr':lr},
+                    scheduler_class=torch.optim.lr_scheduler.StepLR,
+                    scheduler_params={'step_size': 2, 'gamma': gamma},
+                    criterion=criterion,
+                    history=None,
+                    transform=img2d_transform,
+    )
+
+
+if __name__ == '__main__':
+    dataset = HaloDataset(root_dir=data_preprocess_path, subhalos_df=subhalos_df,
+                          load_2d=True, load_3d=False, load_mass=False,
+                          choose_two_2d = False,
+                          DEBUG_LIMIT_FILES = None).share_memory()
+
+    n_data = len(dataset)
+    f_train = 0.6
+    f_val = 0.2
+    train_size = int(f_train*n_data)
+    val_size = int(f_val*n_data)
+    test_size = n_data - train_size - val_size
+    train_ds, val_ds, test_ds = torch.utils.data.random_split(dataset, [train_size, val_size, test_size], generator=torch.Generator().manual_seed(42))
+
+    grid = {'lr': [1e-3, 5e-3, 1e-2, 2e-2],
+            'gamma': [0.5, 0.9],
+            'batch_size': [64, 128]}
+
+    sweep = Sweep(build_model, grid, train_ds, val_ds,
+                  num_epochs=8, n_workers=8,
+                  halving_eta=2, min_epochs=1,
+                  name='2d_classification')
+    results = sweep.run()
+    print(results.to_string())
+    print('Best trial:')
+    print(sweep.best())
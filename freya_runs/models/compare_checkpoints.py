@@ -0,0 +1,27 @@
+#compare the saved Classification_2d checkpoints (results/models/Classification_2d*.pth) on the test split,
+#streaming the test set once for all of them
+from self_supervised_halos.utils.utils import data_preprocess_path, check_cuda, res_path
+from self_supervised_halos.scripts.classification_2d import ClassificationModel
+from self_supervised_halos.scripts.evaluation import evaluate_checkpoints
+
+
+from self_supervised_halos.utils.dataloader import HaloDataset, subhalos_df, DataLoader
+
+import torch
+
+
+if __name__ == '__main__':
+    device = check_cuda()
+    dataset = HaloDataset(root_dir=data_preprocess_path, subhalos_df=subhalos_df,
+                          load_2d=True, load_3d=False, load_mass=False,
+                          choose_two_2d = False)
+    test_size = len(dataset) // 5
+    _, test_ds = torch.utils.data.random_split(dataset, [len(dataset) - test_size, test_size],
+                                               generator=torch.Generator().manual_seed(42))
+    test_loader = DataLoader(test_ds, batch_size=256)
+
+    table, evaluators = evaluate_checkpoints(ClassificationModel, 'Classification_2d*.pth', test_loader,
+                                             device=device, input_index=0,
+                                             factory_kwargs={'scheduler_class': None},
+                                             n_workers=4 if device == 'cpu' else 0)
+    table.to_csv(res_path + 'checkpoint_comparison_2d.csv', index=False)
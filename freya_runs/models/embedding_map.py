@@ -0,0 +1,37 @@
+#2d map of all stored embeddings (results/embeddings/<store>/), saved to results/embedding_maps/ with density and
+#mass images; --add places halos embedded since into the saved map without recomputing it
+#usage: python3 ./freya_runs/models/embedding_map.py supcon [--add]
+from self_supervised_halos.utils.tng import subhalos_df
+from self_supervised_halos.scripts.embeddings import EmbeddingStore
+from self_supervised_halos.scripts.embedding_map import EmbeddingMap, plot_embedding_map, embedding_maps_path
+
+import argparse
+import numpy as np
+import matplotlib.pyplot as plt
+
+
+parser = argparse.ArgumentParser(description='2d map of halo embeddings')
+parser.add_argument('store', help='embedding store name in results/embeddings/')
+parser.add_argument('--name', default=None, help='map name, default: store name')
+parser.add_argument('--add', action='store_true', help='add the new halos of the store to the saved map')
+parser.add_argument('--bins', type=int, default=512)
+args = parser.parse_args()
+
+name = args.name or args.store
+store = EmbeddingStore(args.store)
+if args.add:
+    embedding_map = EmbeddingMap.load(name)
+    new = ~np.isin(store.halo_ids, embedding_map.halo_ids)
+    print(f'Adding {new.sum()} halos to the map of {len(embedding_map)}')
+    if new.any():
+        embedding_map.add(np.asarray(store.embeddings)[new], store.halo_ids[new])
+else:
+    embedding_map = EmbeddingMap.from_store(store)
+embedding_map.save(name)
+
+df = embedding_map.to_dataframe(catalog=subhalos_df[['logSubhaloMass']])
+xy = df[['x', 'y']].to_numpy()
+fig, axs = plt.subplots(1, 2, figsize=(16, 8))
+plot_embedding_map(xy, bins=args.bins, ax=axs[0], title=f'{name}: {len(df)} halos')
+plot_embedding_map(xy, values=df['logSubhaloMass'].to_numpy(), bins=args.bins, ax=axs[1], label='logSubhaloMass')
+plt.savefig(embedding_maps_path + name + '.png')
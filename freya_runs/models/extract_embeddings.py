@@ -0,0 +1,47 @@
+#embed every halo with a trained network into results/embeddings/<name>/, only missing or stale halos are recomputed
+#usage: python3 ./freya_runs/models/extract_embeddings.py supcon --checkpoint SupConNetwork.pth
+from self_supervised_halos.utils.utils import data_preprocess_path, check_cuda
+from self_supervised_halos.scripts.classification_2d import ClassificationModel as ClassificationModel2d
+from self_supervised_halos.scripts.classification_3d import ClassificationModel as ClassificationModel3d
+from self_supervised_halos.scripts.contrastive_learning_2d import ConstrativeLearningModel
+from self_supervised_halos.scripts.halo_mass_embeddings import RegressionModel
+from self_supervised_halos.scripts.embeddings import extract_embeddings
+from self_supervised_halos.scripts.base_model import models_path
+
+
+from self_supervised_halos.utils.dataloader import HaloDataset, subhalos_df, DataLoader
+
+import argparse
+import os
+
+
+#network -> (model class, HaloDataset arguments)
+networks = {
+    'supcon': (ConstrativeLearningModel, dict(load_2d=True, choose_all_2d=True)),
+    'classification_2d': (ClassificationModel2d, dict(load_2d=True, choose_all_2d=True)),
+    'classification_3d': (ClassificationModel3d, dict(load_2d=False, load_3d=True)),
+    'mass_hist': (RegressionModel, dict(load_2d=False, load_mass=True)),
+}
+
+
+parser = argparse.ArgumentParser(description='Extract halo embeddings')
+parser.add_argument('network', choices=list(networks))
+parser.add_argument('--checkpoint', default=None, help='file in results/models/, default <ModelClass>.pth')
+parser.add_argument('--name', default=None, help='embedding store name, default: network name')
+parser.add_argument('--batch_size', type=int, default=256)
+args = parser.parse_args()
+
+device = check_cuda()
+model_class, dataset_kwargs = networks[args.network]
+model = model_class(scheduler_class=None)
+checkpoint = args.checkpoint or model.model_name + '.pth'
+#BaseModel.load only prints a message for a missing file: embeddings of random weights would be stored as a checkpoint's
+if not os.path.exists(models_path + checkpoint):
+    raise FileNotFoundError(f"Checkpoint {models_path + checkpoint} not found")
+model.load(checkpoint)
+
+dataset = HaloDataset(root_dir=data_preprocess_path, subhalos_df=subhalos_df, **dataset_kwargs)
+loader = DataLoader(dataset, batch_size=args.batch_size, shuffle=False)
+
+store = extract_embeddings(model, loader, name=args.name or args.network, device=device)
+print(f'{len(store)} halos, {store.dim}-dim embeddings')
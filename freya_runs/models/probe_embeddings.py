@@ -0,0 +1,25 @@
+#linear probes (ridge and logistic, k-fold) of stored embeddings for mass, mass class and formation time
+#usage: python3 ./freya_runs/models/probe_embeddings.py supcon classification_2d --seeds 0 1 2
+from self_supervised_halos.utils.utils import res_path, check_cuda
+from self_supervised_halos.utils.tng import subhalos_df, subhalos_mass_history
+from self_supervised_halos.scripts.probe_suite import probe_suite, catalog_targets
+
+import argparse
+
+
+parser = argparse.ArgumentParser(description='Linear probes of halo embeddings')
+parser.add_argument('stores', nargs='+', help='embedding store names in results/embeddings/')
+parser.add_argument('--columns', nargs='*', default=[], help='further subhalos_df columns to probe (ridge regression)')
+parser.add_argument('--classification_columns', nargs='*', default=[],
+                    help='columns among --columns that are class labels (logistic probe), mass_class always is')
+parser.add_argument('--folds', type=int, default=5)
+parser.add_argument('--seeds', type=int, nargs='+', default=[0])
+parser.add_argument('--output', default=res_path + 'probes.csv')
+args = parser.parse_args()
+
+device = check_cuda()
+targets = catalog_targets(subhalos_df, subhalos_mass_history, columns=args.columns)
+table = probe_suite(args.stores, targets, classification_targets=['mass_class'] + args.classification_columns,
+                    n_folds=args.folds, seeds=args.seeds, device=device)
+print(table[table['best']].to_string())
+table.to_csv(args.output, index=False)
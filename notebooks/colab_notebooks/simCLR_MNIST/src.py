@@ -14,6 +14,8 @@ import torchvision.transforms as transforms
 from sklearn.manifold import TSNE
 #import umap #conda install -c conda-forge umap-learn
 
+from self_supervised_halos.scripts.losses import SimCLRLoss, SupConLoss
+
 
 LOAD_MODELS = True
 
@@ -66,50 +68,6 @@ def get_mnist_dataloaders(batch_size=128, train_prop=0.7, val_prop=0.2, dataset_
     return dataloader_train, dataloader_val, dataloader_test
 
 
-class SimCLRLoss(nn.Module): #TODO check/test this loss
-    #https://uvadlc-notebooks.readthedocs.io/en/latest/tutorial_notebooks/tutorial17/SimCLR.html
-    def __init__(self, temperature=0.5, device = 'cpu'):
-        super(SimCLRLoss, self).__init__()
-        self.temperature = temperature
-        self.device = device
-        self.similarity_f = nn.CosineSimilarity(dim=2)
-        self.criterion = nn.CrossEntropyLoss()
-
-    def forward(self, zis, zjs):
-        batch_size = zis.size(0)
-
-        # Normalize the embeddings
-        zis = F.normalize(zis, dim=1)
-        zjs = F.normalize(zjs, dim=1)
-
-        # Compute similarity
-        representations = torch.cat([zis, zjs], dim=0)
-        similarity_matrix = self.similarity_f(representations.unsqueeze(1), representations.unsqueeze(0))
-
-        # Create the labels
-        labels = torch.cat([torch.arange(batch_size) for i in range(2)], dim=0)
-        labels = (labels.unsqueeze(0) == labels.unsqueeze(1)).float()
-
-        # Mask to remove positive samples from the similarity matrix
-        mask = torch.eye(labels.shape[0], dtype=torch.bool)
-        labels = labels[~mask].view(labels.shape[0], -1)
-        similarity_matrix = similarity_matrix[~mask].view(similarity_matrix.shape[0], -1)
-
-        # Apply temperature
-        similarity_matrix = similarity_matrix / self.temperature
-
-        # Create target labels
-        target = torch.arange(batch_size).to(self.device) #used to be .to(labels.device) and it DID not work! no idea why
-
-        loss_i = self.criterion(similarity_matrix[:batch_size], target)
-        loss_j = self.criterion(similarity_matrix[batch_size:], target)
-
-        loss = (loss_i + loss_j) / 2
-        return loss
-
-
-
-
 def simCLR_train(model, criterion, optimizer, scheduler,
                 dataloader_train, dataloader_val=None,
                 history=None,
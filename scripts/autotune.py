@@ -0,0 +1,117 @@
+import pandas as pd
+import torch
+import json
+import os
+import itertools
+import multiprocessing as mp
+
+from torch.utils.data import DataLoader
+
+from self_supervised_halos.utils.utils import res_path
+from self_supervised_halos.scripts.prefetch import PrefetchLoader
+from self_supervised_halos.scripts.step_timer import peak_memory_mb
+autotune_path = res_path + 'autotune/'
+
+
+#Short timed training trials (BaseModel.trial_forward_pass with backward=True) over batch size, DataLoader
+#workers, torch threads and prefetch depth. Each configuration runs in a fresh process, so thread settings and
+#peak memory of one trial do not leak into the next; pass a dataset after HaloDataset.share_memory() to avoid copies.
+
+
+def node_type():
+    #key of the tuned configurations: cores and GPU model, nodes of the same partition share it
+    key = f'{os.cpu_count()}cpu'
+    if torch.cuda.is_available():
+        key += '_' + torch.cuda.get_device_name(0).replace(' ', '-')
+    return key
+
+
+def _run_config(build_model, dataset, config, device, n_batches, n_warmup, queue):
+    try:
+        torch.set_num_threads(config['num_threads'])
+        torch.manual_seed(0)
+        model = build_model()
+        model.model.to(device)
+        loader = DataLoader(dataset, batch_size=config['batch_size'], shuffle=True, drop_last=True,
+                            num_workers=config['num_workers'], persistent_workers=config['num_workers'] > 0)
+        if config['prefetch']:
+            loader = PrefetchLoader(loader, device=device, depth=config['prefetch'],
+                                    prepare_fn=lambda batch: model.prepare_batch(batch, device))
+        if str(device).startswith('cuda'):
+            torch.cuda.reset_peak_memory_stats()
+        model.trial_forward_pass(loader, device, n_batches=n_warmup, backward=True)
+        timing = model.trial_forward_pass(loader, device, n_batches=n_batches, backward=True)
+        queue.put({**config, 'samples_per_sec': timing['samples_per_sec'], 'peak_mem_mb': peak_memory_mb(device)})
+    except Exception as e:
+        queue.put({**config, 'error': str(e)})
+
+
+def autotune(build_model, dataset, device='cpu',
+             batch_sizes=(64, 128, 256, 512), num_workers=(0, 2, 4), num_threads=None, prefetch=(0, 2),
+             memory_budget_mb=None, n_batches=10, n_warmup=2, name=None, save=True):
+    """
+    Time every combination and return (best configuration, table of all trials).
+
+    build_model: module-level function (it is pickled to the trial processes) returning a BaseModel instance.
+    num_threads: torch intra-op threads to try; by default the number of cores and half of it.
+    memory_budget_mb: configurations with a higher peak memory (GPU memory on CUDA, RSS on CPU) are discarded.
+    The best configuration is saved to autotune/<name>.json under the key node_type(), see load_tuned_config.
+    """
+    if num_threads is None:
+        n_cores = os.cpu_count() or 1
+        num_threads = sorted({n_cores, max(1, n_cores // 2)})
+    configs = [dict(zip(['batch_size', 'num_workers', 'num_threads', 'prefetch'], values))
+               for values in itertools.product(batch_sizes, num_workers, num_threads, prefetch)]
+
+    ctx = mp.get_context('spawn')
+    results = []
+    for config in configs:
+        queue = ctx.Queue()
+        proc = ctx.Process(target=_run_config, args=(build_model, dataset, config, device, n_batches, n_warmup, queue))
+        proc.start()
+        proc.join()
+        row = queue.get() if not queue.empty() else {**config, 'error': f'exit code {proc.exitcode}'}
+        print(row)
+        results.append(row)
+
+    results_df = pd.DataFrame(results)
+    ok = results_df['samples_per_sec'].notna() if 'samples_per_sec' in results_df else pd.Series(False, index=results_df.index)
+    if memory_budget_mb is not None and ok.any():
+        ok &= results_df['peak_mem_mb'] <= memory_budget_mb
+    results_df['fits'] = ok
+    if not ok.any():
+        print("No configuration ran within the memory budget")
+        return None, results_df
+
+    best = results_df[ok].sort_values('samples_per_sec', ascending=False).iloc[0]
+    best_config = {key: int(best[key]) for key in ['batch_size', 'num_workers', 'num_threads', 'prefetch']}
+    best_config['samples_per_sec'] = float(best['samples_per_sec'])
+    print(f"Best configuration on {node_type()}: {best_config}")
+
+    if save:
+        name = name or build_model().model_name
+        save_tuned_config(name, best_config)
+    return best_config, results_df
+
+
+def save_tuned_config(name, config):
+    os.makedirs(autotune_path, exist_ok=True)
+    filename = autotune_path + name + '.json'
+    configs = {}
+    if os.path.exists(filename):
+        with open(filename) as f:
+            configs = json.load(f)
+    configs[node_type()] = config
+    with open(filename + '.tmp', 'w') as f:
+        json.dump(configs, f, indent=2)
+    os.replace(filename + '.tmp', filename)
+
+
+def load_tuned_config(name, default=None):
+    #configuration tuned for this node type, or default if there is none
+    filename = autotune_path + name + '.json'
+    if not os.path.exists(filename):
+        return default
+    with open(filename) as f:
+        configs = json.load(f)
+    return configs.get(node_type(), default)
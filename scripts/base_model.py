@@ -6,6 +6,7 @@ import matplotlib.pyplot as plt
 from tqdm import tqdm
 import time
 import os
+from contextlib import nullcontext
 
 import torch.nn as nn
 import torch.nn.functional as F
@@ -13,7 +14,27 @@ import torchvision.transforms as transforms
 import torchvision.transforms.functional as TF
 
 from self_supervised_halos.utils.utils import res_path
+from self_supervised_halos.scripts.step_timer import StepTimer, batch_size_of
+from self_supervised_halos.scripts.prefetch import PrefetchLoader, PreparedBatch, move_to_device
+from self_supervised_halos.scripts.distributed import is_distributed, is_main_process, all_reduce_mean, barrier
+from self_supervised_halos.scripts.checkpoint import AsyncCheckpointer, snapshot, atomic_save, get_rng_state, set_rng_state
+from self_supervised_halos.scripts.validation_cache import ValidationCache
+from self_supervised_halos.scripts.probe_monitor import ProbeMonitor
 models_path = res_path + 'models/'
+compile_cache_path = res_path + 'compile_cache/'
+checkpoints_path = models_path + 'checkpoints/'
+
+
+def compiler_errors():
+    #exceptions raised by torch.compile/TorchScript when compilation itself fails. Anything else raised by a compiled
+    #step is a real error of the step and must not trigger the eager fallback
+    errors = [torch.jit.Error]
+    try:
+        from torch._dynamo.exc import TorchDynamoException, BackendCompilerFailed
+        errors += [TorchDynamoException, BackendCompilerFailed]
+    except ImportError:
+        pass
+    return tuple(errors)
 
 
 class BaseModel:
@@ -21,12 +42,254 @@ class BaseModel:
                  optimizer_class=torch.optim.Adam, optimizer_params={'lr':1e-3}, 
                  scheduler_class=torch.optim.lr_scheduler.StepLR,
                  scheduler_params={'step_size': 20, 'gamma': 0.5},
-                 history=None):
+                 history=None,
+                 compile=None):
         self.model = model
+        self.eager_model = model
+        self.model_name = model.__class__.__name__
         self.optimizer = optimizer_class(self.model.parameters(), **optimizer_params)
         self.scheduler = scheduler_class(self.optimizer, **scheduler_params) if scheduler_class else None
 
         self.history = history if history else {'train_loss': [], 'val_loss': [], 'learning_rate': []}
+        self.timer = StepTimer(enabled=False)
+        self.amp_dtype = None
+        self.scaler = None
+        self.compile_backend = None
+        self.distributed = False
+        self.checkpointer = None
+        self.global_step = 0
+        self._resume_position = None
+        self.resolution_schedule = None
+        self.input_resolution = None
+        self.validation_seed = None
+        self.validation_storage = 'cpu'
+        self._validation_cache = None
+        self.probe_monitor = None
+        self.probe_every = 1
+        if compile:
+            self.compile_model(compile)
+
+    def set_mixed_precision(self, dtype='bfloat16', device='cpu'):
+        #opt-in autocast for training and evaluation: 'bfloat16' (CPU or GPU) or 'float16' (GPU, with a GradScaler).
+        #None switches back to float32. Losses in scripts/losses.py always compute their logsumexp in float32
+        if dtype is None:
+            self.amp_dtype, self.scaler = None, None
+            return
+        dtype = getattr(torch, dtype) if isinstance(dtype, str) else dtype
+        device_type = torch.device(device).type
+        if dtype == torch.float16 and device_type != 'cuda':
+            print("float16 autocast is only supported on CUDA here, using bfloat16")
+            dtype = torch.bfloat16
+        self.amp_dtype = dtype
+        self.amp_device_type = device_type
+        if dtype == torch.float16:
+            self.scaler = torch.amp.GradScaler('cuda') if hasattr(torch.amp, 'GradScaler') else torch.cuda.amp.GradScaler()
+        else:
+            self.scaler = None
+        print(f"Mixed precision: {dtype} autocast on {device_type}")
+
+    def compile_model(self, backend='torch_compile', compile_step=False, cache_dir=compile_cache_path,
+                      example_batch=None, device='cpu', **compile_kwargs):
+        #backend: 'torch_compile' (in place, state_dict keys unchanged) or 'torchscript'; None reverts to eager.
+        #compile_step: also torch.compile the whole training_step (device transfer, augmentation, loss).
+        #cache_dir: Inductor FX graph cache (and the portable cache artifacts on torch>=2.6), so later runs skip recompilation.
+        #example_batch: if given, one forward is run right away so compilation errors fall back to eager here and not mid-training
+        self.revert_to_eager()
+        if not backend:
+            return
+        try:
+            if backend == 'torch_compile':
+                self._setup_compile_cache(cache_dir)
+                self.model.compile(**compile_kwargs)
+                if compile_step:
+                    self.training_step = torch.compile(self.training_step, **compile_kwargs)
+            elif backend == 'torchscript':
+                #scripted module shares its parameters with the eager one, the optimizer stays valid
+                self.model = torch.jit.script(self.eager_model)
+            else:
+                raise ValueError(f"Unknown compile backend {backend}")
+            self.compile_backend = backend
+
+            if example_batch is not None:
+                self.model.eval()
+                with torch.no_grad():
+                    self.training_step(example_batch, device)
+                self.save_compile_cache()
+        except Exception as e:
+            print(f"Compilation with {backend} failed, using eager mode: {e}")
+            self.revert_to_eager()
+            return
+        print(f"Model {self.model_name} compiled with {backend}{' (with training step)' if compile_step else ''}")
+
+    def revert_to_eager(self):
+        self.model = self.eager_model
+        if getattr(self.model, '_compiled_call_impl', None) is not None:
+            self.model._compiled_call_impl = None
+        self.__dict__.pop('training_step', None)
+        self.compile_backend = None
+        if self.distributed:
+            self.model = torch.nn.parallel.DistributedDataParallel(self.eager_model)
+
+    def distribute(self, **ddp_kwargs):
+        #wrap the model in DistributedDataParallel; call in the workers started by scripts.distributed.launch
+        if not is_distributed():
+            print("No process group initialized, training in a single process")
+            return
+        self.model = torch.nn.parallel.DistributedDataParallel(self.model, **ddp_kwargs)
+        self.distributed = True
+
+    def set_progressive_resizing(self, schedule):
+        #schedule: {first epoch of the training: input size}, e.g. {0: 16, 2: 32, 4: None} trains epochs 0-1 on inputs pooled to 16^2 (16^3),
+        #epochs 2-3 on 32 and the rest at full resolution. Only training batches are pooled, validation stays at full
+        #resolution. None disables it
+        self.resolution_schedule = dict(sorted(schedule.items())) if schedule else None
+        self.input_resolution = None
+
+    def _update_input_resolution(self):
+        #epochs are counted over the whole training (history), so the schedule carries over between training_loop calls
+        if not self.resolution_schedule:
+            return
+        epoch = len(self.history['train_loss'])
+        for first_epoch, size in self.resolution_schedule.items():
+            if epoch >= first_epoch:
+                self.input_resolution = size
+        #one entry per epoch, aligned with train_loss: an epoch restarted after a mid-epoch resume() already has one,
+        #epochs trained before the schedule was set count as full resolution (0)
+        resolutions = self.history.setdefault('input_resolution', [])
+        del resolutions[epoch:]
+        resolutions.extend([0] * (epoch - len(resolutions)))
+        resolutions.append(self.input_resolution or 0)
+
+    def resize_input(self, x):
+        #average-pool the spatial dimensions of a (batch, channels, ...) tensor to the current scheduled resolution
+        size = self.input_resolution
+        if not size or not self.model.training or x.shape[-1] <= size:
+            return x
+        if x.dim() == 4:
+            return F.adaptive_avg_pool2d(x, size)
+        return F.adaptive_avg_pool3d(x, size)
+
+    def set_validation_cache(self, seed=0, storage_device='cpu'):
+        #validate every epoch on one fixed augmentation of the validation set: the first training_loop call with a
+        #val_loader augments it once with this seed and keeps the prepared batches on storage_device (see
+        #scripts/validation_cache.py). Call again after changing the transform or the loader to rebuild. None disables
+        self.validation_seed = seed
+        self.validation_storage = storage_device
+        self._validation_cache = None
+
+    def _cached_validation(self, val_loader, device):
+        cache = self._validation_cache
+        if cache is None or cache.loader is not val_loader or cache.device != device:
+            was_training = self.model.training
+            self.model.eval() #no progressive resizing for validation
+            cache = ValidationCache(val_loader, lambda batch: self.prepare_batch(batch, device), seed=self.validation_seed,
+                                    storage_device=self.validation_storage, device=device)
+            self.model.train(was_training)
+            if is_main_process():
+                print(f"Cached {len(cache)} validation batches ({cache.nbytes / 2**20:.0f} MB on {self.validation_storage})")
+            self._validation_cache = cache
+        return cache
+
+    def set_probe_monitor(self, probe_loader, every_epochs=1, **monitor_kwargs):
+        #kNN accuracy and ridge probe of the embeddings on a fixed halo subset at the end of every `every_epochs`
+        #epochs, logged to history as probe_* (NaN on the other epochs), see scripts/probe_monitor.py. None disables
+        self.probe_monitor = ProbeMonitor(probe_loader, **monitor_kwargs) if probe_loader is not None else None
+        self.probe_every = every_epochs
+
+    def _run_probe_monitor(self, epoch, device, verbose):
+        if (epoch + 1) % self.probe_every == 0 and is_main_process():
+            probes = self.probe_monitor(self, device)
+            if verbose:
+                print(f"Epoch {epoch + 1}, kNN accuracy: {probes['probe_knn_accuracy']:.3f}, " +
+                      f"ridge R2: {probes['probe_ridge_r2']:.3f} ({1e3*probes['probe_time_s']:.0f} ms)")
+        else:
+            probes = dict.fromkeys(['probe_knn_accuracy', 'probe_ridge_r2', 'probe_ridge_rmse', 'probe_time_s'], np.nan)
+        for key, value in probes.items():
+            self.history.setdefault(key, []).append(value)
+
+    def enable_checkpointing(self, every_steps=None, every_minutes=None, keep_last=3, directory=None):
+        #periodic checkpoints during training_loop, written on a background thread (see scripts/checkpoint.py).
+        #After preemption, call resume() before training_loop with the same arguments to continue mid-epoch;
+        #the batch order is reproduced exactly with a ResumableSampler (or DistributedSampler) in the train loader
+        directory = directory or checkpoints_path + self.model_name + '/'
+        self.checkpointer = AsyncCheckpointer(directory, self.model_name, every_steps=every_steps,
+                                              every_minutes=every_minutes, keep_last=keep_last)
+
+    def checkpoint_state(self, position=None):
+        #CPU snapshot of everything needed to continue training; position: (epoch, batch, train loss sum) inside training_loop
+        return snapshot({
+            'epoch': len(self.history['train_loss']),
+            'step': self.global_step,
+            'model_state_dict': self.eager_model.state_dict(),
+            'optimizer_state_dict': self.optimizer.state_dict(),
+            'scheduler_state_dict': self.scheduler.state_dict() if self.scheduler else None,
+            'scaler_state_dict': self.scaler.state_dict() if self.scaler else None,
+            'history': self.history,
+            'loss': self.history['train_loss'][-1] if self.history['train_loss'] else None,
+            'position': position,
+            'rng_state': get_rng_state(),
+        })
+
+    def save_checkpoint(self, position=None):
+        if not is_main_process():
+            return
+        self.checkpointer.save(self.checkpoint_state(position), self.global_step)
+
+    def resume(self, filename=None):
+        #load the latest periodic checkpoint (or the given file) including RNG state and position in the epoch
+        if filename is None and self.checkpointer:
+            filename = self.checkpointer.latest()
+        if filename is None or not os.path.exists(filename):
+            print(f"No checkpoint found for {self.model_name}, starting from scratch")
+            return False
+        checkpoint = torch.load(filename, map_location='cpu', weights_only=False)
+        self._restore(checkpoint)
+        set_rng_state(checkpoint['rng_state'])
+        #a checkpoint written between epochs has no in-epoch position: continue with the next epoch
+        self._resume_position = checkpoint['position'] or (checkpoint['epoch'], 0, 0)
+        if self.checkpointer:
+            self.checkpointer.last_step = self.global_step
+        print(f'Model {self.model_name} resumed from {filename} (epoch {checkpoint["epoch"]}, step {self.global_step})')
+        return True
+
+    def _setup_compile_cache(self, cache_dir):
+        if not cache_dir:
+            return
+        os.makedirs(cache_dir, exist_ok=True)
+        os.environ.setdefault('TORCHINDUCTOR_CACHE_DIR', cache_dir)
+        os.environ.setdefault('TORCHINDUCTOR_FX_GRAPH_CACHE', '1')
+        self._compile_cache_file = os.path.join(cache_dir, f'{self.model_name}_artifacts.bin')
+        if hasattr(torch.compiler, 'load_cache_artifacts') and os.path.exists(self._compile_cache_file):
+            with open(self._compile_cache_file, 'rb') as f:
+                torch.compiler.load_cache_artifacts(f.read())
+            print(f"Loaded compile cache {self._compile_cache_file}")
+
+    def save_compile_cache(self):
+        #call after the first compiled steps; the FX graph cache in cache_dir is written by Inductor anyway
+        if self.compile_backend != 'torch_compile' or not hasattr(torch.compiler, 'save_cache_artifacts'):
+            return
+        artifacts = torch.compiler.save_cache_artifacts()
+        if artifacts is not None:
+            with open(self._compile_cache_file, 'wb') as f:
+                f.write(artifacts[0])
+
+    def autocast(self):
+        if self.amp_dtype is None:
+            return nullcontext()
+        return torch.autocast(device_type=self.amp_device_type, dtype=self.amp_dtype)
+
+    def backward(self, loss):
+        if self.scaler is not None:
+            self.scaler.scale(loss).backward()
+        else:
+            loss.backward()
+
+    def optimizer_step(self):
+        if self.scaler is not None:
+            self.scaler.step(self.optimizer)
+            self.scaler.update()
+        else:
+            self.optimizer.step()
 
     def forward(self, x):
         raise NotImplementedError("Forward method not implemented")
@@ -34,15 +297,56 @@ class BaseModel:
     def training_step(self, batch, device, verbose=False):
         raise NotImplementedError("Training step not implemented")
 
-    def trial_forward_pass(self, dataloader, device, limit_to_first_batch=True):
-        self.model.eval()
-        with torch.no_grad():
+    def prepare_batch(self, batch, device):
+        #move the batch to the device and apply the input augmentation. Runs on the prefetch thread when
+        #training_loop(prefetch=K) is used; training_step calls it itself for batches that are not PreparedBatch
+        with self.timer.phase('to_device'):
+            return PreparedBatch(move_to_device(batch, device))
+
+    def optimization_step(self, batch, device):
+        #one optimizer update on a batch; subclasses can override it to change how gradients are computed
+        with self.timer.phase('forward'), self.autocast():
+            try:
+                loss = self.training_step(batch, device)
+            except compiler_errors() as e:
+                if not self.compile_backend:
+                    raise
+                #torch.compile compiles lazily, errors show up at the first step. Only compiler errors are caught:
+                #retrying after any other error would hide it and repeat the step's side effects (momentum update, queue)
+                print(f"Compiled step failed, falling back to eager mode: {e}")
+                self.revert_to_eager()
+                loss = self.training_step(batch, device)
+        with self.timer.phase('backward'):
+            self.optimizer.zero_grad()
+            self.backward(loss)
+        with self.timer.phase('optimizer'):
+            self.optimizer_step()
+        return loss
+
+    def trial_forward_pass(self, dataloader, device, limit_to_first_batch=True, n_batches=None, backward=False):
+        #n_batches: number of batches to run (overrides limit_to_first_batch).
+        #backward: full optimization steps instead of forward passes (the weights are updated).
+        #Returns the timing of the pass, used by scripts/autotune.py
+        if n_batches is None:
+            n_batches = 1 if limit_to_first_batch else len(dataloader)
+        self.model.train(backward)
+        n_samples, i = 0, -1 #i stays -1 for an empty loader
+        with (nullcontext() if backward else torch.no_grad()):
             t0 = time.time()
-            for batch in tqdm(dataloader, desc=f"Trial Forward Pass {limit_to_first_batch=}"):
-                self.training_step(batch, device, verbose=limit_to_first_batch)
-                if limit_to_first_batch: break
+            for i, batch in enumerate(tqdm(dataloader, desc=f"Trial Forward Pass {limit_to_first_batch=}", total=n_batches)):
+                if backward:
+                    self.optimization_step(batch, device)
+                else:
+                    with self.autocast():
+                        self.training_step(batch, device, verbose=limit_to_first_batch)
+                n_samples += batch_size_of(batch)
+                if i + 1 == n_batches: break
+            if str(device).startswith('cuda'):
+                torch.cuda.synchronize()
             t1 = time.time()
             print(f"Trial forward pass elapsed time: {t1-t0:.2f} s ({limit_to_first_batch=})")
+        return {'time_s': t1 - t0, 'n_batches': i + 1, 'n_samples': n_samples,
+                'samples_per_sec': n_samples / (t1 - t0) if n_samples else 0.0}
 
 
     def show_transforms(self, dataloader, device):
@@ -53,90 +357,164 @@ class BaseModel:
     def __call__(self, x):
         return self.forward(x)
 
-    def training_loop(self, train_loader, val_loader, num_epochs, device):
+    def training_loop(self, train_loader, val_loader, num_epochs, device,
+                      instrument=False, profile_steps=None, profile_dir=None,
+                      prefetch=0):
+        #instrument: record per-step phase timings, samples/sec and peak memory (see StepTimer), epoch means go to history
+        #profile_steps: (first, last) training steps to trace with torch.profiler, saved to profile_dir
+        #prefetch: number of batches moved to the device and augmented ahead of time on a background thread
+        if instrument or profile_steps:
+            self.timer.reset(enabled=True, device=device, profile_steps=profile_steps, profile_dir=profile_dir)
 
-        for epoch in tqdm(range(num_epochs), desc="Epochs"):
-            self.model.train()  # Set the model to training mode
-            train_loss = 0
-            #for batch in tqdm(train_loader, desc=f"Epoch {epoch+1}/{num_epochs} Training"):
-            for batch in train_loader:
-                loss = self.training_step(batch, device)
-                self.optimizer.zero_grad()
-                loss.backward()
-                self.optimizer.step()
-                train_loss += loss.item()
-            avg_train_loss = train_loss / len(train_loader)
-            self.history['train_loss'].append(avg_train_loss)
-            print(f"Epoch {epoch + 1}, Training Loss: {avg_train_loss}")
-
-            if val_loader:
-                self.model.eval()  # Set the model to evaluation mode
-                val_loss = 0
-                with torch.no_grad():
-                    #for batch in tqdm(val_loader, desc=f"Epoch {epoch+1}/{num_epochs} Validation"):
-                    for batch in val_loader:
-                        loss = self.training_step(batch, device)
-                        val_loss += loss.item()
-                avg_val_loss = val_loss / len(val_loader)
-                self.history['val_loss'].append(avg_val_loss)
-                print(f"Epoch {epoch + 1}, Validation Loss: {avg_val_loss}")
-
-            if self.scheduler:
-                if isinstance(self.scheduler, torch.optim.lr_scheduler.ReduceLROnPlateau):
-                    if val_loader:
-                        self.scheduler.step(avg_val_loss)
+        if val_loader and self.validation_seed is not None:
+            val_loader = self._cached_validation(val_loader, device)
+
+        if prefetch:
+            prepare_fn = lambda batch: self.prepare_batch(batch, device)
+            train_loader = PrefetchLoader(train_loader, device=device, depth=prefetch, prepare_fn=prepare_fn)
+            if val_loader and not isinstance(val_loader, ValidationCache):
+                val_loader = PrefetchLoader(val_loader, device=device, depth=prefetch, prepare_fn=prepare_fn)
+
+        start_epoch, start_batch, start_loss = 0, 0, 0
+        if self._resume_position:
+            #set by resume(): continue inside the interrupted epoch or with the next one
+            start_epoch, start_batch, start_loss = self._resume_position
+            self._resume_position = None
+
+        try:
+            verbose = is_main_process()
+            for epoch in tqdm(range(start_epoch, num_epochs), desc="Epochs", disable=not verbose):
+                self.model.train()  # Set the model to training mode
+                self._update_input_resolution()
+                train_loss = start_loss if epoch == start_epoch else 0
+                batch_index = start_batch if epoch == start_epoch else 0
+                sampler = getattr(train_loader, 'sampler', None)
+                if hasattr(sampler, 'set_epoch'):
+                    sampler.set_epoch(epoch) #DistributedSampler/ResumableSampler: different shuffling every epoch
+                n_skip = 0
+                if batch_index:
+                    if hasattr(sampler, 'set_start'):
+                        sampler.set_start(batch_index * train_loader.batch_size)
                     else:
-                        self.scheduler.step(avg_train_loss)
-                else:
-                    self.scheduler.step()
+                        n_skip = batch_index
+                #for batch in tqdm(train_loader, desc=f"Epoch {epoch+1}/{num_epochs} Training"):
+                for batch in self.timer.iterate(train_loader, epoch=epoch):
+                    if n_skip:
+                        n_skip -= 1
+                        continue
+                    loss = self.optimization_step(batch, device)
+                    train_loss += loss.item()
+                    batch_index += 1
+                    self.global_step += 1
+                    if self.checkpointer and self.checkpointer.due(self.global_step):
+                        self.save_checkpoint(position=(epoch, batch_index, train_loss))
+                avg_train_loss = all_reduce_mean(train_loss / len(train_loader))
+                self.history['train_loss'].append(avg_train_loss)
+                if verbose:
+                    print(f"Epoch {epoch + 1}, Training Loss: {avg_train_loss}")
+
+                if self.timer.enabled:
+                    timing = self.timer.epoch_summary(epoch)
+                    for key, value in timing.items():
+                        self.history.setdefault(key, []).append(value)
+                    if verbose:
+                        print(f"Epoch {epoch + 1}, {timing['samples_per_sec']:.1f} samples/s (per process), " +
+                              ", ".join(f"{key[5:]}: {1e3*value:.1f} ms" for key, value in timing.items() if key.startswith('time_')))
+
+                if val_loader:
+                    self.model.eval()  # Set the model to evaluation mode
+                    val_loss = 0
+                    with torch.no_grad(), self.autocast():
+                        #for batch in tqdm(val_loader, desc=f"Epoch {epoch+1}/{num_epochs} Validation"):
+                        for batch in val_loader:
+                            loss = self.training_step(batch, device)
+                            val_loss += loss.item()
+                    avg_val_loss = all_reduce_mean(val_loss / len(val_loader))
+                    self.history['val_loss'].append(avg_val_loss)
+                    if verbose:
+                        print(f"Epoch {epoch + 1}, Validation Loss: {avg_val_loss}")
+
+                if self.probe_monitor:
+                    self._run_probe_monitor(epoch, device, verbose)
+
+                if self.scheduler:
+                    if isinstance(self.scheduler, torch.optim.lr_scheduler.ReduceLROnPlateau):
+                        if val_loader:
+                            self.scheduler.step(avg_val_loss)
+                        else:
+                            self.scheduler.step(avg_train_loss)
+                    else:
+                        self.scheduler.step()
                     
-                current_lr = self.scheduler.get_last_lr()[0]
-            else:
-                current_lr = self.optimizer.param_groups[0]['lr']
-            self.history['learning_rate'].append(current_lr)
+                    current_lr = self.scheduler.get_last_lr()[0]
+                else:
+                    current_lr = self.optimizer.param_groups[0]['lr']
+                self.history['learning_rate'].append(current_lr)
 
-    def save(self):
-        filename = models_path + self.model.__class__.__name__ + '.pth'
-        filename_plt = models_path + self.model.__class__.__name__ + '.png'
-        epoch = len(self.history['train_loss'])
-        loss = self.history['train_loss'][-1]
-        torch.save({
-            'epoch': epoch,
-            'model_state_dict': self.model.state_dict(),
-            'optimizer_state_dict': self.optimizer.state_dict(),
-            'scheduler_state_dict': self.scheduler.state_dict() if self.scheduler else None,
-            'history': self.history,
-            'loss': loss
-        }, filename)
-        print(f'Model {self.model.__class__.__name__} saved at epoch {epoch}')
+                if self.checkpointer and self.checkpointer.due(self.global_step):
+                    self.save_checkpoint(position=(epoch + 1, 0, 0))
+        finally:
+            #also on errors: wait for checkpoint writes and save a profiler window that reaches past the last step
+            if self.checkpointer:
+                self.checkpointer.wait()
+            self.timer.close()
+            self.timer.enabled = False
+
+    def export_timing(self, filename=None):
+        #per-step timings of the last instrumented training_loop, .json or .csv
+        filename = filename or models_path + self.model_name + '_timing.csv'
+        self.timer.export(filename)
+
+    def save(self, plot=False):
+        #in distributed runs only rank 0 writes, the others wait for it
+        if not is_main_process():
+            barrier()
+            return
+        filename = models_path + self.model_name + '.pth'
+        state = self.checkpoint_state()
+        atomic_save(state, filename)
+        print(f'Model {self.model_name} saved at epoch {state["epoch"]}')
+        barrier()
+        if plot:
+            self.plot_history()
 
+    def plot_history(self, show=False):
+        #loss curves to <ModelClass>.png; show=True also opens the figure (blocks on headless nodes)
+        filename_plt = models_path + self.model_name + '.png'
         plt.figure()
         plt.plot(self.history['train_loss'], label='train')
-        try:
+        if self.history['val_loss']:
             plt.plot(self.history['val_loss'], label='val')
-        except:
-            pass
-
         plt.legend()
         plt.savefig(filename_plt)
-        plt.show()
-
+        if show:
+            plt.show()
+        plt.close()
 
     def load(self, filename):
         filename = models_path + filename
         try:
-            checkpoint = torch.load(filename)
+            checkpoint = torch.load(filename, weights_only=False)
         except FileNotFoundError:
-            print(f"Model {self.model.__class__.__name__} not found at {filename}")
+            print(f"Model {self.model_name} not found at {filename}")
             return None
 
+        self._restore(checkpoint)
+        loss = checkpoint['loss']
+        print(f'Model {self.model_name} loaded at epoch {checkpoint["epoch"]}')
+        return loss
 
-        self.model.load_state_dict(checkpoint['model_state_dict'])
+    def _restore(self, checkpoint):
+        self.eager_model.load_state_dict(checkpoint['model_state_dict'])
         self.optimizer.load_state_dict(checkpoint['optimizer_state_dict'])
         if self.scheduler:
             self.scheduler.load_state_dict(checkpoint['scheduler_state_dict'])
+        if self.scaler and checkpoint.get('scaler_state_dict'):
+            self.scaler.load_state_dict(checkpoint['scaler_state_dict'])
         self.history = checkpoint['history']
-        loss = checkpoint['loss']
-        print(f'Model {self.model.__class__.__name__} loaded at epoch {checkpoint["epoch"]}')
-        return loss
-    
+        self.global_step = checkpoint.get('step', 0)
+        self.on_load()
+
+    def on_load(self):
+        #hook for subclasses with state derived from the weights
+        pass
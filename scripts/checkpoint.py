@@ -0,0 +1,145 @@
+import torch
+import numpy as np
+import random
+import threading
+import time
+import glob
+import os
+
+
+#Periodic checkpoints during BaseModel.training_loop (see BaseModel.enable_checkpointing and BaseModel.resume).
+#The state is copied to CPU on the training thread and written on a background thread, so a step only waits
+#for the copy. Files are written to a temporary name and renamed, a preempted job never leaves a broken checkpoint.
+
+
+def snapshot(obj):
+    #deep copy of a (nested) state dict with all tensors detached and moved to the CPU
+    if isinstance(obj, torch.Tensor):
+        return obj.detach().to('cpu', copy=True)
+    if isinstance(obj, dict):
+        return {key: snapshot(value) for key, value in obj.items()}
+    if isinstance(obj, (list, tuple)):
+        return type(obj)(snapshot(value) for value in obj)
+    return obj
+
+
+def atomic_save(obj, filename):
+    tmp_filename = filename + '.tmp'
+    torch.save(obj, tmp_filename)
+    os.replace(tmp_filename, filename)
+
+
+def get_rng_state():
+    state = {'python': random.getstate(),
+             'numpy': np.random.get_state(),
+             'torch': torch.get_rng_state()}
+    if torch.cuda.is_available():
+        state['cuda'] = torch.cuda.get_rng_state_all()
+    return state
+
+
+def set_rng_state(state):
+    random.setstate(state['python'])
+    np.random.set_state(state['numpy'])
+    torch.set_rng_state(state['torch'])
+    if 'cuda' in state and torch.cuda.is_available():
+        torch.cuda.set_rng_state_all(state['cuda'])
+
+
+class ResumableSampler(torch.utils.data.Sampler):
+    """
+    Random (or sequential) sampler with a fixed order for every epoch (seed + epoch), so that a run resumed
+    mid-epoch sees the remaining batches of the same order. BaseModel.training_loop calls set_epoch and,
+    when resuming, set_start to skip the samples already used.
+    """
+    def __init__(self, data_source, shuffle=True, seed=0):
+        self.data_source = data_source
+        self.shuffle = shuffle
+        self.seed = seed
+        self.epoch = 0
+        self.start = 0
+
+    def set_epoch(self, epoch):
+        self.epoch = epoch
+
+    def set_start(self, start):
+        #skip the first `start` samples of the next iteration only
+        self.start = start
+
+    def __iter__(self):
+        n = len(self.data_source)
+        if self.shuffle:
+            generator = torch.Generator()
+            generator.manual_seed(self.seed + self.epoch)
+            order = torch.randperm(n, generator=generator)
+        else:
+            order = torch.arange(n)
+        start, self.start = self.start, 0
+        return iter(order[start:].tolist())
+
+    def __len__(self):
+        return len(self.data_source)
+
+
+class AsyncCheckpointer:
+    """
+    Writes checkpoints every `every_steps` optimizer steps and/or every `every_minutes` minutes on a background
+    thread, keeping the `keep_last` most recent files `<prefix>_step<step>.pth` in `directory`.
+    """
+    def __init__(self, directory, prefix, every_steps=None, every_minutes=None, keep_last=3):
+        self.directory = directory
+        self.prefix = prefix
+        self.every_steps = every_steps
+        self.every_minutes = every_minutes
+        self.keep_last = keep_last
+        self.last_time = time.time()
+        self.last_step = 0
+        self.thread = None
+        self.error = None
+        os.makedirs(directory, exist_ok=True)
+
+    def due(self, step):
+        if self.every_steps and step - self.last_step >= self.every_steps:
+            return True
+        if self.every_minutes and time.time() - self.last_time >= 60 * self.every_minutes:
+            return True
+        return False
+
+    def save(self, state, step):
+        #state must already be a snapshot (see snapshot), it is written while training continues
+        self.wait()
+        self.last_step = step
+        self.last_time = time.time()
+        filename = os.path.join(self.directory, f'{self.prefix}_step{step:08d}.pth')
+        self.thread = threading.Thread(target=self._write, args=(state, filename), daemon=True)
+        self.thread.start()
+
+    def _write(self, state, filename):
+        try:
+            atomic_save(state, filename)
+            self._rotate()
+        except Exception as e:
+            self.error = e
+
+    def _rotate(self):
+        if not self.keep_last:
+            return
+        for filename in self.checkpoints()[:-self.keep_last]:
+            os.remove(filename)
+
+    def wait(self):
+        #block until the checkpoint in flight is on disk
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+        if self.error is not None:
+            error, self.error = self.error, None
+            print(f"Checkpoint writing failed: {error}")
+
+    def checkpoints(self):
+        #zero-padded step numbers: lexicographic order is step order
+        return sorted(glob.glob(os.path.join(self.directory, f'{self.prefix}_step*.pth')))
+
+    def latest(self):
+        checkpoints = self.checkpoints()
+        return checkpoints[-1] if checkpoints else None
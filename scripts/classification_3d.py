@@ -14,6 +14,10 @@ import matplotlib.pyplot as plt
 
 
 from self_supervised_halos.scripts.base_model import BaseModel
+from self_supervised_halos.scripts.prefetch import PreparedBatch, move_to_device
+from self_supervised_halos.scripts.layers import DownsampleMaxPool
+from self_supervised_halos.scripts.evaluation import evaluate_classifier
+from self_supervised_halos.scripts.tta import tta_logits
 
 class Classification_3d(nn.Module):
     def __init__(self):
@@ -21,15 +25,15 @@ class Classification_3d(nn.Module):
         self.cnn = nn.Sequential(
             nn.Conv3d(1, 16, kernel_size=2, stride=2),
             nn.ReLU(),
-            nn.MaxPool3d(kernel_size=2, stride=2),
+            DownsampleMaxPool(dims=3),
 
             nn.Conv3d(16, 32, kernel_size=2, stride=2),
             nn.ReLU(),
-            nn.MaxPool3d(kernel_size=2, stride=2),
+            DownsampleMaxPool(dims=3),
 
             nn.Conv3d(32, 64, kernel_size=2, stride=2),
             nn.ReLU(),
-            nn.MaxPool3d(kernel_size=2, stride=2),
+            nn.AdaptiveMaxPool3d(1), #same as MaxPool3d(2, 2) for 64 pixel inputs, also accepts 16 and 32 (progressive resizing)
             nn.Flatten()
         )
         self.fc = nn.Sequential(
@@ -52,6 +56,7 @@ class ClassificationModel(BaseModel):
                 criterion=None, 
                 history=None,
                 transform = None,
+                compile=None,
                  ):
         model = Classification_3d()
         super().__init__(model, 
@@ -62,17 +67,27 @@ class ClassificationModel(BaseModel):
         self.criterion = criterion
         self.history = history if history else {'train_loss': [], 'val_loss': [], 'learning_rate': []}
         self.transform = transform
+        if compile:
+            self.compile_model(compile)
 
     def forward(self, x):
         return self.model(x)
 
+    def prepare_batch(self, batch, device):
+        with self.timer.phase('to_device'):
+            inputs, targets = move_to_device(batch, device)
+        if self.transform:
+            with self.timer.phase('transform'):
+                inputs = (inputs[0], self.transform(inputs[1])) + tuple(inputs[2:])
+        inputs = (inputs[0], self.resize_input(inputs[1])) + tuple(inputs[2:])
+        return PreparedBatch((inputs, targets))
+
     def training_step(self, batch, device, verbose = False):
+        if not isinstance(batch, PreparedBatch):
+            batch = self.prepare_batch(batch, device)
         inputs, targets = batch
         inputs = inputs[1]
         targets = targets[1]
-        inputs, targets = inputs.to(device), targets.to(device)
-        if self.transform:
-            inputs = self.transform(inputs)
 
         outputs = self.model(inputs)
         loss = self.criterion(outputs, targets)
@@ -84,57 +99,14 @@ class ClassificationModel(BaseModel):
         return loss
 
 
-def report_classification_performance(model, dataloader, device='cpu', viz_one = False):
-    model.model.eval()
-
-    all_preds = []
-    all_labels = []
-    all_ids = []
-    all_masses = []
-
-    with torch.no_grad():
-        for i, batch in tqdm(enumerate(dataloader), desc="Classification Performance"):
-            inputs, targets = batch
-            image = inputs[1].to(device)
-            halo_id = targets[2].to(device)
-            halo_mass = targets[0].to(device)
-            batch_label = targets[1].to(device)
-
-            pred_class = model(image)
-
-
-            if viz_one:
-                n_img_to_plots = 3
-                fig, ax = plt.subplots(1, n_img_to_plots, figsize=(10, 5))
-                for i in range(n_img_to_plots):
-                    img_input = image[i].cpu().numpy()
-                    img_input = np.squeeze(img_input)
-                    logmass = halo_mass[i].cpu().numpy()
-                    ax[i].imshow(img_input, cmap='afmhot')
-                    ax[i].set_title(f"True: {batch_label[i]}, Pred: {torch.argmax(pred_class[i])}; Mass: {logmass:.1f}", fontsize=10)
-                return None
-
-
-
-            all_preds.append(pred_class)
-            all_labels.append(batch_label)
-            all_masses.append(halo_mass)
-            all_ids.append(halo_id)
-
-    all_preds = torch.cat(all_preds)
-    all_labels = torch.cat(all_labels)
-    all_masses = torch.cat(all_masses)
-    all_ids = torch.cat(all_ids)
-
-
-    all_preds = all_preds.cpu().numpy()
-    all_labels = all_labels.cpu().numpy()
-    all_ids = all_ids.cpu().numpy()
-    all_masses = all_masses.cpu().numpy()
-
-
-    pred_labels = np.argmax(all_preds, axis=1)
-
-    results_df = pd.DataFrame({'id':all_ids, 'mass':all_masses, 'true_class': all_labels, 'pred_class': pred_labels})
-
-    return results_df
+def report_classification_performance(model, dataloader, device='cpu', viz_one = False, keep_predictions = True, tta = False):
+    #metrics are accumulated in fixed memory by scripts/evaluation.py; returns the per-halo predictions table
+    #(id, mass, true_class, pred_class, confidence), or the evaluator itself with keep_predictions=False
+    #tta: average the logits over the 24 rotations of each cube, see scripts/tta.py
+    logits_fn = (lambda model, x: tta_logits(model, x, input_index=1)) if tta else None
+    evaluator = evaluate_classifier(model, dataloader, device=device, input_index=1,
+                                    keep_predictions=keep_predictions, viz_one=viz_one, logits_fn=logits_fn)
+    if evaluator is None:
+        return None
+    print(evaluator.summary())
+    return evaluator.predictions_dataframe() if keep_predictions else evaluator
@@ -5,6 +5,8 @@ import numpy as np
 from tqdm import tqdm
 import time
 import os
+import copy
+from contextlib import nullcontext
 
 import torch.nn as nn
 import torch.nn.functional as F
@@ -14,87 +16,11 @@ import matplotlib.pyplot as plt
 
 
 from self_supervised_halos.scripts.base_model import BaseModel
-from self_supervised_halos.utils.dataloader import img2d_transform
-
-
-class SupConLoss(nn.Module): #TODO check/test this loss
-    #src: https://github.com/giakoumoglou/classification/tree/main/notebooks
-    #if no labels are provided, it is basically the SimCLRLoss #TODO check this with SimCLRLoss class
-    def __init__(self, temperature=0.07, contrast_mode='all',
-                 base_temperature=0.07,
-                 device = 'cpu'):
-        super(SupConLoss, self).__init__()
-        self.temperature = temperature
-        self.contrast_mode = contrast_mode
-        self.base_temperature = base_temperature
-
-        self.device = device
-
-    def forward(self, features, labels=None, mask=None):
-
-        device = self.device
-
-        if len(features.shape) < 3:
-            raise ValueError('`features` needs to be [bsz, n_views, ...],'
-                             'at least 3 dimensions are required')
-        if len(features.shape) > 3:
-            features = features.view(features.shape[0], features.shape[1], -1)
-
-        batch_size = features.shape[0]
-        if labels is not None and mask is not None:
-            raise ValueError('Cannot define both `labels` and `mask`')
-        elif labels is None and mask is None:
-            mask = torch.eye(batch_size, dtype=torch.float32).to(device)
-        elif labels is not None:
-            labels = labels.contiguous().view(-1, 1)
-            if labels.shape[0] != batch_size:
-                raise ValueError('Num of labels does not match num of features')
-            mask = torch.eq(labels, labels.T).float().to(device)
-        else:
-            mask = mask.float().to(device)
-
-        contrast_count = features.shape[1]
-        contrast_feature = torch.cat(torch.unbind(features, dim=1), dim=0)
-        if self.contrast_mode == 'one':
-            anchor_feature = features[:, 0]
-            anchor_count = 1
-        elif self.contrast_mode == 'all':
-            anchor_feature = contrast_feature
-            anchor_count = contrast_count
-        else:
-            raise ValueError('Unknown mode: {}'.format(self.contrast_mode))
-
-        # compute logits
-        anchor_dot_contrast = torch.div(
-            torch.matmul(anchor_feature, contrast_feature.T),
-            self.temperature)
-        # for numerical stability
-        logits_max, _ = torch.max(anchor_dot_contrast, dim=1, keepdim=True)
-        logits = anchor_dot_contrast - logits_max.detach()
-
-        # tile mask
-        mask = mask.repeat(anchor_count, contrast_count)
-        # mask-out self-contrast cases
-        logits_mask = torch.scatter(
-            torch.ones_like(mask),
-            1,
-            torch.arange(batch_size * anchor_count).view(-1, 1).to(device),
-            0
-        )
-        mask = mask * logits_mask
-
-        # compute log_prob
-        exp_logits = torch.exp(logits) * logits_mask
-        log_prob = logits - torch.log(exp_logits.sum(1, keepdim=True))
-
-        # compute mean of log-likelihood over positive
-        mean_log_prob_pos = (mask * log_prob).sum(1) / mask.sum(1)
-
-        # loss
-        loss = - (self.temperature / self.base_temperature) * mean_log_prob_pos
-        loss = loss.view(anchor_count, batch_size).mean()
-
-        return loss
+from self_supervised_halos.scripts.prefetch import PreparedBatch
+from self_supervised_halos.scripts.layers import DownsampleMaxPool
+from self_supervised_halos.scripts.distributed import is_distributed, all_gather_with_grad, all_gather_no_grad
+from self_supervised_halos.utils.dataloader import img2d_transform, img2d_view_transform, img2d_local_view_transform
+from self_supervised_halos.scripts.losses import SupConLoss, MoCoSupConLoss, queue_supcon_loss
 
 
 class Encoder(nn.Module):
@@ -107,15 +33,15 @@ class Encoder(nn.Module):
         self.encoder = nn.Sequential(
             nn.Conv2d(image_channels, 32, kernel_size=2, stride=2),
             nn.ReLU(),
-            nn.MaxPool2d(kernel_size=2, stride=2),
+            DownsampleMaxPool(dims=2),
 
             nn.Conv2d(32, 64, kernel_size=2, stride=2),
             nn.ReLU(),
-            nn.MaxPool2d(kernel_size=2, stride=2),
+            DownsampleMaxPool(dims=2),
 
             nn.Conv2d(64, 128, kernel_size=2, stride=2),
             nn.ReLU(),
-            nn.MaxPool2d(kernel_size=2, stride=2),
+            nn.AdaptiveMaxPool2d(1), #same as MaxPool2d(2, 2) for 64x64 inputs, also accepts 32x32 local crops and 16x16 inputs
 
             nn.Flatten(),
             nn.Linear(128, 64),
@@ -157,6 +83,48 @@ class SupConNetwork(nn.Module):
 
 
 
+class EmbeddingQueue:
+    """Fixed-size FIFO queue of detached embeddings and their labels (MoCo negatives)"""
+    def __init__(self, size):
+        self.size = size
+        self.embeddings = None
+        self.labels = None
+        self.ptr = 0
+        self.n_filled = 0
+
+    def __len__(self):
+        return self.n_filled
+
+    def reset(self):
+        self.embeddings = None
+        self.labels = None
+        self.ptr = 0
+        self.n_filled = 0
+
+    @torch.no_grad()
+    def enqueue(self, embeddings, labels):
+        embeddings = embeddings.detach()
+        labels = labels.detach().to(embeddings.device)
+        if self.embeddings is None or self.embeddings.device != embeddings.device:
+            self.embeddings = torch.zeros(self.size, embeddings.shape[1], dtype=embeddings.dtype, device=embeddings.device)
+            self.labels = torch.full((self.size,), -1, dtype=labels.dtype, device=embeddings.device)
+            self.ptr = 0
+            self.n_filled = 0
+
+        n = min(embeddings.shape[0], self.size)
+        idx = (self.ptr + torch.arange(n, device=embeddings.device)) % self.size
+        self.embeddings[idx] = embeddings[-n:]
+        self.labels[idx] = labels[-n:]
+        self.ptr = (self.ptr + n) % self.size
+        self.n_filled = min(self.n_filled + n, self.size)
+
+    def get(self):
+        if self.n_filled == 0:
+            return None, None
+        return self.embeddings[:self.n_filled], self.labels[:self.n_filled]
+
+
+
 class ConstrativeLearningModel(BaseModel):
     def __init__(self, 
                 optimizer_class=torch.optim.Adam,
@@ -167,7 +135,24 @@ class ConstrativeLearningModel(BaseModel):
                 history=None,
                 transform = img2d_transform,
                 use_labels_for_loss = True,
+                momentum_queue_size = None,
+                momentum = 0.99,
+                grad_cache_chunk_size = None,
+                n_global_views = None,
+                n_local_views = 0,
+                global_view_transform = img2d_view_transform,
+                local_view_transform = img2d_local_view_transform,
+                compile=None,
                  ):
+        #momentum_queue_size: if set, train MoCo-style: keys from a momentum copy of the network are kept in a FIFO queue
+        #of this size and used as extra negatives/positives. criterion must then be MoCoSupConLoss (the default)
+        #or queue_supcon_loss
+        #grad_cache_chunk_size: if set, use gradient caching (https://arxiv.org/abs/2101.06983) so the loss is computed over
+        #the full loader batch while the network only ever holds activations of grad_cache_chunk_size views
+        #n_global_views: if set, multi-view mode. The dataset must be built with choose_all_2d=True; each sample gives
+        #n_global_views full-size views (cycling through the xy/xz/yz projections) and n_local_views small local crops,
+        #each group augmented with one batched call of global_view_transform/local_view_transform
+        #set_probe_monitor(loader) logs the kNN accuracy and ridge R^2 of the encoder embeddings to history every epoch
         model = SupConNetwork(Encoder(), ProjectionHead())
         super().__init__(model, 
                         optimizer_class = optimizer_class, 
@@ -178,44 +163,206 @@ class ConstrativeLearningModel(BaseModel):
         self.history = history if history else {'train_loss': [], 'val_loss': [], 'learning_rate': []}
         self.transform = transform
         self.use_labels_for_loss = use_labels_for_loss
+        self.grad_cache_chunk_size = grad_cache_chunk_size
+        self.n_global_views = n_global_views
+        self.n_local_views = n_local_views
+        self.global_view_transform = global_view_transform
+        self.local_view_transform = local_view_transform
+
+        if momentum_queue_size and n_global_views and (n_global_views != 2 or n_local_views):
+            raise ValueError('Momentum queue mode supports exactly two views')
+
+        self.momentum = momentum
+        if momentum_queue_size:
+            criterion_fn = getattr(self.criterion, 'func', self.criterion) #functools.partial
+            if self.criterion is None:
+                self.criterion = MoCoSupConLoss()
+            elif not (isinstance(self.criterion, MoCoSupConLoss) or criterion_fn is queue_supcon_loss):
+                raise ValueError(f"Momentum queue mode needs a MoCoSupConLoss or queue_supcon_loss criterion, "
+                                 f"got {type(self.criterion).__name__}")
+            self.momentum_model = copy.deepcopy(self.model)
+            for param in self.momentum_model.parameters():
+                param.requires_grad = False
+            self.queue = EmbeddingQueue(momentum_queue_size)
+        else:
+            self.momentum_model = None
+            self.queue = None
+        if compile:
+            #compiled last, once the criterion, transforms and momentum copy exist
+            self.compile_model(compile)
 
     def forward(self, x):
         return self.model(x)
 
-    def training_step(self, batch, device, verbose = False):
+    @torch.no_grad()
+    def update_momentum_model(self):
+        for param, param_m in zip(self.model.parameters(), self.momentum_model.parameters()):
+            param_m.mul_(self.momentum).add_(param.detach(), alpha=1 - self.momentum)
+
+    def embed(self, views, model=None, chunk_size=None):
+        #views: list of view-major tensors (one per resolution); returns view-major embeddings of all views
+        model = model if model is not None else self.model
+        features = []
+        for view_group in views:
+            for chunk in torch.split(view_group, chunk_size or view_group.shape[0], dim=0):
+                features.append(model(chunk))
+        return torch.cat(features, dim=0)
+
+    def momentum_queue_loss(self, views, features, targets, device):
+        batch_size = features.shape[0] // 2
+        param = next(self.model.parameters())
+        self.momentum_model.to(param.device)
+        if self.model.training:
+            self.update_momentum_model()
+
+        with torch.no_grad():
+            self.momentum_model.train(self.model.training)
+            keys = self.embed(views, model=self.momentum_model, chunk_size=self.grad_cache_chunk_size)
+        #positive key of the view_1 query is the view_2 key and vice versa
+        keys = torch.roll(keys, batch_size, dims=0)
+
+        targets = targets.to(device)
+        labels = torch.cat([targets, targets], dim=0) if self.use_labels_for_loss else None
+        queue, queue_labels = self.queue.get()
+
+        #without labels, keys[(i + B) % 2B] (after the roll) is the momentum key of query i's own view: a near-duplicate
+        #of the query, not a negative, so it is left out of the contrast set (MoCo InfoNCE: positive key + negatives)
+        ignore_keys = None
+        if labels is None:
+            ignore_keys = (torch.arange(2 * batch_size, device=features.device) + batch_size) % (2 * batch_size)
+        loss = self.criterion(features, keys, queue=queue, labels=labels, queue_labels=queue_labels, ignore_keys=ignore_keys)
+
+        if self.model.training:
+            self.queue.enqueue(keys[:batch_size], targets)
+        return loss
+
+    def make_views(self, batch, device):
+        #returns a list of view-major tensors [(n_views * batch_size, 1, H, W), ...], one per view resolution
+        if self.n_global_views:
+            return self.make_multi_views(batch, device)
+
         inputs, targets = batch
         images = inputs[0]
         targets = targets[1]
 
 
-        image_1 = images[0].to(device)
-        image_2 = images[1].to(device)
-        
-        batch_size = image_1.shape[0]
+        with self.timer.phase('to_device'):
+            image_1 = images[0].to(device)
+            image_2 = images[1].to(device)
 
-        view_1 = self.transform(image_1)
-        view_2 = self.transform(image_2)
+        with self.timer.phase('transform'):
+            view_1 = self.transform(image_1)
+            view_2 = self.transform(image_2)
 
-        data = torch.cat([view_1, view_2], dim=0)
-        data = data.to(device)
+            data = torch.cat([view_1, view_2], dim=0)
+        return [data], targets
 
-        features = self.model(data)
-
-        f1, f2 = torch.split(features, [batch_size, batch_size], dim=0)
-        features = torch.cat([f1.unsqueeze(1), f2.unsqueeze(1)], dim=1)
+    def make_multi_views(self, batch, device):
+        inputs, targets = batch
+        with self.timer.phase('to_device'):
+            images = inputs[0].to(device) # (batch_size, 3 projections, 1, H, W)
+        targets = targets[1]
+        n_proj = images.shape[1]
+
+        def select(n_views):
+            #view v uses projection v % 3, view-major layout: [all samples of view 0, all samples of view 1, ...]
+            proj_idx = torch.arange(n_views, device=device) % n_proj
+            selected = images[:, proj_idx].transpose(0, 1)
+            return selected.reshape(n_views * images.shape[0], *images.shape[2:])
+
+        with self.timer.phase('transform'):
+            views = [self.global_view_transform(select(self.n_global_views))]
+            if self.n_local_views:
+                views.append(self.local_view_transform(select(self.n_local_views)))
+        return views, targets
+
+    def contrastive_loss(self, views, features, targets, device):
+        if self.momentum_model is not None:
+            return self.momentum_queue_loss(views, features, targets, device)
+
+        batch_size = targets.shape[0]
+        n_views = features.shape[0] // batch_size
+        features = features.view(n_views, batch_size, -1).transpose(0, 1) # (batch_size, n_views, dim)
+
+        if is_distributed():
+            #negatives span the batches of all processes. all_gather sums the gradient of every process's loss into
+            #the local part, DDP then averages over processes, which gives the gradient of the global-batch loss
+            features = all_gather_with_grad(features.contiguous())
+            targets = all_gather_no_grad(targets.to(features.device))
 
         if self.use_labels_for_loss:
             loss = self.criterion(features, labels=targets)
         else:
             loss = self.criterion(features)
+        return loss
+
+    def prepare_batch(self, batch, device):
+        views, targets = self.make_views(batch, device)
+        views = [self.resize_input(view) for view in views]
+        return PreparedBatch((views, targets))
+
+    def training_step(self, batch, device, verbose = False):
+        if not isinstance(batch, PreparedBatch):
+            batch = self.prepare_batch(batch, device)
+        views, targets = batch
 
+        features = self.embed(views)
+        loss = self.contrastive_loss(views, features, targets, device)
 
         if verbose:
             print(f"Loss: {loss.item()}")
-            print(f"features shape: {features.shape}")
+            print(f"features shape: {features.shape}, views: {[tuple(v.shape) for v in views]}")
+            if self.queue is not None:
+                print(f"queue length: {len(self.queue)}")
+
+        return loss
 
+    def grad_cache_step(self, batch, device):
+        if not isinstance(batch, PreparedBatch):
+            batch = self.prepare_batch(batch, device)
+        views, targets = batch
+        chunks = [chunk for view_group in views for chunk in torch.split(view_group, self.grad_cache_chunk_size, dim=0)]
+
+        #1. embeddings of all views without keeping the graph
+        with self.timer.phase('forward'), torch.no_grad(), self.autocast():
+            features = torch.cat([self.model(chunk) for chunk in chunks], dim=0)
+
+        #2. full-batch loss and its gradient w.r.t. the embeddings only (scaled if a GradScaler is used)
+        with self.timer.phase('loss'):
+            features = features.detach().requires_grad_()
+            with self.autocast():
+                loss = self.contrastive_loss(views, features, targets, device)
+            self.backward(loss)
+            feature_grads = torch.split(features.grad, [chunk.shape[0] for chunk in chunks], dim=0)
+
+        #3. re-run each chunk with the graph and backpropagate the cached gradient into the parameters.
+        #SupConNetwork has no dropout/batchnorm, so the second forward reproduces the cached embeddings
+        with self.timer.phase('backward'):
+            for i, (chunk, feature_grad) in enumerate(zip(chunks, feature_grads)):
+                #with DDP, gradients are all-reduced only once, after the last chunk
+                sync = nullcontext() if (not self.distributed or i == len(chunks) - 1) else self.model.no_sync()
+                with sync:
+                    with self.autocast():
+                        chunk_features = self.model(chunk)
+                    chunk_features.backward(feature_grad.to(chunk_features.dtype))
+
+        return loss.detach()
+
+    def optimization_step(self, batch, device):
+        if not self.grad_cache_chunk_size:
+            return super().optimization_step(batch, device)
+        self.optimizer.zero_grad()
+        loss = self.grad_cache_step(batch, device)
+        with self.timer.phase('optimizer'):
+            self.optimizer_step()
         return loss
 
+    def on_load(self):
+        if self.momentum_model is not None:
+            #restart the momentum network from the loaded weights, queued keys belong to the old network
+            self.momentum_model.load_state_dict(self.eager_model.state_dict())
+            self.queue.reset()
+
     def show_transforms(self, dataloader, device):
         self.model.eval()
         with torch.no_grad():
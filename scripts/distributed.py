@@ -0,0 +1,95 @@
+import torch
+import os
+import socket
+
+import torch.distributed as dist
+import torch.multiprocessing as mp
+from torch.utils.data import DataLoader
+from torch.utils.data.distributed import DistributedSampler
+
+
+#CPU data-parallel training: N processes (gloo backend) each take 1/N of every epoch via DistributedSampler,
+#gradients are averaged by DistributedDataParallel (BaseModel.distribute), only rank 0 writes checkpoints.
+
+
+def is_distributed():
+    return dist.is_available() and dist.is_initialized()
+
+
+def get_rank():
+    return dist.get_rank() if is_distributed() else 0
+
+
+def get_world_size():
+    return dist.get_world_size() if is_distributed() else 1
+
+
+def is_main_process():
+    return get_rank() == 0
+
+
+def barrier():
+    if is_distributed():
+        dist.barrier()
+
+
+def all_reduce_mean(value):
+    #mean of a python float over all processes
+    if not is_distributed():
+        return value
+    tensor = torch.tensor([value], dtype=torch.float64)
+    dist.all_reduce(tensor, op=dist.ReduceOp.SUM)
+    return tensor.item() / get_world_size()
+
+
+def all_gather_with_grad(tensor):
+    #concatenation over processes along dim 0; gradients flow back to the local part
+    if not is_distributed():
+        return tensor
+    import torch.distributed.nn.functional as dist_fn
+    return torch.cat(dist_fn.all_gather(tensor), dim=0)
+
+
+@torch.no_grad()
+def all_gather_no_grad(tensor):
+    if not is_distributed():
+        return tensor
+    gathered = [torch.empty_like(tensor) for _ in range(get_world_size())]
+    dist.all_gather(gathered, tensor.contiguous())
+    return torch.cat(gathered, dim=0)
+
+
+def distributed_loader(dataset, batch_size, shuffle=True, seed=0, **loader_kwargs):
+    #DataLoader over this process's shard of the dataset, BaseModel.training_loop calls sampler.set_epoch
+    sampler = DistributedSampler(dataset, num_replicas=get_world_size(), rank=get_rank(), shuffle=shuffle, seed=seed)
+    return DataLoader(dataset, batch_size=batch_size, sampler=sampler, **loader_kwargs)
+
+
+def _free_port():
+    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
+        s.bind(('', 0))
+        return s.getsockname()[1]
+
+
+def _worker(rank, world_size, train_fn, args, threads_per_process, port):
+    os.environ['MASTER_ADDR'] = os.environ.get('MASTER_ADDR', '127.0.0.1')
+    os.environ['MASTER_PORT'] = str(port)
+    torch.set_num_threads(threads_per_process)
+    dist.init_process_group('gloo', rank=rank, world_size=world_size)
+    try:
+        train_fn(rank, world_size, *args)
+    finally:
+        dist.destroy_process_group()
+
+
+def launch(train_fn, world_size, *args, threads_per_process=None):
+    """
+    Run train_fn(rank, world_size, *args) in world_size processes with a gloo process group.
+
+    train_fn should build the dataset, loaders (distributed_loader) and model, call model.distribute()
+    and then model.training_loop as usual. The cores of the node are split evenly between the processes.
+    """
+    if threads_per_process is None:
+        threads_per_process = max(1, (os.cpu_count() or world_size) // world_size)
+    port = int(os.environ.get('MASTER_PORT', _free_port()))
+    mp.spawn(_worker, args=(world_size, train_fn, args, threads_per_process, port), nprocs=world_size, join=True)
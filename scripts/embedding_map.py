@@ -0,0 +1,336 @@
+import pandas as pd
+import torch
+import numpy as np
+import matplotlib.pyplot as plt
+import scipy.sparse
+from scipy.optimize import curve_fit
+import time
+import os
+
+from self_supervised_halos.utils.utils import res_path
+from self_supervised_halos.scripts.embeddings import EmbeddingStore
+from self_supervised_halos.scripts.similarity_index import SimilarityIndex
+embedding_maps_path = res_path + 'embedding_maps/'
+
+
+#2d maps of the whole halo catalog in embedding space, instead of t-SNE on a few hundred points. UMAP-style layout:
+#kNN graph from SimilarityIndex (exact blocked search, or IVF-PQ for large catalogs), fuzzy neighbour weights,
+#then SGD where every epoch samples the edges by weight and applies all attractive and negative-sample repulsive
+#updates at once (index_add_ over the edge list, ~N*k*epochs work instead of N^2).
+#New halos are placed into an existing map at the weighted mean of their neighbours and refined with the old
+#points fixed. Maps are drawn as rasterized density (or per-pixel mean of a catalog column) images.
+
+
+def find_ab_params(spread=1.0, min_dist=0.1):
+    #a, b of the low-dimensional similarity 1 / (1 + a d^2b), fitted to the min_dist/spread target curve as in UMAP
+    x = np.linspace(0, 3 * spread, 300)
+    y = np.where(x < min_dist, 1.0, np.exp(-(x - min_dist) / spread))
+    (a, b), _ = curve_fit(lambda x, a, b: 1.0 / (1.0 + a * x ** (2 * b)), x, y)
+    return float(a), float(b)
+
+
+def knn_graph(index, queries=None, k=15, chunk_size=1024, exact=None, nprobe=8):
+    """
+    k nearest neighbours of every row of a SimilarityIndex (or of new query embeddings).
+
+    Parameters:
+    index (SimilarityIndex): Index over the embeddings; approximate search if its IVF-PQ index is trained.
+    queries (array): (Q, D) new embeddings; None for the rows of the index themselves (self excluded).
+    k (int): Number of neighbours.
+    chunk_size (int): Queries per search call.
+
+    Returns:
+    tuple: (rows (Q, k) int64, distances (Q, k) float32), cosine distance 1 - cos or euclidean distance.
+    """
+    n_queries = len(index) if queries is None else len(queries)
+    id_index = pd.Index(index.halo_ids)
+    all_rows, all_dist = [], []
+    for start in range(0, n_queries, chunk_size):
+        if queries is None:
+            rows = np.arange(start, min(start + chunk_size, n_queries))
+            scores, ids = index.search(index.vectors[rows], k=k, exclude=rows, exact=exact, nprobe=nprobe)
+        else:
+            scores, ids = index.search(queries[start:start + chunk_size], k=k, exact=exact, nprobe=nprobe)
+        all_rows.append(id_index.get_indexer(ids.ravel()).reshape(ids.shape))
+        all_dist.append(1 - scores if index.metric == 'cosine' else np.sqrt(np.clip(-scores, 0, None)))
+    rows, dist = np.concatenate(all_rows), np.concatenate(all_dist).astype(np.float32)
+    dist[rows < 0] = np.inf
+    return rows, dist
+
+
+def fuzzy_weights(dist, n_iter=64):
+    #membership strengths exp(-(d - rho) / sigma): rho is the distance to the nearest neighbour, sigma is found by
+    #bisection so that the weights of every point sum to log2(k)
+    dist = torch.as_tensor(dist, dtype=torch.float64)
+    finite = torch.isfinite(dist)
+    positive = torch.where(finite & (dist > 0), dist, torch.full_like(dist, float('inf')))
+    rho = positive.min(dim=1).values
+    rho = torch.where(torch.isfinite(rho), rho, torch.zeros_like(rho))
+    shifted = torch.where(finite, (dist - rho[:, None]).clamp(min=0), torch.full_like(dist, float('inf')))
+    target = np.log2(dist.shape[1])
+    lo, hi, sigma = torch.zeros_like(rho), torch.full_like(rho, float('inf')), torch.ones_like(rho)
+    for _ in range(n_iter):
+        total = torch.exp(-shifted / sigma[:, None]).sum(dim=1)
+        too_large = total > target
+        hi = torch.where(too_large, sigma, hi)
+        lo = torch.where(too_large, lo, sigma)
+        sigma = torch.where(torch.isinf(hi), sigma * 2, (lo + hi) / 2)
+    mean_dist = dist[finite].mean() if finite.any() else torch.tensor(1.0, dtype=dist.dtype)
+    sigma = sigma.clamp(min=1e-3 * mean_dist.item())
+    return torch.exp(-shifted / sigma[:, None]).float()
+
+
+def fuzzy_graph(rows, weights):
+    #symmetrized weighted kNN graph (fuzzy union w + w^T - w * w^T) as an edge list (head, tail, weight)
+    n, k = rows.shape
+    valid = rows >= 0
+    heads = np.repeat(np.arange(n), k)[valid.ravel()]
+    w = scipy.sparse.coo_matrix((np.asarray(weights).ravel()[valid.ravel()], (heads, rows[valid])), shape=(n, n)).tocsr()
+    w = (w + w.T - w.multiply(w.T)).tocoo()
+    keep = w.data > 0
+    return torch.from_numpy(w.row[keep]).long(), torch.from_numpy(w.col[keep]).long(), torch.from_numpy(w.data[keep]).float()
+
+
+def _attraction(diff, a, b):
+    d2 = (diff * diff).sum(dim=1)
+    coef = -2 * a * b * d2.clamp(min=1e-12).pow(b - 1) / (1 + a * d2.pow(b))
+    return (coef.where(d2 > 0, torch.zeros_like(coef))[:, None] * diff).clamp(-4, 4)
+
+
+def _repulsion(diff, a, b):
+    d2 = (diff * diff).sum(dim=1)
+    coef = 2 * b / ((1e-3 + d2) * (1 + a * d2.pow(b)))
+    return (coef.where(d2 > 0, torch.zeros_like(coef))[:, None] * diff).clamp(-4, 4)
+
+
+def optimize_layout(layout, heads, tails, weights, a, b, n_epochs=200, learning_rate=1.0, negative_sample_rate=5,
+                    movable=None, n_reference=None, seed=0):
+    """
+    UMAP-style SGD on a layout, all sampled edges of an epoch are applied at once.
+
+    Parameters:
+    layout (torch.Tensor): (N, 2) initial positions, updated in place.
+    heads, tails, weights (torch.Tensor): Edge list; each epoch an edge is used with probability weight / max weight.
+    a, b (float): Parameters of the low-dimensional similarity (find_ab_params).
+    movable (torch.Tensor): Boolean (N,) mask of the points that move, all by default. Heads must be movable;
+        tails that are not pull their heads without moving themselves.
+    n_reference (int): Negative samples are drawn from the first n_reference points (the existing map), all by default.
+
+    Returns:
+    torch.Tensor: The layout.
+    """
+    generator = torch.Generator(device=layout.device).manual_seed(seed)
+    probability = weights / weights.max()
+    n_reference = n_reference or len(layout)
+    tail_moves = None if movable is None else movable[tails]
+    for epoch in range(n_epochs):
+        alpha = learning_rate * (1 - epoch / n_epochs)
+        sampled = torch.rand(len(heads), generator=generator, device=layout.device) < probability
+        i, j = heads[sampled], tails[sampled]
+        grad = _attraction(layout[i] - layout[j], a, b)
+        layout.index_add_(0, i, alpha * grad)
+        if tail_moves is None:
+            layout.index_add_(0, j, -alpha * grad)
+        else:
+            moves = tail_moves[sampled]
+            layout.index_add_(0, j[moves], -alpha * grad[moves])
+
+        i_neg = i.repeat_interleave(negative_sample_rate)
+        k_neg = torch.randint(0, n_reference, (len(i_neg),), generator=generator, device=layout.device)
+        layout.index_add_(0, i_neg, alpha * _repulsion(layout[i_neg] - layout[k_neg], a, b))
+    return layout
+
+
+def pca_init(vectors, scale=10.0):
+    #first two principal components scaled to [-scale, scale], deterministic start of the layout
+    centered = vectors - vectors.mean(dim=0)
+    _, _, v = torch.linalg.svd(centered[:min(len(centered), 100000)], full_matrices=False)
+    layout = centered @ v[:2].T
+    return scale * layout / layout.abs().max().clamp(min=1e-12)
+
+
+class EmbeddingMap:
+    """
+    Incremental 2d layout of halo embeddings.
+
+    Parameters:
+    n_neighbors (int): Size of the kNN graph.
+    min_dist (float), spread (float): Packing of the points in the map, as in UMAP.
+    n_epochs (int): Epochs of the fit; placing new points uses n_epochs // 4.
+    learning_rate (float): Initial SGD step, decays linearly.
+    negative_sample_rate (int): Repulsive samples per attractive edge.
+    metric (str): 'cosine' or 'l2'.
+    approximate (bool): Build the kNN graph with IVF-PQ; by default for more than 50000 halos.
+    seed (int): Seed of the edge and negative sampling.
+    """
+    def __init__(self, n_neighbors=15, min_dist=0.1, spread=1.0, n_epochs=200, learning_rate=1.0,
+                 negative_sample_rate=5, metric='cosine', approximate=None, seed=0):
+        self.n_neighbors = n_neighbors
+        self.min_dist = min_dist
+        self.spread = spread
+        self.n_epochs = n_epochs
+        self.learning_rate = learning_rate
+        self.negative_sample_rate = negative_sample_rate
+        self.metric = metric
+        self.approximate = approximate
+        self.seed = seed
+        self.a, self.b = find_ab_params(spread, min_dist)
+        self.index = None
+        self.layout = None
+
+    def __len__(self):
+        return 0 if self.layout is None else len(self.layout)
+
+    @property
+    def halo_ids(self):
+        return self.index.halo_ids
+
+    def _use_ivf(self, n):
+        return self.approximate if self.approximate is not None else n > 50000
+
+    def _build_index(self, vectors, halo_ids):
+        self.index = SimilarityIndex(vectors, halo_ids, metric=self.metric)
+        if self._use_ivf(len(halo_ids)):
+            self.index.train_ivf(seed=self.seed)
+
+    def fit(self, embeddings, halo_ids):
+        #embeddings: (N, D) array, halo_ids: (N,)
+        t0 = time.perf_counter()
+        self._build_index(embeddings, halo_ids)
+        rows, dist = knn_graph(self.index, k=self.n_neighbors)
+        heads, tails, weights = fuzzy_graph(rows, fuzzy_weights(dist))
+        t1 = time.perf_counter()
+        layout = pca_init(self.index.vectors)
+        self.layout = optimize_layout(layout, heads, tails, weights, self.a, self.b, n_epochs=self.n_epochs,
+                                      learning_rate=self.learning_rate, negative_sample_rate=self.negative_sample_rate,
+                                      seed=self.seed)
+        print(f"Embedding map of {len(self)} halos: kNN graph {t1 - t0:.1f} s, layout {time.perf_counter() - t1:.1f} s")
+        return self
+
+    @classmethod
+    def from_store(cls, store, **kwargs):
+        #store: EmbeddingStore or its name
+        store = EmbeddingStore(store) if isinstance(store, str) else store
+        return cls(**kwargs).fit(np.asarray(store.embeddings), store.halo_ids)
+
+    def transform(self, embeddings, n_epochs=None):
+        """
+        Positions of new embeddings in the existing map, which does not move.
+
+        Returns:
+        np.ndarray: (Q, 2) positions.
+        """
+        queries = self.index._prepare(torch.as_tensor(np.asarray(embeddings), dtype=torch.float32))
+        rows, dist = knn_graph(self.index, queries=queries, k=self.n_neighbors)
+        weights = fuzzy_weights(dist)
+        valid = torch.from_numpy(rows >= 0)
+        weights = weights * valid
+        rows_t = torch.from_numpy(rows).clamp(min=0)
+        #start at the weighted mean of the neighbours, then refine against the fixed map
+        init = (weights[..., None] * self.layout[rows_t]).sum(dim=1) / weights.sum(dim=1, keepdim=True).clamp(min=1e-12)
+        n_old, n_new = len(self.layout), len(queries)
+        layout = torch.cat([self.layout, init])
+        heads = (n_old + torch.arange(n_new)).repeat_interleave(self.n_neighbors)[valid.ravel()]
+        tails = rows_t.ravel()[valid.ravel()]
+        movable = torch.zeros(n_old + n_new, dtype=torch.bool)
+        movable[n_old:] = True
+        optimize_layout(layout, heads, tails, weights.ravel()[valid.ravel()], self.a, self.b,
+                        n_epochs=n_epochs or max(self.n_epochs // 4, 1), learning_rate=self.learning_rate,
+                        negative_sample_rate=self.negative_sample_rate, movable=movable, n_reference=n_old, seed=self.seed)
+        return layout[n_old:].numpy()
+
+    def add(self, embeddings, halo_ids, n_epochs=None):
+        #place new halos and keep them in the map (and in its kNN index) for later additions
+        positions = self.transform(embeddings, n_epochs=n_epochs)
+        #codes of the new halos go to the existing IVF lists; the quantizers are only trained once the map outgrows exact search
+        self.index.add(embeddings, halo_ids)
+        if self.index.ivf is None and self._use_ivf(len(self.index)):
+            self.index.train_ivf(seed=self.seed)
+        self.layout = torch.cat([self.layout, torch.from_numpy(positions)])
+        return positions
+
+    def to_dataframe(self, catalog=None):
+        #(halo_id, x, y), joined with the catalog columns if given
+        df = pd.DataFrame({'halo_id': self.halo_ids, 'x': self.layout[:, 0].numpy(), 'y': self.layout[:, 1].numpy()})
+        if catalog is not None:
+            df = df.join(catalog, on='halo_id')
+        return df
+
+    def save(self, name):
+        os.makedirs(embedding_maps_path, exist_ok=True)
+        state = {key: value for key, value in self.__dict__.items() if key not in ('index', 'layout')}
+        state.update({'halo_ids': self.index.halo_ids, 'vectors': self.index.vectors, 'ivf': self.index.ivf,
+                      'layout': self.layout})
+        filename = embedding_maps_path + name + '.pth'
+        torch.save(state, filename + '.tmp')
+        os.replace(filename + '.tmp', filename)
+
+    @classmethod
+    def load(cls, name):
+        state = torch.load(embedding_maps_path + name + '.pth', weights_only=False)
+        halo_ids, vectors, ivf, layout = (state.pop(key) for key in ('halo_ids', 'vectors', 'ivf', 'layout'))
+        embedding_map = cls.__new__(cls)
+        embedding_map.__dict__.update(state)
+        embedding_map.index = SimilarityIndex(vectors, halo_ids, metric=embedding_map.metric)
+        embedding_map.index.ivf = ivf
+        embedding_map.layout = layout
+        return embedding_map
+
+
+def rasterize(xy, values=None, bins=512, extent=None):
+    """
+    Bin points into an image.
+
+    Parameters:
+    xy (array): (N, 2) positions.
+    values (array): (N,) values to average per pixel; None for counts.
+    bins (int): Pixels per side.
+    extent (tuple): (xmin, xmax, ymin, ymax), by default the range of the points.
+
+    Returns:
+    tuple: (bins, bins) image (rows are y, NaN in empty pixels when averaging) and the extent.
+    """
+    xy = np.asarray(xy, dtype=np.float64)
+    if extent is None:
+        (xmin, ymin), (xmax, ymax) = xy.min(axis=0), xy.max(axis=0)
+        extent = (xmin, xmax, ymin, ymax)
+    xmin, xmax, ymin, ymax = extent
+    ix = np.clip(((xy[:, 0] - xmin) / max(xmax - xmin, 1e-12) * bins).astype(np.int64), 0, bins - 1)
+    iy = np.clip(((xy[:, 1] - ymin) / max(ymax - ymin, 1e-12) * bins).astype(np.int64), 0, bins - 1)
+    pixel = iy * bins + ix
+    counts = np.bincount(pixel, minlength=bins * bins).reshape(bins, bins).astype(np.float64)
+    if values is None:
+        return counts, extent
+    values = np.asarray(values, dtype=np.float64)
+    finite = np.isfinite(values)
+    sums = np.bincount(pixel[finite], weights=values[finite], minlength=bins * bins).reshape(bins, bins)
+    n = np.bincount(pixel[finite], minlength=bins * bins).reshape(bins, bins)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        return np.where(n > 0, sums / n, np.nan), extent
+
+
+def plot_embedding_map(xy, values=None, bins=512, ax=None, cmap=None, log=True, label=None, extent=None, title=None):
+    """
+    Density image of a map (log counts), or the per-pixel mean of `values` (e.g. logSubhaloMass) shaded by density.
+
+    Returns:
+    matplotlib.axes.Axes
+    """
+    if ax is None:
+        _, ax = plt.subplots(figsize=(8, 8))
+    counts, extent = rasterize(xy, bins=bins, extent=extent)
+    density = np.log10(counts + 1) if log else counts
+    if values is None:
+        image = ax.imshow(np.where(counts > 0, density, np.nan), origin='lower', extent=extent, cmap=cmap or 'afmhot',
+                          aspect='auto', interpolation='nearest')
+        plt.colorbar(image, ax=ax, label=label or ('log10(1 + halos per pixel)' if log else 'halos per pixel'))
+    else:
+        mean, _ = rasterize(xy, values=values, bins=bins, extent=extent)
+        image = ax.imshow(mean, origin='lower', extent=extent, cmap=cmap or 'viridis', aspect='auto',
+                          interpolation='nearest', alpha=np.clip(density / max(density.max(), 1e-12), 0.2, 1.0))
+        plt.colorbar(image, ax=ax, label=label)
+    ax.set_xlabel('map 1')
+    ax.set_ylabel('map 2')
+    if title:
+        ax.set_title(title)
+    return ax
@@ -0,0 +1,213 @@
+import pandas as pd
+import torch
+import numpy as np
+from tqdm import tqdm
+import hashlib
+import os
+
+import torch.nn as nn
+
+from self_supervised_halos.utils.utils import res_path
+embeddings_path = res_path + 'embeddings/'
+
+
+#Embeddings of every halo for a trained network, kept in a memory-mapped (N, D) matrix with one row per halo id.
+#Each row remembers the hash of the checkpoint and of the input it was computed from; re-running the extraction
+#after retraining or re-preprocessing only runs the network on the halos that are missing or stale.
+
+
+def supcon_encoder(model, x):
+    #SupConNetwork: encoder output, before the projection head
+    return model.encoder(x)
+
+
+def classification_penultimate(model, x):
+    #Classification_2d/3d: activations of the last hidden layer of the classifier head
+    return model.fc[:-1](model.cnn(x))
+
+
+def mass_hist_pooled(model, x):
+    #HaloMassHistTransformer: hidden states averaged over the valid (non-NaN) snapshots
+    mask = torch.isnan(x)
+    _, hidden_states = model(torch.nan_to_num(x, nan=-10.0), src_key_padding_mask=mask) # (seq_len, batch_size, embed_dim)
+    valid = (~mask).T.unsqueeze(-1).float()
+    return (hidden_states * valid).sum(dim=0) / valid.sum(dim=0).clamp(min=1)
+
+
+#network class -> (embedding function, index of the input in the HaloDataset tuple)
+embedding_layers = {
+    'SupConNetwork': (supcon_encoder, 0),
+    'Classification_2d': (classification_penultimate, 0),
+    'Classification_3d': (classification_penultimate, 1),
+    'HaloMassHistTransformer': (mass_hist_pooled, 2),
+}
+
+
+def checkpoint_hash(model, layer_fn=None):
+    #fingerprint of the weights (and of the extracted layer), 16 hex digits
+    h = hashlib.blake2b(digest_size=8)
+    if layer_fn is not None:
+        h.update(layer_fn.__name__.encode())
+    for key, value in sorted(model.state_dict().items()):
+        h.update(key.encode())
+        h.update(value.detach().cpu().contiguous().numpy().tobytes())
+    return h.hexdigest()
+
+
+def input_hashes(x):
+    #one int64 fingerprint per item of a batch
+    x = x.detach().cpu().contiguous().numpy()
+    return np.array([int.from_bytes(hashlib.blake2b(item.tobytes(), digest_size=8).digest(), 'little', signed=True)
+                     for item in x], dtype=np.int64)
+
+
+class EmbeddingStore:
+    """
+    Memory-mapped embeddings at results/embeddings/<name>/: embeddings.npy of shape (capacity, D) and index.npz with
+    the halo id, input hash and checkpoint hash of each row. Rows are appended, the matrix grows by doubling.
+    """
+    def __init__(self, name):
+        self.name = name
+        self.directory = embeddings_path + name + '/'
+        self.embeddings_file = self.directory + 'embeddings.npy'
+        self.index_file = self.directory + 'index.npz'
+        self._embeddings = None
+        self.halo_ids = np.zeros(0, dtype=np.int64)
+        self.input_hashes = np.zeros(0, dtype=np.int64)
+        self.checkpoint_hashes = np.zeros(0, dtype='U16')
+        if os.path.exists(self.index_file):
+            index = np.load(self.index_file)
+            self.halo_ids = index['halo_id']
+            self.input_hashes = index['input_hash']
+            self.checkpoint_hashes = index['checkpoint_hash']
+            self._embeddings = np.load(self.embeddings_file, mmap_mode='r+')
+        self.rows = {halo_id: row for row, halo_id in enumerate(self.halo_ids.tolist())}
+
+    def __len__(self):
+        return len(self.halo_ids)
+
+    @property
+    def dim(self):
+        return None if self._embeddings is None else self._embeddings.shape[1]
+
+    @property
+    def embeddings(self):
+        #(N, D) memmap view, row i belongs to halo_ids[i]
+        if self._embeddings is None:
+            return np.zeros((0, 0), dtype=np.float32)
+        return self._embeddings[:len(self)]
+
+    def get(self, halo_ids):
+        rows = [self.rows[int(halo_id)] for halo_id in halo_ids]
+        return np.asarray(self._embeddings[rows])
+
+    def stale(self, halo_ids, hashes, ckpt_hash):
+        #True for halos that are missing or were computed from another input or checkpoint
+        result = np.ones(len(halo_ids), dtype=bool)
+        for i, (halo_id, input_hash) in enumerate(zip(halo_ids, hashes)):
+            row = self.rows.get(int(halo_id))
+            if row is not None:
+                result[i] = self.input_hashes[row] != input_hash or self.checkpoint_hashes[row] != ckpt_hash
+        return result
+
+    def write(self, halo_ids, embeddings, hashes, ckpt_hash):
+        if self.dim is not None and embeddings.shape[1] != self.dim:
+            raise ValueError(f"Store {self.name} holds {self.dim}-dim embeddings, got {embeddings.shape[1]}; use another name")
+        new_ids = [int(halo_id) for halo_id in halo_ids if int(halo_id) not in self.rows]
+        if new_ids:
+            self._grow(len(self) + len(new_ids), embeddings.shape[1])
+            start = len(self)
+            for i, halo_id in enumerate(new_ids):
+                self.rows[halo_id] = start + i
+            self.halo_ids = np.concatenate([self.halo_ids, np.array(new_ids, dtype=np.int64)])
+            self.input_hashes = np.concatenate([self.input_hashes, np.zeros(len(new_ids), dtype=np.int64)])
+            self.checkpoint_hashes = np.concatenate([self.checkpoint_hashes, np.full(len(new_ids), '', dtype='U16')])
+        rows = np.array([self.rows[int(halo_id)] for halo_id in halo_ids])
+        self._embeddings[rows] = embeddings
+        self.input_hashes[rows] = hashes
+        self.checkpoint_hashes[rows] = ckpt_hash
+
+    def _grow(self, n_rows, dim):
+        capacity = 0 if self._embeddings is None else self._embeddings.shape[0]
+        if n_rows <= capacity:
+            return
+        os.makedirs(self.directory, exist_ok=True)
+        new_capacity = max(n_rows, 2 * capacity, 1024)
+        tmp_file = self.embeddings_file + '.tmp.npy'
+        grown = np.lib.format.open_memmap(tmp_file, mode='w+', dtype=np.float32, shape=(new_capacity, dim))
+        if capacity:
+            grown[:len(self)] = self._embeddings[:len(self)]
+        grown.flush()
+        del grown
+        self._embeddings = None
+        os.replace(tmp_file, self.embeddings_file)
+        self._embeddings = np.load(self.embeddings_file, mmap_mode='r+')
+
+    def flush(self):
+        #embeddings first, then the index that declares them valid
+        if self._embeddings is None:
+            return
+        self._embeddings.flush()
+        tmp_file = self.index_file + '.tmp'
+        with open(tmp_file, 'wb') as f:
+            np.savez(f, halo_id=self.halo_ids, input_hash=self.input_hashes, checkpoint_hash=self.checkpoint_hashes)
+        os.replace(tmp_file, self.index_file)
+
+    def to_dataframe(self):
+        return pd.DataFrame(np.asarray(self.embeddings), index=pd.Index(self.halo_ids, name='halo_id'))
+
+
+def extract_embeddings(model, dataloader, name, layer_fn=None, input_index=None, device='cpu', flush_every=50):
+    """
+    Embed every halo of the dataloader into the EmbeddingStore `name`, skipping halos whose stored row is up to date.
+
+    Parameters:
+    model (nn.Module or BaseModel): Trained network; its class selects the layer from embedding_layers unless layer_fn is given.
+    dataloader (DataLoader): Loader over a HaloDataset (or a Subset). Inputs must be deterministic for the hashes to match:
+        use choose_all_2d=True for 2d networks, the three projections are embedded and averaged.
+    name (str): Store name, results/embeddings/<name>/.
+    layer_fn (callable): f(model, x) -> (batch, D) embeddings.
+    input_index (int): Which input of the HaloDataset tuple to embed (0 - 2d, 1 - 3d, 2 - mass history).
+    device (str): Device for the forward pass.
+    flush_every (int): Number of batches between index writes, an interrupted run keeps what was flushed.
+
+    Returns:
+    EmbeddingStore: The updated store.
+    """
+    network = getattr(model, 'eager_model', model)
+    if layer_fn is None or input_index is None:
+        default_fn, default_index = embedding_layers[network.__class__.__name__]
+        layer_fn = layer_fn or default_fn
+        input_index = default_index if input_index is None else input_index
+
+    network = network.to(device)
+    network.eval()
+    ckpt_hash = checkpoint_hash(network, layer_fn)
+    store = EmbeddingStore(name)
+
+    n_computed, n_total = 0, 0
+    with torch.inference_mode():
+        for i, batch in enumerate(tqdm(dataloader, desc=f"Embeddings {name}")):
+            inputs, targets = batch
+            x = torch.as_tensor(inputs[input_index]).float()
+            halo_ids = np.asarray(targets[2])
+            hashes = input_hashes(x)
+            todo = store.stale(halo_ids, hashes, ckpt_hash)
+            n_total += len(halo_ids)
+            if not todo.any():
+                continue
+            x = x[torch.from_numpy(todo)].to(device)
+            if x.dim() == 5 and input_index == 0:
+                #all projections (choose_all_2d): embed each and average
+                n_halos, n_projections = x.shape[:2]
+                embeddings = layer_fn(network, x.flatten(0, 1)).view(n_halos, n_projections, -1).mean(dim=1)
+            else:
+                embeddings = layer_fn(network, x)
+            store.write(halo_ids[todo], embeddings.float().cpu().numpy(), hashes[todo], ckpt_hash)
+            n_computed += int(todo.sum())
+            if (i + 1) % flush_every == 0:
+                store.flush()
+
+    store.flush()
+    print(f"Embeddings {name}: {n_computed} of {n_total} halos computed, {n_total - n_computed} up to date")
+    return store
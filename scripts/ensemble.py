@@ -0,0 +1,165 @@
+import pandas as pd
+import torch
+import numpy as np
+from tqdm import tqdm
+import copy
+
+from torch.func import stack_module_state, functional_call, vmap
+
+from self_supervised_halos.scripts.prefetch import move_to_device
+
+
+#Classification_2d/3d have a few tens of thousands of parameters, so a single model uses the hardware poorly.
+#EnsembleTrainer stacks the parameters of K copies and runs them with torch.func.vmap: every batch is loaded and
+#augmented once and goes through all K members in one vectorized forward/backward.
+
+
+class StackedAdam:
+    """Adam over stacked (K, ...) parameters with a separate lr and weight decay for each of the K members"""
+    def __init__(self, params, lrs, weight_decays, betas=(0.9, 0.999), eps=1e-8):
+        self.params = list(params)
+        self.lrs = lrs
+        self.weight_decays = weight_decays
+        self.betas = betas
+        self.eps = eps
+        self.step_count = 0
+        self.exp_avg = [torch.zeros_like(p) for p in self.params]
+        self.exp_avg_sq = [torch.zeros_like(p) for p in self.params]
+
+    def zero_grad(self):
+        for p in self.params:
+            p.grad = None
+
+    def _per_member(self, values, p):
+        return values.to(p.device).view(-1, *([1] * (p.dim() - 1)))
+
+    @torch.no_grad()
+    def step(self):
+        self.step_count += 1
+        beta1, beta2 = self.betas
+        bias_correction1 = 1 - beta1 ** self.step_count
+        bias_correction2 = 1 - beta2 ** self.step_count
+        for p, exp_avg, exp_avg_sq in zip(self.params, self.exp_avg, self.exp_avg_sq):
+            if p.grad is None:
+                continue
+            grad = p.grad + self._per_member(self.weight_decays, p) * p #L2 penalty as in torch.optim.Adam
+            exp_avg.mul_(beta1).add_(grad, alpha=1 - beta1)
+            exp_avg_sq.mul_(beta2).addcmul_(grad, grad, value=1 - beta2)
+            denom = (exp_avg_sq / bias_correction2).sqrt_().add_(self.eps)
+            p.sub_(self._per_member(self.lrs, p) / bias_correction1 * exp_avg / denom)
+
+
+class EnsembleTrainer:
+    """
+    Train K copies of a model at once on the same batches, each with its own seed (initialization), lr and weight decay.
+
+    model_class: e.g. Classification_2d; input_index: 0 - 2d maps, 1 - 3d cubes (HaloDataset order).
+    lrs, weight_decays, seeds: lists of length n_members (a scalar is used for every member).
+    """
+    def __init__(self, model_class, n_members,
+                 lrs=1e-3, weight_decays=0.0, seeds=None,
+                 criterion=None, transform=None, input_index=0,
+                 device='cpu', model_kwargs={}):
+        self.model_class = model_class
+        self.n_members = n_members
+        self.lrs = torch.as_tensor(np.broadcast_to(lrs, n_members), dtype=torch.float32)
+        self.weight_decays = torch.as_tensor(np.broadcast_to(weight_decays, n_members), dtype=torch.float32)
+        self.seeds = list(seeds) if seeds is not None else list(range(n_members))
+        if len(self.seeds) != n_members:
+            raise ValueError(f"{len(self.seeds)} seeds given for {n_members} ensemble members")
+        self.criterion = criterion
+        self.transform = transform
+        self.input_index = input_index
+        self.device = device
+        self.model_kwargs = model_kwargs
+
+        members = []
+        for seed in self.seeds:
+            torch.manual_seed(seed)
+            members.append(model_class(**model_kwargs).to(device))
+        self.params, self.buffers = stack_module_state(members)
+        self.base_model = copy.deepcopy(members[0]).to('meta')
+
+        self.optimizer = StackedAdam(self.params.values(), self.lrs, self.weight_decays)
+        self.history = {'train_loss': [], 'val_loss': [], 'val_accuracy': []} #each entry: list of n_members values
+
+    def _forward_one(self, params, buffers, x):
+        return functional_call(self.base_model, (params, buffers), (x,))
+
+    def forward(self, x):
+        #(batch, ...) -> (n_members, batch, n_classes), same input for every member
+        return vmap(self._forward_one, in_dims=(0, 0, None), randomness='different')(self.params, self.buffers, x)
+
+    def __call__(self, x):
+        return self.forward(x)
+
+    def prepare_batch(self, batch, device, augment=True):
+        inputs, targets = move_to_device(batch, device)
+        x = inputs[self.input_index].float()
+        if augment and self.transform:
+            x = self.transform(x)
+        return x, targets[1]
+
+    def member_losses(self, outputs, targets):
+        return torch.stack([self.criterion(outputs[k], targets) for k in range(self.n_members)])
+
+    def training_loop(self, train_loader, val_loader, num_epochs, device=None):
+        device = device or self.device
+        for param in self.params.values():
+            param.requires_grad_(True)
+
+        for epoch in tqdm(range(num_epochs), desc="Epochs"):
+            train_loss = torch.zeros(self.n_members)
+            for batch in train_loader:
+                x, targets = self.prepare_batch(batch, device)
+                losses = self.member_losses(self.forward(x), targets)
+                self.optimizer.zero_grad()
+                #members are independent, the gradient of the sum is the gradient of each member's loss
+                losses.sum().backward()
+                self.optimizer.step()
+                train_loss += losses.detach().cpu()
+            train_loss = (train_loss / len(train_loader)).tolist()
+            self.history['train_loss'].append(train_loss)
+            print(f"Epoch {epoch + 1}, Training Loss: best {min(train_loss):.4f}, worst {max(train_loss):.4f}")
+
+            if val_loader:
+                val_loss, val_accuracy = self.evaluate(val_loader, device)
+                self.history['val_loss'].append(val_loss)
+                self.history['val_accuracy'].append(val_accuracy)
+                print(f"Epoch {epoch + 1}, Validation Loss: best {min(val_loss):.4f}, Accuracy: best {max(val_accuracy):.3f}")
+
+    def evaluate(self, dataloader, device=None, augment=True):
+        #augment=True keeps the behaviour of BaseModel validation, which applies the transform as well
+        device = device or self.device
+        total_loss = torch.zeros(self.n_members)
+        correct = torch.zeros(self.n_members)
+        n_samples = 0
+        with torch.no_grad():
+            for batch in dataloader:
+                x, targets = self.prepare_batch(batch, device, augment=augment)
+                outputs = self.forward(x)
+                total_loss += self.member_losses(outputs, targets).cpu()
+                correct += (outputs.argmax(dim=-1) == targets.unsqueeze(0)).sum(dim=1).cpu()
+                n_samples += targets.shape[0]
+        return (total_loss / len(dataloader)).tolist(), (correct / n_samples).tolist()
+
+    def history_dataframe(self):
+        #long format: one row per (epoch, member)
+        rows = []
+        for epoch, train_loss in enumerate(self.history['train_loss']):
+            for k in range(self.n_members):
+                row = {'epoch': epoch + 1, 'member': k, 'seed': self.seeds[k],
+                       'lr': self.lrs[k].item(), 'weight_decay': self.weight_decays[k].item(),
+                       'train_loss': train_loss[k]}
+                if epoch < len(self.history['val_loss']):
+                    row['val_loss'] = self.history['val_loss'][epoch][k]
+                    row['val_accuracy'] = self.history['val_accuracy'][epoch][k]
+                rows.append(row)
+        return pd.DataFrame(rows)
+
+    def member_model(self, k):
+        #standalone nn.Module with the weights of member k, e.g. for ClassificationModel.model.load_state_dict
+        model = self.model_class(**self.model_kwargs)
+        state = {name: value[k].detach().clone() for name, value in {**self.params, **self.buffers}.items()}
+        model.load_state_dict(state)
+        return model
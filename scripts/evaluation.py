@@ -0,0 +1,368 @@
+import pandas as pd
+import torch
+import numpy as np
+from tqdm import tqdm
+import matplotlib.pyplot as plt
+from glob import glob
+import os
+import queue
+
+import torch.nn.functional as F
+import torch.distributed as dist
+import torch.multiprocessing as mp
+
+from self_supervised_halos.scripts.distributed import is_distributed
+from self_supervised_halos.scripts.base_model import models_path
+
+
+#Classification metrics accumulated batch by batch in fixed memory: nothing but counters is kept unless the per-halo
+#predictions table is requested. Evaluators of different shards (processes, nodes, checkpoints of the test set split
+#in parts) can be merged, the merged metrics are the same as for one pass over the whole set.
+
+default_mass_bins = np.linspace(11, 14.7, 11) #same as HaloDataset.mass_bins
+
+
+class ClassificationEvaluator:
+    """
+    Streaming confusion matrix, top-k accuracy, accuracy per log-mass bin and calibration (reliability) bins.
+
+    n_classes: number of classes; mass_bins: edges of the log-mass bins for the per-mass-bin accuracy;
+    topk: the k of the top-k accuracies; n_calibration_bins: confidence bins; keep_predictions: also keep the
+    per-halo table (id, mass, true class, predicted class, confidence).
+    """
+    def __init__(self, n_classes=10, mass_bins=default_mass_bins, topk=(1, 3), n_calibration_bins=15, keep_predictions=False):
+        self.n_classes = n_classes
+        self.mass_bins = np.asarray(mass_bins, dtype=np.float64)
+        self.topk = tuple(topk)
+        self.n_calibration_bins = n_calibration_bins
+        self.keep_predictions = keep_predictions
+        self.reset()
+
+    def reset(self):
+        n_mass_bins = len(self.mass_bins) + 1 #plus under/overflow, merged into the edge bins in results
+        self.counts = {
+            'confusion': torch.zeros(self.n_classes, self.n_classes, dtype=torch.float64),
+            'topk_correct': torch.zeros(len(self.topk), dtype=torch.float64),
+            'mass_total': torch.zeros(n_mass_bins, dtype=torch.float64),
+            'mass_correct': torch.zeros(n_mass_bins, dtype=torch.float64),
+            'calib_total': torch.zeros(self.n_calibration_bins, dtype=torch.float64),
+            'calib_correct': torch.zeros(self.n_calibration_bins, dtype=torch.float64),
+            'calib_confidence': torch.zeros(self.n_calibration_bins, dtype=torch.float64),
+            'nll': torch.zeros(1, dtype=torch.float64),
+        }
+        self.predictions = []
+
+    @property
+    def n_samples(self):
+        return int(self.counts['confusion'].sum().item())
+
+    @torch.no_grad()
+    def update(self, logits, labels, masses=None, halo_ids=None):
+        logits = logits.detach().float().cpu()
+        labels = torch.as_tensor(labels).long().cpu()
+        counts = self.counts
+        n = self.n_classes
+
+        pred = logits.argmax(dim=1)
+        counts['confusion'] += torch.bincount(labels * n + pred, minlength=n * n).view(n, n).double()
+
+        max_k = min(max(self.topk), n)
+        top = logits.topk(max_k, dim=1).indices == labels[:, None]
+        for i, k in enumerate(self.topk):
+            counts['topk_correct'][i] += top[:, :k].any(dim=1).sum()
+
+        correct = (pred == labels).double()
+        if masses is not None:
+            masses = torch.as_tensor(masses).double().cpu()
+            mass_bin = torch.bucketize(masses, torch.from_numpy(self.mass_bins), right=True) #as np.digitize in HaloDataset
+            counts['mass_total'] += torch.bincount(mass_bin, minlength=len(self.mass_bins) + 1).double()
+            counts['mass_correct'] += torch.bincount(mass_bin, weights=correct, minlength=len(self.mass_bins) + 1)
+
+        log_probs = F.log_softmax(logits, dim=1)
+        confidence = log_probs.max(dim=1).values.exp().double()
+        calib_bin = (confidence * self.n_calibration_bins).long().clamp(max=self.n_calibration_bins - 1)
+        counts['calib_total'] += torch.bincount(calib_bin, minlength=self.n_calibration_bins).double()
+        counts['calib_correct'] += torch.bincount(calib_bin, weights=correct, minlength=self.n_calibration_bins)
+        counts['calib_confidence'] += torch.bincount(calib_bin, weights=confidence, minlength=self.n_calibration_bins)
+        counts['nll'] -= log_probs.gather(1, labels[:, None]).sum().double()
+
+        if self.keep_predictions:
+            self.predictions.append(pd.DataFrame({
+                'id': np.asarray(halo_ids) if halo_ids is not None else np.full(len(labels), -1),
+                'mass': masses.numpy() if masses is not None else np.nan,
+                'true_class': labels.numpy(),
+                'pred_class': pred.numpy(),
+                'confidence': confidence.numpy(),
+            }))
+
+    def merge(self, other):
+        #add the counts (and predictions) of another shard
+        for key, value in other.counts.items():
+            self.counts[key] += value
+        self.predictions.extend(other.predictions)
+        return self
+
+    def state_dict(self):
+        return {'counts': {key: value.clone() for key, value in self.counts.items()},
+                'predictions': pd.concat(self.predictions) if self.predictions else None}
+
+    def load_state_dict(self, state):
+        #e.g. merge shards written by separate jobs: ev.merge(ClassificationEvaluator().load_state_dict(torch.load(f)))
+        self.counts = {key: value.clone() for key, value in state['counts'].items()}
+        self.predictions = [state['predictions']] if state['predictions'] is not None else []
+        return self
+
+    def all_reduce(self):
+        #merge the shards of all processes of a process group (each evaluated its part of the data)
+        if not is_distributed():
+            return self
+        for value in self.counts.values():
+            dist.all_reduce(value, op=dist.ReduceOp.SUM)
+        if self.keep_predictions:
+            gathered = [None] * dist.get_world_size()
+            dist.all_gather_object(gathered, self.state_dict()['predictions'])
+            self.predictions = [df for df in gathered if df is not None]
+        return self
+
+    def results(self):
+        counts = self.counts
+        n_samples = max(self.n_samples, 1)
+        confusion = counts['confusion'].numpy()
+        results = {
+            'n_samples': self.n_samples,
+            'accuracy': float(np.trace(confusion) / n_samples),
+            'nll': counts['nll'].item() / n_samples,
+            'confusion_matrix': confusion.astype(np.int64),
+        }
+        for k, correct in zip(self.topk, counts['topk_correct'].tolist()):
+            results[f'top{k}_accuracy'] = correct / n_samples
+        recall = np.diag(confusion) / np.maximum(confusion.sum(axis=1), 1)
+        results['balanced_accuracy'] = float(recall[confusion.sum(axis=1) > 0].mean()) if confusion.sum() else 0.0
+
+        calib_total = counts['calib_total'].numpy()
+        calibration = pd.DataFrame({
+            'confidence_low': np.arange(self.n_calibration_bins) / self.n_calibration_bins,
+            'n': calib_total.astype(np.int64),
+            'accuracy': counts['calib_correct'].numpy() / np.maximum(calib_total, 1),
+            'mean_confidence': counts['calib_confidence'].numpy() / np.maximum(calib_total, 1),
+        })
+        results['calibration'] = calibration
+        results['ece'] = float((calib_total * np.abs(calibration['accuracy'] - calibration['mean_confidence'])).sum() / n_samples)
+
+        #under/overflow counted with the first/last bin
+        mass_total = counts['mass_total'].numpy().copy()
+        mass_correct = counts['mass_correct'].numpy().copy()
+        for values in (mass_total, mass_correct):
+            values[1] += values[0]
+            values[-2] += values[-1]
+        mass_total, mass_correct = mass_total[1:-1], mass_correct[1:-1]
+        results['per_mass_bin'] = pd.DataFrame({
+            'mass_low': self.mass_bins[:-1], 'mass_high': self.mass_bins[1:],
+            'n': mass_total.astype(np.int64),
+            'accuracy': mass_correct / np.maximum(mass_total, 1),
+        })
+        return results
+
+    def predictions_dataframe(self):
+        if not self.predictions:
+            return None
+        return pd.concat(self.predictions, ignore_index=True)
+
+    def summary(self):
+        results = self.results()
+        return ', '.join(f'{key}: {value:.4f}' for key, value in results.items()
+                         if isinstance(value, float)) + f', n: {results["n_samples"]}'
+
+
+def evaluate_classifier(model, dataloader, device='cpu', input_index=0, evaluator=None, keep_predictions=False, viz_one=False,
+                        logits_fn=None):
+    """
+    Stream a dataloader through a classification model into a ClassificationEvaluator.
+
+    Parameters:
+    model (BaseModel): Classification model (Classification_2d/3d or any model returning class logits).
+    dataloader (DataLoader): Loader over a HaloDataset; with a DistributedSampler each process evaluates its shard
+        and the counts are merged over the process group.
+    device (str): Device for the forward pass.
+    input_index (int): Which input of the HaloDataset tuple to classify (0 - 2d, 1 - 3d).
+    evaluator (ClassificationEvaluator): Evaluator to add to, a new one by default.
+    keep_predictions (bool): Keep the per-halo predictions table.
+    viz_one (bool): Only plot three inputs of the first batch with their predictions and return None.
+    logits_fn (callable): f(model, inputs) -> logits instead of model(inputs), e.g. scripts.tta.tta_logits.
+
+    Returns:
+    ClassificationEvaluator: The evaluator with the accumulated metrics.
+    """
+    evaluator = evaluator or ClassificationEvaluator(keep_predictions=keep_predictions)
+    model.model.eval()
+    with torch.inference_mode():
+        for batch in tqdm(dataloader, desc="Classification Performance"):
+            inputs, targets = batch
+            image = inputs[input_index].to(device).float()
+            if logits_fn is not None:
+                logits = logits_fn(model, image)
+            else:
+                with model.autocast():
+                    logits = model(image).float()
+
+            if viz_one:
+                plot_predictions(image, logits, targets)
+                return None
+
+            evaluator.update(logits, targets[1], masses=targets[0], halo_ids=targets[2])
+    return evaluator.all_reduce()
+
+
+def _load_checkpoints(model_factory, factory_kwargs, checkpoints, device):
+    models = {}
+    for filename in checkpoints:
+        if not os.path.exists(models_path + filename):
+            raise FileNotFoundError(f"Checkpoint {models_path + filename} not found")
+        model = model_factory(**factory_kwargs)
+        model.load(filename)
+        model.model.to(device)
+        model.model.eval()
+        models[filename] = model
+    return models
+
+
+def _logits(model, x, logits_fn=None):
+    if logits_fn is not None:
+        return logits_fn(model, x)
+    with model.autocast():
+        return model(x).float()
+
+
+def _checkpoint_worker(model_factory, factory_kwargs, checkpoints, device, logits_fn, keep_predictions, n_threads, in_queue, out_queue):
+    torch.set_num_threads(n_threads)
+    models = _load_checkpoints(model_factory, factory_kwargs, checkpoints, device)
+    evaluators = {name: ClassificationEvaluator(keep_predictions=keep_predictions) for name in models}
+    with torch.inference_mode():
+        while True:
+            item = in_queue.get()
+            if item is None:
+                break
+            x, targets = item
+            x = x.to(device)
+            for name, model in models.items():
+                evaluators[name].update(_logits(model, x, logits_fn), targets[1], masses=targets[0], halo_ids=targets[2])
+    out_queue.put({name: (evaluators[name].state_dict(), len(models[name].history['train_loss'])) for name in models})
+
+
+def _check_workers(procs):
+    for proc in procs:
+        if not proc.is_alive() and proc.exitcode != 0:
+            raise RuntimeError(f"Checkpoint evaluation worker {proc.name} died with exit code {proc.exitcode}")
+
+
+def _put(in_queue, item, proc, poll=1.0):
+    #bounded queue: a dead worker would block the producer forever
+    while True:
+        try:
+            return in_queue.put(item, timeout=poll)
+        except queue.Full:
+            _check_workers([proc])
+
+
+def _get(out_queue, procs, poll=1.0):
+    while True:
+        try:
+            return out_queue.get(timeout=poll)
+        except queue.Empty:
+            _check_workers(procs)
+            if not any(proc.is_alive() for proc in procs) and out_queue.empty():
+                raise RuntimeError("Checkpoint evaluation workers exited without sending their results")
+
+
+def evaluate_checkpoints(model_factory, checkpoints, dataloader, device='cpu', input_index=0, factory_kwargs={},
+                         n_workers=0, logits_fn=None, keep_predictions=False):
+    """
+    Evaluate several checkpoints of the same architecture with one pass over the data: every batch is loaded
+    (and augmented) once and fed to all models.
+
+    Parameters:
+    model_factory (callable): Returns a BaseModel, e.g. ClassificationModel from classification_2d.py.
+    checkpoints (list or str): File names in results/models/, or a glob pattern there ('Classification_2d*.pth').
+    dataloader (DataLoader): Test loader over a HaloDataset.
+    device (str): Device for the forward passes.
+    input_index (int): Which input of the HaloDataset tuple to classify (0 - 2d, 1 - 3d).
+    factory_kwargs (dict): Arguments of model_factory.
+    n_workers (int): If > 0, the checkpoints are split over this many processes that receive every batch through
+        shared memory; model_factory and logits_fn must then be picklable (module level, functools.partial).
+    logits_fn (callable): f(model, inputs) -> logits, e.g. functools.partial(tta_logits, input_index=1).
+    keep_predictions (bool): Keep the per-halo predictions of every checkpoint in the evaluators.
+
+    Returns:
+    tuple: (comparison DataFrame with one row per checkpoint, {checkpoint: ClassificationEvaluator})
+    """
+    if isinstance(checkpoints, str):
+        checkpoints = sorted(os.path.basename(f) for f in glob(models_path + checkpoints))
+    if not checkpoints:
+        raise ValueError("No checkpoints to evaluate")
+
+    epochs = {}
+    if n_workers:
+        ctx = mp.get_context('spawn')
+        groups = [group for group in (checkpoints[i::n_workers] for i in range(n_workers)) if group]
+        n_threads = max(1, (os.cpu_count() or 1) // len(groups))
+        in_queues = [ctx.Queue(maxsize=4) for _ in groups]
+        out_queue = ctx.Queue()
+        procs = [ctx.Process(target=_checkpoint_worker,
+                             args=(model_factory, factory_kwargs, group, device, logits_fn, keep_predictions, n_threads, in_queue, out_queue))
+                 for group, in_queue in zip(groups, in_queues)]
+        for proc in procs:
+            proc.start()
+        states = {}
+        try:
+            for batch in tqdm(dataloader, desc=f"Evaluating {len(checkpoints)} checkpoints"):
+                inputs, targets = batch
+                x = inputs[input_index].float()
+                for in_queue, proc in zip(in_queues, procs):
+                    _put(in_queue, (x, targets), proc)
+            for in_queue, proc in zip(in_queues, procs):
+                _put(in_queue, None, proc)
+            for _ in procs:
+                states.update(_get(out_queue, procs))
+        finally:
+            if len(states) < len(checkpoints):
+                #failed or interrupted: do not leave the other workers waiting for batches
+                for proc in procs:
+                    proc.terminate()
+        for proc in procs:
+            proc.join()
+        evaluators = {}
+        for name in checkpoints:
+            state, epochs[name] = states[name]
+            evaluators[name] = ClassificationEvaluator(keep_predictions=keep_predictions).load_state_dict(state)
+    else:
+        models = _load_checkpoints(model_factory, factory_kwargs, checkpoints, device)
+        evaluators = {name: ClassificationEvaluator(keep_predictions=keep_predictions) for name in models}
+        with torch.inference_mode():
+            for batch in tqdm(dataloader, desc=f"Evaluating {len(checkpoints)} checkpoints"):
+                inputs, targets = batch
+                x = inputs[input_index].to(device).float()
+                for name, model in models.items():
+                    evaluators[name].update(_logits(model, x, logits_fn), targets[1], masses=targets[0], halo_ids=targets[2])
+        epochs = {name: len(model.history['train_loss']) for name, model in models.items()}
+
+    rows = []
+    for name, evaluator in evaluators.items():
+        results = evaluator.results()
+        rows.append({'checkpoint': name, 'epochs': epochs[name], 'n_samples': results['n_samples'],
+                     **{key: value for key, value in results.items() if isinstance(value, float)}})
+    table = pd.DataFrame(rows).sort_values('accuracy', ascending=False).reset_index(drop=True)
+    print(table.to_string())
+    return table, evaluators
+
+
+def plot_predictions(image, logits, targets, n_img_to_plots=3):
+    fig, ax = plt.subplots(1, n_img_to_plots, figsize=(10, 5))
+    for i in range(n_img_to_plots):
+        img_input = np.squeeze(image[i].cpu().numpy())
+        if img_input.ndim == 4:
+            img_input = img_input[0] #all projections: the first one
+        if img_input.ndim == 3:
+            img_input = img_input.sum(axis=-1) #3d cube: projection along z
+        logmass = targets[0][i].cpu().numpy()
+        ax[i].imshow(img_input, cmap='afmhot')
+        ax[i].set_title(f"True: {targets[1][i]}, Pred: {torch.argmax(logits[i])}; Mass: {logmass:.1f}", fontsize=10)
@@ -0,0 +1,259 @@
+import pandas as pd
+import torch
+import numpy as np
+import json
+import os
+import copy
+from contextlib import nullcontext
+
+import torch.nn as nn
+import torch.nn.functional as F
+
+from self_supervised_halos.utils.utils import res_path
+exported_path = res_path + 'exported/'
+
+
+#CPU inference for bulk embedding/classification: export a trained network to TorchScript or ONNX, optionally after
+#int8 quantization (dynamic: Linear layers, weights int8 and activations quantized on the fly; static: Conv and Linear
+#with activation ranges calibrated on a few HaloDataset batches), and run it through InferenceModel, which has the
+#forward/autocast interface of BaseModel so evaluate_classifier, extract_embeddings etc. work unchanged.
+
+
+class _MassHistPredictions(nn.Module):
+    #HaloMassHistTransformer returns (predictions, hidden_states); exports keep the predictions as RegressionModel.forward
+    def __init__(self, model):
+        super(_MassHistPredictions, self).__init__()
+        self.model = model
+
+    def forward(self, x, src_key_padding_mask):
+        return self.model(x, src_key_padding_mask=src_key_padding_mask)[0]
+
+
+def inference_module(model):
+    #plain nn.Module with tensor-only inputs/outputs for a BaseModel or network
+    network = getattr(model, 'eager_model', model)
+    if network.__class__.__name__ == 'HaloMassHistTransformer':
+        return _MassHistPredictions(network).eval()
+    return network.eval()
+
+
+def example_inputs(module, batch):
+    #forward arguments of the module for the HaloDataset input of a batch
+    if isinstance(module, _MassHistPredictions):
+        return (batch, torch.zeros_like(batch, dtype=torch.bool))
+    return (batch,)
+
+
+def _fusable_pairs(module):
+    #names of consecutive (Conv/Linear, ReLU) children of Sequential containers, for fuse_modules
+    pairs = []
+    for name, child in module.named_modules():
+        if not isinstance(child, nn.Sequential):
+            continue
+        children = list(child.named_children())
+        for (name_a, a), (name_b, b) in zip(children[:-1], children[1:]):
+            if isinstance(a, (nn.Conv2d, nn.Conv3d, nn.Linear)) and isinstance(b, nn.ReLU):
+                prefix = name + '.' if name else ''
+                pairs.append([prefix + name_a, prefix + name_b])
+    return pairs
+
+
+def quantize(model, mode='dynamic', calibration_loader=None, input_index=0, n_calibration_batches=10, backend='x86'):
+    """
+    int8 copy of a network for CPU inference.
+
+    Parameters:
+    model (BaseModel or nn.Module): Trained model, it is not modified.
+    mode (str): 'dynamic' (Linear layers, no calibration) or 'static' (Conv and Linear layers, needs calibration_loader).
+        Static quantization falls back to dynamic if the network has operations without int8 kernels.
+    calibration_loader (DataLoader): HaloDataset (subset) loader for the activation ranges of static quantization.
+    input_index (int): Which input of the HaloDataset tuple the network takes (0 - 2d, 1 - 3d, 2 - mass history).
+    n_calibration_batches (int): Number of calibration batches.
+    backend (str): Quantized engine, 'x86' (or 'fbgemm' on older torch) for servers, 'qnnpack' for ARM.
+
+    Returns:
+    nn.Module: Quantized module with the tensor-only interface of inference_module.
+    """
+    module = copy.deepcopy(inference_module(model)).cpu().eval()
+    if backend not in torch.backends.quantized.supported_engines:
+        backend = 'fbgemm' if 'fbgemm' in torch.backends.quantized.supported_engines else torch.backends.quantized.supported_engines[-1]
+    torch.backends.quantized.engine = backend
+
+    if mode == 'static' and not isinstance(module, _MassHistPredictions):
+        if calibration_loader is None:
+            raise ValueError('Static quantization needs a calibration_loader')
+        try:
+            return _quantize_static(module, calibration_loader, input_index, n_calibration_batches, backend)
+        except Exception as e:
+            print(f"Static quantization failed, using dynamic quantization: {e}")
+    elif mode == 'static':
+        print("Static quantization is not supported for the transformer, using dynamic quantization")
+    elif mode != 'dynamic':
+        raise ValueError(f"Unknown quantization mode {mode}")
+    return torch.ao.quantization.quantize_dynamic(module, {nn.Linear}, dtype=torch.qint8)
+
+
+def _quantize_static(module, calibration_loader, input_index, n_calibration_batches, backend):
+    pairs = _fusable_pairs(module)
+    if pairs:
+        module = torch.ao.quantization.fuse_modules(module, pairs)
+    wrapped = torch.ao.quantization.QuantWrapper(module)
+    wrapped.qconfig = torch.ao.quantization.get_default_qconfig(backend)
+    prepared = torch.ao.quantization.prepare(wrapped)
+    with torch.inference_mode():
+        for i, (inputs, _) in enumerate(calibration_loader):
+            if i == n_calibration_batches:
+                break
+            prepared(torch.as_tensor(inputs[input_index]).float())
+    quantized = torch.ao.quantization.convert(prepared)
+    #first call here, so that missing int8 kernels show up now and not during inference
+    with torch.inference_mode():
+        quantized(torch.as_tensor(next(iter(calibration_loader))[0][input_index]).float())
+    return quantized
+
+
+def export(module, example_batch, name, format='torchscript'):
+    """
+    Save an inference module (inference_module(model) or quantize(model)) to results/exported/<name>.pt or .onnx.
+
+    Parameters:
+    module (nn.Module): Module to export.
+    example_batch (torch.Tensor): Input batch (of the HaloDataset input the module takes) for tracing.
+    name (str): File name without extension.
+    format (str): 'torchscript' (traced, works for quantized modules) or 'onnx' (float modules, run with onnxruntime).
+
+    Returns:
+    str: Path of the exported file.
+    """
+    os.makedirs(exported_path, exist_ok=True)
+    module = module.eval()
+    args = example_inputs(module, example_batch.float().cpu())
+    input_names = ['input', 'src_key_padding_mask'][:len(args)]
+    if format == 'torchscript':
+        filename = exported_path + name + '.pt'
+        with torch.inference_mode():
+            traced = torch.jit.trace(module, args, check_trace=False)
+        traced = torch.jit.freeze(traced) if not _is_quantized(module) else traced
+        traced.save(filename)
+    elif format == 'onnx':
+        filename = exported_path + name + '.onnx'
+        torch.onnx.export(module, args, filename, input_names=input_names, output_names=['output'],
+                          dynamic_axes={input_name: {0: 'batch'} for input_name in input_names + ['output']},
+                          opset_version=17)
+    else:
+        raise ValueError(f"Unknown export format {format}")
+    with open(exported_path + name + '.json', 'w') as f:
+        json.dump({'format': format, 'inputs': input_names, 'quantized': _is_quantized(module),
+                   'input_shape': list(example_batch.shape[1:])}, f)
+    print(f"Exported {name} ({format}) to {filename}")
+    return filename
+
+
+def _is_quantized(module):
+    return any(isinstance(m, (torch.ao.nn.quantized.Linear, torch.ao.nn.quantized.dynamic.Linear,
+                              torch.ao.nn.quantized.Conv2d, torch.ao.nn.quantized.Conv3d)) for m in module.modules())
+
+
+class _OnnxModule:
+    #onnxruntime session with the call/eval interface of an nn.Module
+    def __init__(self, filename, input_names, n_threads=None):
+        try:
+            import onnxruntime as ort #pip install onnxruntime
+        except ImportError as e:
+            raise ImportError("Running ONNX exports needs onnxruntime: pip install onnxruntime") from e
+        options = ort.SessionOptions()
+        if n_threads:
+            options.intra_op_num_threads = n_threads
+        self.session = ort.InferenceSession(filename, options, providers=['CPUExecutionProvider'])
+        self.input_names = input_names
+
+    def eval(self):
+        return self
+
+    def __call__(self, *args):
+        feed = {name: arg.cpu().numpy() for name, arg in zip(self.input_names, args)}
+        return torch.from_numpy(self.session.run(None, feed)[0])
+
+
+class InferenceModel:
+    """
+    Runtime for exported or quantized networks with the interface of BaseModel: forward/__call__, autocast, .model.
+
+    InferenceModel.load(name) reads results/exported/<name>.pt (TorchScript) or .onnx (onnxruntime);
+    InferenceModel(module) wraps a module in memory, e.g. the output of quantize.
+    """
+    def __init__(self, module, input_names=('input',), model_name='exported'):
+        self.model = module
+        self.input_names = list(input_names)
+        self.model_name = model_name
+
+    @classmethod
+    def load(cls, name, n_threads=None):
+        with open(exported_path + name + '.json') as f:
+            meta = json.load(f)
+        if meta['format'] == 'onnx':
+            module = _OnnxModule(exported_path + name + '.onnx', meta['inputs'], n_threads)
+        else:
+            if n_threads:
+                torch.set_num_threads(n_threads)
+            module = torch.jit.load(exported_path + name + '.pt', map_location='cpu').eval()
+        return cls(module, meta['inputs'], model_name=name)
+
+    def autocast(self):
+        #int8/float32 exports run as they are
+        return nullcontext()
+
+    def forward(self, x, src_key_padding_mask=None):
+        x = x.float().cpu()
+        with torch.inference_mode():
+            if len(self.input_names) == 2:
+                if src_key_padding_mask is None:
+                    src_key_padding_mask = torch.zeros_like(x, dtype=torch.bool)
+                return self.model(x, src_key_padding_mask.cpu())
+            return self.model(x)
+
+    def __call__(self, *args, **kwargs):
+        return self.forward(*args, **kwargs)
+
+
+def check_drift(reference, candidate, dataloader, input_index=0, n_batches=10, device='cpu'):
+    """
+    Compare the outputs of an exported/quantized model with the float32 reference on a few batches.
+
+    Parameters:
+    reference (BaseModel or nn.Module): Original model.
+    candidate (InferenceModel or nn.Module): Exported or quantized model.
+    dataloader (DataLoader): HaloDataset loader.
+    input_index (int): Which input of the HaloDataset tuple the models take.
+    n_batches (int): Number of batches to compare.
+    device (str): Device of the reference model.
+
+    Returns:
+    dict: max and mean absolute difference, relative error, cosine similarity of the outputs and, for classifier
+    Classification_2d/3d, the fraction of samples with the same predicted class.
+    """
+    reference_module = inference_module(reference)
+    max_abs, sum_abs, sum_ref, sum_cos, same_class, n = 0.0, 0.0, 0.0, 0.0, 0, 0
+    with torch.inference_mode():
+        for i, (inputs, targets) in enumerate(dataloader):
+            if i == n_batches:
+                break
+            x = torch.as_tensor(inputs[input_index]).float()
+            args = example_inputs(reference_module, x)
+            if isinstance(reference_module, _MassHistPredictions):
+                #the transformer takes NaN-filled histories with their padding mask, as in RegressionModel.training_step
+                args = (torch.nan_to_num(x, nan=-10.0), torch.isnan(x))
+            out_ref = reference_module(*[arg.to(device) for arg in args]).float().cpu()
+            out = candidate(*args).float().cpu()
+            diff = (out - out_ref).abs()
+            max_abs = max(max_abs, diff.max().item())
+            sum_abs += diff.sum().item()
+            sum_ref += out_ref.abs().sum().item()
+            sum_cos += F.cosine_similarity(out.flatten(1), out_ref.flatten(1), dim=1).sum().item()
+            same_class += (out.argmax(dim=-1) == out_ref.argmax(dim=-1)).sum().item()
+            n += x.shape[0]
+    drift = {'max_abs_diff': max_abs, 'mean_abs_diff': sum_abs / max(n * out_ref[0].numel(), 1),
+             'relative_error': sum_abs / max(sum_ref, 1e-12), 'cosine_similarity': sum_cos / max(n, 1)}
+    if reference_module.__class__.__name__.startswith('Classification'):
+        drift['same_class'] = same_class / max(n, 1)
+    return drift
@@ -0,0 +1,221 @@
+import pandas as pd
+import torch
+import numpy as np
+from tqdm import tqdm
+import functools
+import json
+import os
+
+import torch.nn as nn
+
+from self_supervised_halos.scripts.base_model import BaseModel
+from self_supervised_halos.scripts.embeddings import checkpoint_hash
+from self_supervised_halos.utils.utils import res_path
+feature_cache_path = res_path + 'feature_cache/'
+
+
+#Training heads (projection heads, linear probes, alignment) on top of a frozen encoder does not need the CNN forward
+#at every epoch: embed the dataset once, keep the embeddings in a memory-mapped .npy and train the head from it.
+#<name>_meta.json records the encoder weights hash and the build parameters; a cache that does not match them is rebuilt.
+
+
+def _describe(transform):
+    #stable description of an augmentation: qualified name of functions and classes, and for instances their class
+    #with the public attributes (recursively, e.g. the transforms inside a Compose). Default reprs contain the
+    #object address and would change the fingerprint in every process
+    if transform is None or isinstance(transform, (bool, int, float, str)):
+        return transform
+    if isinstance(transform, (list, tuple)):
+        return [_describe(item) for item in transform]
+    if isinstance(transform, dict):
+        return {str(key): _describe(value) for key, value in sorted(transform.items(), key=lambda item: str(item[0]))}
+    if isinstance(transform, functools.partial):
+        return {'partial': _describe(transform.func), 'args': _describe(transform.args),
+                'keywords': _describe(transform.keywords)}
+    if hasattr(transform, '__qualname__'):
+        return f"{getattr(transform, '__module__', '')}.{transform.__qualname__}"
+    if isinstance(transform, torch.Tensor):
+        return repr(transform.tolist())
+    attributes = {key: value for key, value in vars(transform).items() if not key.startswith('_')} if hasattr(transform, '__dict__') else {}
+    if not attributes:
+        return repr(transform) if type(transform).__repr__ is not object.__repr__ else _describe(type(transform))
+    return {'class': _describe(type(transform)), **_describe(attributes)}
+
+
+def cache_fingerprint(encoder, dataloader, input_index, transform, n_augmentations, seed):
+    return {'encoder': checkpoint_hash(encoder), 'input_index': input_index, 'transform': _describe(transform),
+            'n_augmentations': n_augmentations, 'seed': seed, 'n_samples': len(dataloader.dataset)}
+
+
+def build_feature_cache(encoder, dataloader, device, name, input_index=0,
+                        transform=None, n_augmentations=0, seed=42, overwrite=False):
+    """
+    Run a frozen encoder once over a dataloader and store the embeddings in a memory-mapped matrix.
+
+    Parameters:
+    encoder (nn.Module): Frozen encoder, e.g. SupConNetwork.encoder.
+    dataloader (DataLoader): Loader over a HaloDataset (or a Subset of it), without drop_last. Rows are stored in loader order along with the halo ids.
+    device (str): Device for the forward pass.
+    name (str): Cache name, files are written to results/feature_cache/<name>*.
+    input_index (int): Which input of the HaloDataset tuple to encode (0 - 2d, 1 - 3d, 2 - mass history).
+    transform (callable): Augmentation for the extra versions of each halo.
+    n_augmentations (int): Number of augmented versions stored in addition to the plain one.
+    seed (int): Seed for the dataset projection choice and the augmentations, the cache is reproducible.
+    overwrite (bool): Rebuild the cache even if it exists and matches the encoder and parameters.
+
+    Returns:
+    FeatureCacheDataset: Dataset reading from the cache.
+    """
+    if n_augmentations and transform is None:
+        raise ValueError('`transform` is required for n_augmentations > 0')
+    if len(dataloader.dataset) == 0:
+        raise ValueError(f"Cannot build feature cache {name} from an empty dataloader")
+
+    os.makedirs(feature_cache_path, exist_ok=True)
+    features_file = feature_cache_path + name + '.npy'
+    labels_file = feature_cache_path + name + '_labels.npz'
+    meta_file = feature_cache_path + name + '_meta.json'
+    fingerprint = cache_fingerprint(encoder, dataloader, input_index, transform, n_augmentations, seed)
+    if os.path.exists(features_file) and os.path.exists(labels_file) and not overwrite:
+        stored = None
+        if os.path.exists(meta_file):
+            with open(meta_file) as f:
+                stored = json.load(f)
+        if stored == fingerprint:
+            print(f"Feature cache {name} exists, loading it")
+            return FeatureCacheDataset(name)
+        changed = sorted(key for key in fingerprint if stored is None or stored.get(key) != fingerprint[key])
+        print(f"Feature cache {name} was built with another {', '.join(changed)}, rebuilding it")
+
+    if os.path.exists(meta_file):
+        os.remove(meta_file)
+
+    n_versions = 1 + n_augmentations
+    n_samples = len(dataloader.dataset)
+
+    encoder = encoder.to(device)
+    encoder.eval()
+
+    np.random.seed(seed)
+    torch.manual_seed(seed)
+
+    features = None
+    masses = np.zeros(n_samples, dtype=np.float32)
+    classes = np.zeros(n_samples, dtype=np.int64)
+    ids = np.zeros(n_samples, dtype=np.int64)
+
+    start = 0
+    with torch.inference_mode():
+        for batch in tqdm(dataloader, desc=f"Building feature cache {name}"):
+            inputs, targets = batch
+            x = inputs[input_index].to(device).float()
+            batch_size = x.shape[0]
+            stop = start + batch_size
+
+            for version in range(n_versions):
+                x_version = x if version == 0 else transform(x)
+                embeddings = encoder(x_version).float().cpu().numpy()
+                if features is None:
+                    features = np.lib.format.open_memmap(features_file, mode='w+', dtype=np.float32,
+                                                         shape=(n_versions, n_samples, embeddings.shape[1]))
+                features[version, start:stop] = embeddings
+
+            masses[start:stop] = targets[0].numpy()
+            classes[start:stop] = targets[1].numpy()
+            ids[start:stop] = targets[2].numpy()
+            start = stop
+
+    if features is None:
+        raise ValueError(f"Dataloader of feature cache {name} yielded no batches")
+    features.flush()
+    del features
+    np.savez(labels_file, mass=masses, mass_class=classes, id=ids)
+    #written last: a cache interrupted before this point is never taken as valid
+    with open(meta_file, 'w') as f:
+        json.dump(fingerprint, f)
+    print(f"Feature cache {name} saved: {n_versions} versions x {n_samples} halos")
+    return FeatureCacheDataset(name)
+
+
+class FeatureCacheDataset(torch.utils.data.Dataset):
+    """
+    Embeddings from build_feature_cache. Items have the HaloDataset structure
+    ((features, 0, 0), (mass, mass_class, halo_id)), so heads can be trained with the usual BaseModel loop.
+    With augmented versions in the cache, a random version is returned for each item (random_version=True).
+    """
+    def __init__(self, name, random_version=True):
+        self.name = name
+        self.features = np.load(feature_cache_path + name + '.npy', mmap_mode='r')
+        labels = np.load(feature_cache_path + name + '_labels.npz')
+        self.masses = labels['mass']
+        self.classes = labels['mass_class']
+        self.halos_ids = labels['id']
+        self.random_version = random_version
+
+    @property
+    def n_versions(self):
+        return self.features.shape[0]
+
+    @property
+    def feature_dim(self):
+        return self.features.shape[2]
+
+    def __len__(self):
+        return self.features.shape[1]
+
+    def __getitem__(self, idx):
+        version = np.random.randint(self.n_versions) if self.random_version else 0
+        features = np.array(self.features[version, idx])
+        label = (self.masses[idx], self.classes[idx], self.halos_ids[idx])
+        return (features, np.zeros(1), np.zeros(1)), label
+
+    def to_dataframe(self, version=0):
+        df = pd.DataFrame(np.asarray(self.features[version]), index=self.halos_ids)
+        df['mass'] = self.masses
+        df['mass_class'] = self.classes
+        return df
+
+
+class FeatureHeadModel(BaseModel):
+    """Head (e.g. nn.Linear(64, 10) for a linear probe) trained on cached features"""
+    def __init__(self, head,
+                optimizer_class=torch.optim.Adam,
+                optimizer_params={},
+                scheduler_class=torch.optim.lr_scheduler.StepLR,
+                scheduler_params={},
+                criterion=None,
+                history=None,
+                target_index=1,
+                compile=None,
+                 ):
+        super().__init__(head,
+                        optimizer_class = optimizer_class,
+                        optimizer_params=optimizer_params,
+                        scheduler_class = scheduler_class,
+                        scheduler_params=scheduler_params)
+        self.criterion = criterion
+        self.history = history if history else {'train_loss': [], 'val_loss': [], 'learning_rate': []}
+        self.target_index = target_index #0 - regression on log mass, 1 - mass class
+        if compile:
+            self.compile_model(compile)
+
+    def forward(self, x):
+        return self.model(x)
+
+    def training_step(self, batch, device, verbose = False):
+        inputs, targets = batch
+        features = inputs[0].to(device)
+        targets = targets[self.target_index].to(device)
+        if self.target_index == 0:
+            targets = targets.float()
+
+        outputs = self.model(features)
+        if self.target_index == 0:
+            outputs = outputs.squeeze(-1)
+        loss = self.criterion(outputs, targets)
+
+        if verbose:
+            print(f"Loss: {loss.item()}")
+            print(f"Outputs shape: {outputs.shape}")
+
+        return loss
@@ -14,6 +14,7 @@ import matplotlib.pyplot as plt
 
 
 from self_supervised_halos.scripts.base_model import BaseModel
+from self_supervised_halos.scripts.prefetch import PreparedBatch
 
 
 import torch
@@ -126,6 +127,7 @@ class RegressionModel(BaseModel):
                 criterion=None, 
                 history=None,
                 transform = mask_time_series_batch,
+                compile=None,
                  ):
         model = HaloMassHistTransformer()
         super().__init__(model, 
@@ -136,18 +138,27 @@ class RegressionModel(BaseModel):
         self.criterion = criterion
         self.history = history if history else {'train_loss': [], 'val_loss': [], 'learning_rate': []}
         self.transform = transform
+        if compile:
+            self.compile_model(compile)
 
     def forward(self, x, **kwargs):
         return self.model(x, **kwargs)[0]
     
-    def training_step(self, batch, device, verbose = False):
+    def prepare_batch(self, batch, device):
         inputs, targets = batch
-        time_series = inputs[2].to(device)
-        time_series = time_series.float()
-
+        with self.timer.phase('to_device'):
+            time_series = inputs[2].to(device)
+            time_series = time_series.float()
 
         # Mask some subsequences in the batch
-        unmasked_signal, masked_signal, prediction_mask = self.transform(time_series)
+        with self.timer.phase('transform'):
+            unmasked_signal, masked_signal, prediction_mask = self.transform(time_series)
+        return PreparedBatch((unmasked_signal, masked_signal, prediction_mask))
+
+    def training_step(self, batch, device, verbose = False):
+        if not isinstance(batch, PreparedBatch):
+            batch = self.prepare_batch(batch, device)
+        unmasked_signal, masked_signal, prediction_mask = batch
 
         # Replace NaNs with zeros for processing
         masked_signal_filled = torch.nan_to_num(masked_signal, nan=-10.0)
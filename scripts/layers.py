@@ -0,0 +1,23 @@
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+
+
+class DownsampleMaxPool(nn.Module):
+    """
+    MaxPool with kernel 2 and stride 2 (2d or 3d) that passes inputs through once their spatial size is below
+    min_size, so the following kernel-2/stride-2 convolution still gets at least 2 pixels.
+    For the 64^2/64^3 inputs it is the same as nn.MaxPool2d/3d(2, 2); together with an adaptive pooling layer at the
+    end of the network it lets Classification_2d/3d and Encoder run on 16 and 32 pixel inputs (progressive resizing).
+    """
+    def __init__(self, dims=2, min_size=4):
+        super(DownsampleMaxPool, self).__init__()
+        self.dims = dims
+        self.min_size = min_size
+
+    def forward(self, x):
+        if x.shape[-1] < self.min_size:
+            return x
+        if self.dims == 2:
+            return F.max_pool2d(x, kernel_size=2, stride=2)
+        return F.max_pool3d(x, kernel_size=2, stride=2)
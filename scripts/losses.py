@@ -0,0 +1,216 @@
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+
+
+# Contrastive losses shared by the halo models (scripts/) and the MNIST playground (notebooks/colab_notebooks/simCLR_MNIST).
+# All similarities are computed with a single matmul of L2-normalized embeddings, and self-similarity is removed
+# by filling the diagonal with -inf in place, so no (N x N x D) broadcast or boolean-indexing copies are made.
+
+
+def _float32(tensor):
+    #similarities and logsumexp are kept in float32 under autocast
+    return torch.autocast(device_type=tensor.device.type, enabled=False)
+
+
+def _self_contrast_fill(logits):
+    # logits: (n_anchor, n_contrast); anchor i is always contrast i (see view ordering below)
+    return logits.fill_diagonal_(float('-inf'))
+
+
+def nt_xent_loss(z_i, z_j, temperature=0.5, normalize=True):
+    """
+    NT-Xent (SimCLR) loss for two views of the same batch.
+
+    Parameters:
+    z_i (torch.Tensor): Embeddings of the first view, shape (batch_size, dim).
+    z_j (torch.Tensor): Embeddings of the second view, shape (batch_size, dim).
+    temperature (float): Softmax temperature.
+    normalize (bool): L2-normalize the embeddings first (set False if the network already does it).
+
+    Returns:
+    loss (torch.Tensor): Scalar loss averaged over all 2*batch_size anchors.
+    """
+    batch_size = z_i.shape[0]
+    with _float32(z_i):
+        z = torch.cat([z_i, z_j], dim=0).float()
+        if normalize:
+            z = F.normalize(z, dim=1)
+
+        logits = torch.matmul(z, z.T) / temperature
+        logits = _self_contrast_fill(logits)
+
+        # the positive of sample k in the first half is k + batch_size and vice versa
+        targets = torch.arange(batch_size, device=z.device)
+        targets = torch.cat([targets + batch_size, targets], dim=0)
+
+        return F.cross_entropy(logits, targets)
+
+
+def supcon_loss(features, labels=None, mask=None, temperature=0.07, base_temperature=0.07, contrast_mode='all'):
+    """
+    Supervised contrastive loss (https://arxiv.org/abs/2004.11362). Without labels/mask it reduces to NT-Xent.
+
+    Parameters:
+    features (torch.Tensor): Normalized embeddings of shape (batch_size, n_views, dim).
+    labels (torch.Tensor): Class labels of shape (batch_size,). Samples with equal labels are positives.
+    mask (torch.Tensor): Alternatively, a (batch_size, batch_size) positives mask.
+    temperature (float): Softmax temperature.
+    base_temperature (float): Loss is scaled by temperature/base_temperature.
+    contrast_mode (str): 'all' uses every view as an anchor, 'one' only the first view.
+
+    Returns:
+    loss (torch.Tensor): Scalar loss.
+    """
+    if len(features.shape) < 3:
+        raise ValueError('`features` needs to be [bsz, n_views, ...],'
+                         'at least 3 dimensions are required')
+    if len(features.shape) > 3:
+        features = features.view(features.shape[0], features.shape[1], -1)
+
+    device = features.device
+    batch_size, contrast_count = features.shape[0], features.shape[1]
+    features = features.float()
+
+    if labels is not None and mask is not None:
+        raise ValueError('Cannot define both `labels` and `mask`')
+    elif labels is None and mask is None:
+        mask = torch.eye(batch_size, dtype=torch.bool, device=device)
+    elif labels is not None:
+        labels = labels.contiguous().view(-1, 1).to(device)
+        if labels.shape[0] != batch_size:
+            raise ValueError('Num of labels does not match num of features')
+        mask = torch.eq(labels, labels.T)
+    else:
+        mask = mask.to(device).bool()
+
+    # view-major ordering: [view_0 of all samples, view_1 of all samples, ...]
+    contrast_feature = features.transpose(0, 1).reshape(contrast_count * batch_size, -1)
+    if contrast_mode == 'one':
+        anchor_feature = features[:, 0]
+        anchor_count = 1
+    elif contrast_mode == 'all':
+        anchor_feature = contrast_feature
+        anchor_count = contrast_count
+    else:
+        raise ValueError('Unknown mode: {}'.format(contrast_mode))
+
+    with _float32(features):
+        logits = torch.matmul(anchor_feature, contrast_feature.T) / temperature
+        logits = _self_contrast_fill(logits)
+        log_prob = logits - torch.logsumexp(logits, dim=1, keepdim=True)
+
+    pos_mask = mask.repeat(anchor_count, contrast_count)
+    pos_mask.fill_diagonal_(False)
+
+    # log_prob is -inf on the diagonal, zero it out before summing over positives
+    mean_log_prob_pos = log_prob.masked_fill(~pos_mask, 0.0).sum(1) / pos_mask.sum(1).clamp(min=1)
+
+    loss = - (temperature / base_temperature) * mean_log_prob_pos
+    loss = loss.view(anchor_count, batch_size).mean()
+
+    return loss
+
+
+class SimCLRLoss(nn.Module):
+    """NT-Xent loss, forward(zis, zjs) takes the embeddings of the two views"""
+    def __init__(self, temperature=0.5, device='cpu'):
+        super(SimCLRLoss, self).__init__()
+        self.temperature = temperature
+        self.device = device #kept for backward compatibility, tensors are created on the device of the inputs
+
+    def forward(self, zis, zjs):
+        return nt_xent_loss(zis, zjs, temperature=self.temperature)
+
+
+NTXentLoss = SimCLRLoss
+
+
+class SupConLoss(nn.Module):
+    #src: https://github.com/giakoumoglou/classification/tree/main/notebooks
+    #if no labels are provided, it is the SimCLR (NT-Xent) loss
+    def __init__(self, temperature=0.07, contrast_mode='all',
+                 base_temperature=0.07,
+                 device='cpu'):
+        super(SupConLoss, self).__init__()
+        self.temperature = temperature
+        self.contrast_mode = contrast_mode
+        self.base_temperature = base_temperature
+
+        self.device = device #kept for backward compatibility, tensors are created on the device of the inputs
+
+    def forward(self, features, labels=None, mask=None):
+        return supcon_loss(features, labels=labels, mask=mask,
+                           temperature=self.temperature,
+                           base_temperature=self.base_temperature,
+                           contrast_mode=self.contrast_mode)
+
+
+def queue_supcon_loss(query, key, queue=None, labels=None, queue_labels=None,
+                      temperature=0.07, base_temperature=0.07, ignore_keys=None):
+    """
+    MoCo-style (supervised) contrastive loss: anchors are contrasted against momentum-encoder keys of the
+    current batch and a queue of keys from previous batches (https://arxiv.org/abs/1911.05722).
+
+    Parameters:
+    query (torch.Tensor): Normalized embeddings from the online network, shape (N, dim).
+    key (torch.Tensor): Normalized momentum embeddings, shape (N, dim); key[i] is the positive of query[i].
+    queue (torch.Tensor): Normalized embeddings of past batches, shape (K, dim). None to use the batch only.
+    labels (torch.Tensor): Labels of the batch, shape (N,). If None, only key[i] is a positive of query[i].
+    queue_labels (torch.Tensor): Labels of the queue entries, shape (K,). Required if labels are given.
+    temperature (float): Softmax temperature.
+    base_temperature (float): Loss is scaled by temperature/base_temperature.
+    ignore_keys (torch.Tensor): Index of a key per query, shape (N,), removed from its contrast set (neither positive
+        nor negative), e.g. the momentum key of the query's own view, which is a near-duplicate of the query.
+
+    Returns:
+    loss (torch.Tensor): Scalar loss.
+    """
+    n_query = query.shape[0]
+    query = query.float()
+    key = key.detach().float()
+    contrast_feature = key if queue is None else torch.cat([key, queue.detach().float()], dim=0)
+
+    # the query itself is not in the contrast set, so no self-contrast masking is needed
+    with _float32(query):
+        logits = torch.matmul(query, contrast_feature.T) / temperature
+        if ignore_keys is not None:
+            ignored = torch.zeros_like(logits, dtype=torch.bool)
+            ignored[torch.arange(n_query, device=query.device), ignore_keys.to(query.device)] = True
+            logits = logits.masked_fill(ignored, -float('inf'))
+        log_prob = logits - torch.logsumexp(logits, dim=1, keepdim=True)
+
+    if labels is None:
+        pos_mask = torch.zeros_like(logits, dtype=torch.bool)
+        idx = torch.arange(n_query, device=query.device)
+        pos_mask[idx, idx] = True
+    else:
+        labels = labels.contiguous().view(-1).to(query.device)
+        if queue is not None:
+            if queue_labels is None:
+                raise ValueError('`queue_labels` are required when `labels` are given')
+            contrast_labels = torch.cat([labels, queue_labels.to(query.device)], dim=0)
+        else:
+            contrast_labels = labels
+        pos_mask = torch.eq(labels.view(-1, 1), contrast_labels.view(1, -1))
+    if ignore_keys is not None:
+        pos_mask = pos_mask & ~ignored
+
+    mean_log_prob_pos = log_prob.masked_fill(~pos_mask, 0.0).sum(1) / pos_mask.sum(1).clamp(min=1)
+
+    loss = - (temperature / base_temperature) * mean_log_prob_pos
+    return loss.mean()
+
+
+class MoCoSupConLoss(nn.Module):
+    """SupCon loss against a momentum-encoder key queue, forward(query, key, queue, labels, queue_labels)"""
+    def __init__(self, temperature=0.07, base_temperature=0.07):
+        super(MoCoSupConLoss, self).__init__()
+        self.temperature = temperature
+        self.base_temperature = base_temperature
+
+    def forward(self, query, key, queue=None, labels=None, queue_labels=None, ignore_keys=None):
+        return queue_supcon_loss(query, key, queue=queue, labels=labels, queue_labels=queue_labels,
+                                 temperature=self.temperature,
+                                 base_temperature=self.base_temperature,
+                                 ignore_keys=ignore_keys)
@@ -0,0 +1,123 @@
+import torch
+import threading
+import queue
+
+
+class PreparedBatch(tuple):
+    """Batch already moved to the device and augmented by BaseModel.prepare_batch, training_step uses it as is"""
+    pass
+
+
+def move_to_device(batch, device, non_blocking=False):
+    if isinstance(batch, torch.Tensor):
+        return batch.to(device, non_blocking=non_blocking)
+    if isinstance(batch, PreparedBatch):
+        return batch
+    if isinstance(batch, (list, tuple)):
+        return type(batch)(move_to_device(item, device, non_blocking) for item in batch)
+    return batch
+
+
+def pin_batch(batch):
+    if isinstance(batch, torch.Tensor):
+        return batch.pin_memory()
+    if isinstance(batch, (list, tuple)):
+        return type(batch)(pin_batch(item) for item in batch)
+    return batch
+
+
+def record_stream(batch, stream):
+    #mark the CUDA tensors of a batch as used on stream, so the caching allocator does not hand their memory (allocated
+    #on the copy stream) to another tensor while the consumer stream is still reading them
+    if isinstance(batch, torch.Tensor):
+        if batch.is_cuda:
+            batch.record_stream(stream)
+    elif isinstance(batch, (list, tuple)):
+        for item in batch:
+            record_stream(item, stream)
+
+
+class _End:
+    pass
+
+
+class _Failure:
+    def __init__(self, exc):
+        self.exc = exc
+
+
+class PrefetchLoader:
+    """
+    Drop-in wrapper around a DataLoader that prepares the next `depth` batches on a background thread while the
+    current step runs. prepare_fn (e.g. BaseModel.prepare_batch) moves the batch to the device and can apply the
+    augmentation; without it batches are only moved to the device. On CUDA, batches are pinned and copied on a
+    side stream, and their tensors are recorded on the consuming stream before they are handed out. A thread is enough: collation, copies and torch augmentations release the GIL.
+    """
+    def __init__(self, loader, device='cpu', depth=2, prepare_fn=None, pin_memory=None):
+        self.loader = loader
+        self.device = device
+        self.depth = depth
+        self.prepare_fn = prepare_fn
+        is_cuda = str(device).startswith('cuda') and torch.cuda.is_available()
+        if pin_memory is None:
+            pin_memory = is_cuda and not getattr(loader, 'pin_memory', False)
+        self.pin_memory = pin_memory
+        self.stream = torch.cuda.Stream() if is_cuda else None
+
+    def __len__(self):
+        return len(self.loader)
+
+    def __getattr__(self, name):
+        #dataset, batch_size etc. of the wrapped loader
+        return getattr(self.loader, name)
+
+    def _prepare(self, batch):
+        if self.pin_memory:
+            batch = pin_batch(batch)
+        if self.prepare_fn is not None:
+            return self.prepare_fn(batch)
+        return move_to_device(batch, self.device, non_blocking=self.pin_memory)
+
+    def _put(self, out_queue, stop_event, item):
+        #returns False if the consumer stopped iterating
+        while not stop_event.is_set():
+            try:
+                out_queue.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def _worker(self, out_queue, stop_event):
+        try:
+            for batch in self.loader:
+                if self.stream is not None:
+                    with torch.cuda.stream(self.stream):
+                        batch = self._prepare(batch)
+                    self.stream.synchronize()
+                else:
+                    batch = self._prepare(batch)
+                if not self._put(out_queue, stop_event, batch):
+                    return
+            self._put(out_queue, stop_event, _End())
+        except Exception as exc:
+            self._put(out_queue, stop_event, _Failure(exc))
+
+    def __iter__(self):
+        out_queue = queue.Queue(maxsize=max(self.depth, 1))
+        stop_event = threading.Event()
+        thread = threading.Thread(target=self._worker, args=(out_queue, stop_event), daemon=True)
+        thread.start()
+        try:
+            while True:
+                item = out_queue.get()
+                if isinstance(item, _End):
+                    break
+                if isinstance(item, _Failure):
+                    raise item.exc
+                if self.stream is not None:
+                    record_stream(item, torch.cuda.current_stream())
+                yield item
+        finally:
+            stop_event.set()
+            thread.join()
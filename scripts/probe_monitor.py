@@ -0,0 +1,130 @@
+import torch
+import time
+from contextlib import nullcontext
+
+import torch.nn.functional as F
+
+from self_supervised_halos.scripts.embeddings import embedding_layers
+
+
+#Epoch-end check of the representation while it trains (see BaseModel.set_probe_monitor): a fixed subset of halos is
+#loaded once, embedded with the same layer as scripts/embeddings.py and split in a bank and a query half. The mass
+#class of the queries is predicted by a weighted kNN vote over the bank, logSubhaloMass by a ridge regression fitted
+#in closed form on the bank. Both take milliseconds once the subset is embedded.
+
+
+def knn_accuracy(bank, bank_labels, queries, query_labels, k=20, temperature=0.07, n_classes=None):
+    #cosine kNN with exp(similarity / temperature) weighted votes (as in the DINO/InstDisc kNN monitor)
+    bank = F.normalize(bank, dim=1)
+    queries = F.normalize(queries, dim=1)
+    n_classes = n_classes or int(max(bank_labels.max(), query_labels.max())) + 1
+    similarity, idx = (queries @ bank.T).topk(min(k, bank.shape[0]), dim=1)
+    votes = torch.zeros(queries.shape[0], n_classes, device=queries.device)
+    votes.scatter_add_(1, bank_labels[idx], (similarity / temperature).exp())
+    return (votes.argmax(dim=1) == query_labels).float().mean().item()
+
+
+def ridge_probe(x_train, y_train, x_test, y_test, ridge_lambda=1e-2):
+    #closed-form ridge regression on standardized features (float64, D x D solve); returns R^2 and RMSE on the test set
+    x_train, y_train, x_test, y_test = (t.double() for t in (x_train, y_train, x_test, y_test))
+    mean, std = x_train.mean(dim=0), x_train.std(dim=0).clamp(min=1e-8)
+    x_train, x_test = (x_train - mean) / std, (x_test - mean) / std
+    y_mean = y_train.mean()
+    gram = x_train.T @ x_train + ridge_lambda * x_train.shape[0] * torch.eye(x_train.shape[1], dtype=x_train.dtype, device=x_train.device)
+    weights = torch.linalg.solve(gram, x_train.T @ (y_train - y_mean))
+    residuals = y_test - (x_test @ weights + y_mean)
+    r2 = 1 - (residuals ** 2).sum() / ((y_test - y_test.mean()) ** 2).sum().clamp(min=1e-12)
+    return r2.item(), residuals.pow(2).mean().sqrt().item()
+
+
+class ProbeMonitor:
+    """
+    kNN accuracy (mass class) and ridge probe (logSubhaloMass) of the embeddings of a fixed halo subset.
+
+    Parameters:
+    probe_loader (DataLoader): HaloDataset loader; the first n_samples halos are loaded once and kept on the CPU.
+    n_samples (int): Size of the probe subset, half bank/train and half query/test.
+    k (int): Neighbours of the kNN vote.
+    temperature (float): Temperature of the kNN vote weights.
+    ridge_lambda (float): Ridge penalty (relative to the number of samples, features are standardized).
+    layer_fn (callable): f(network, x) -> (batch, D), default from embedding_layers for the network class.
+    input_index (int): Which input of the HaloDataset tuple to embed, default from embedding_layers.
+    chunk_size (int): Samples per forward pass.
+    seed (int): Seed of the bank/query split.
+    """
+    def __init__(self, probe_loader, n_samples=2048, k=20, temperature=0.07, ridge_lambda=1e-2,
+                 layer_fn=None, input_index=None, chunk_size=512, seed=0):
+        self.probe_loader = probe_loader
+        self.n_samples = n_samples
+        self.k = k
+        self.temperature = temperature
+        self.ridge_lambda = ridge_lambda
+        self.layer_fn = layer_fn
+        self.input_index = input_index
+        self.chunk_size = chunk_size
+        self.seed = seed
+        self.inputs = None
+
+    def _load(self, input_index):
+        inputs, logmass, mass_class = [], [], []
+        n = 0
+        for batch_inputs, targets in self.probe_loader:
+            x = batch_inputs[input_index]
+            if isinstance(x, (list, tuple)):
+                x = x[0] #two projections (choose_two_2d): the first one
+            inputs.append(torch.as_tensor(x).float())
+            logmass.append(torch.as_tensor(targets[0]).float())
+            mass_class.append(torch.as_tensor(targets[1]).long())
+            n += len(inputs[-1])
+            if n >= self.n_samples:
+                break
+        self.inputs = torch.cat(inputs)[:self.n_samples]
+        self.logmass = torch.cat(logmass)[:self.n_samples]
+        self.mass_class = torch.cat(mass_class)[:self.n_samples]
+        n = len(self.inputs)
+        self.split = torch.randperm(n, generator=torch.Generator().manual_seed(self.seed))
+        self.n_bank = n // 2
+
+    @torch.no_grad()
+    def embed(self, network, device, layer_fn, input_index, autocast=None):
+        embeddings = []
+        for x in torch.split(self.inputs, self.chunk_size):
+            x = x.to(device, non_blocking=True)
+            with autocast() if autocast else nullcontext():
+                if x.dim() == 5 and input_index == 0:
+                    #all projections (choose_all_2d): embed each and average, as extract_embeddings
+                    embedding = layer_fn(network, x.flatten(0, 1)).view(x.shape[0], x.shape[1], -1).mean(dim=1)
+                else:
+                    embedding = layer_fn(network, x)
+            embeddings.append(embedding.float())
+        return torch.cat(embeddings)
+
+    def __call__(self, model, device='cpu'):
+        """
+        Probe a BaseModel (or network) now. Returns a dict of probe_knn_accuracy, probe_ridge_r2, probe_ridge_rmse
+        and probe_time_s (embedding and probes, without the one-time loading of the subset).
+        """
+        network = getattr(model, 'eager_model', model)
+        layer_fn, input_index = self.layer_fn, self.input_index
+        if layer_fn is None or input_index is None:
+            default_fn, default_index = embedding_layers[network.__class__.__name__]
+            layer_fn = layer_fn or default_fn
+            input_index = default_index if input_index is None else input_index
+        if self.inputs is None:
+            self._load(input_index)
+
+        was_training = network.training
+        network.eval()
+        t0 = time.perf_counter()
+        embeddings = self.embed(network, device, layer_fn, input_index, autocast=getattr(model, 'autocast', None))
+        network.train(was_training)
+
+        bank, query = self.split[:self.n_bank].to(device), self.split[self.n_bank:].to(device)
+        mass_class, logmass = self.mass_class.to(device), self.logmass.to(device)
+        knn = knn_accuracy(embeddings[bank], mass_class[bank], embeddings[query], mass_class[query],
+                           k=self.k, temperature=self.temperature)
+        r2, rmse = ridge_probe(embeddings[bank], logmass[bank], embeddings[query], logmass[query], self.ridge_lambda)
+        if str(device).startswith('cuda'):
+            torch.cuda.synchronize()
+        return {'probe_knn_accuracy': knn, 'probe_ridge_r2': r2, 'probe_ridge_rmse': rmse,
+                'probe_time_s': time.perf_counter() - t0}
@@ -0,0 +1,335 @@
+import pandas as pd
+import torch
+import numpy as np
+import time
+
+import torch.nn.functional as F
+
+from self_supervised_halos.scripts.embeddings import EmbeddingStore
+from self_supervised_halos.scripts.evaluation import default_mass_bins
+
+
+#Linear probes of stored embeddings (scripts/embeddings.py) for many catalog quantities at once, without training a
+#head per embedding/target/seed. Features are standardized once over all halos (no labels involved), a bias column is
+#appended and k-fold splits are drawn per seed.
+#Ridge: all targets, folds and penalties share one D x D Gram matrix per target; the training Gram of a fold is the
+#full one minus the fold's, and all (fold, penalty) systems are solved in one batched torch.linalg.solve.
+#Logistic: multinomial, the weights of all (fold, penalty) problems are one tensor optimized by a batched L-BFGS
+#(batched_lbfgs): every step is one forward/backward over all problems, but the curvature history, the backtracking
+#step size and the stopping test are kept per problem, so each converges as if fitted alone. The final gradient norm
+#of every problem is reported to spot unconverged probes.
+
+
+def half_mass_snapshot(mass_history):
+    #formation time: first snapshot at which the main progenitor reaches half of its final (snapshot 99) mass
+    snap = np.asarray(mass_history['snap'])
+    mass = np.asarray(mass_history['mass'], dtype=float)
+    order = np.argsort(snap)
+    snap, mass = snap[order], mass[order]
+    if not len(mass) or not np.isfinite(mass[-1]):
+        return np.nan
+    formed = np.nonzero(mass >= 0.5 * mass[-1])[0]
+    return float(snap[formed[0]]) if len(formed) else np.nan
+
+
+def catalog_targets(catalog, mass_history=None, columns=(), mass_bins=default_mass_bins):
+    """
+    Probe targets indexed by halo id.
+
+    Parameters:
+    catalog (DataFrame): Halo catalog indexed by halo id (subhalos_df), with logSubhaloMass.
+    mass_history (dict): halo id -> {'snap', 'mass'} (tng.subhalos_mass_history) for half_mass_snapshot.
+    columns (list): Further catalog columns to probe (regression).
+    mass_bins (array): Edges of the mass classes, as HaloDataset.
+
+    Returns:
+    DataFrame: logSubhaloMass, mass_class (int, classification), half_mass_snapshot and the extra columns.
+    """
+    targets = pd.DataFrame(index=catalog.index)
+    targets['logSubhaloMass'] = catalog['logSubhaloMass']
+    targets['mass_class'] = (np.digitize(catalog['logSubhaloMass'], mass_bins) - 1).astype(np.int64)
+    if mass_history is not None:
+        targets['half_mass_snapshot'] = [half_mass_snapshot(mass_history[halo_id]) if halo_id in mass_history else np.nan
+                                         for halo_id in catalog.index]
+    for column in columns:
+        targets[column] = catalog[column]
+    return targets
+
+
+def kfold_ids(n, n_folds, seed):
+    #fold index of every row, balanced random assignment
+    perm = torch.randperm(n, generator=torch.Generator().manual_seed(seed))
+    fold = torch.empty(n, dtype=torch.long)
+    fold[perm] = torch.arange(n) % n_folds
+    return fold
+
+
+def ridge_probes(x, y, fold, n_folds, lambdas):
+    """
+    Ridge regressions of all targets for all folds and penalties.
+
+    Parameters:
+    x (torch.Tensor): (N, D) standardized features with a bias column last, float64.
+    y (torch.Tensor): (N, T) targets, NaN where missing.
+    fold (torch.Tensor): (N,) fold index.
+    lambdas (list): Penalties, relative to the number of training samples; the bias is not penalized.
+
+    Returns:
+    dict: 'r2' and 'rmse' of shape (n_folds, n_lambdas, T) on the held-out folds.
+    """
+    n, d = x.shape
+    valid = ~torch.isnan(y)
+    y = torch.nan_to_num(y)
+    w = valid.to(x.dtype)
+    onehot = F.one_hot(fold, n_folds).to(x.dtype) # (N, K)
+    #per fold and target: X^T diag(w) X and X^T diag(w) y, the training statistics are total - fold
+    gram_fold = torch.stack([torch.stack([(x[fold == k] * w[fold == k, t:t + 1]).T @ x[fold == k] for t in range(y.shape[1])])
+                             for k in range(n_folds)]) # (K, T, D, D)
+    xty_fold = torch.einsum('nk,nt,nd->ktd', onehot, w * y, x)
+    n_fold = onehot.T @ w
+    gram_train = gram_fold.sum(dim=0, keepdim=True) - gram_fold
+    xty_train = xty_fold.sum(dim=0, keepdim=True) - xty_fold
+    n_train = n_fold.sum(dim=0, keepdim=True) - n_fold
+
+    penalty = torch.eye(d, dtype=x.dtype, device=x.device)
+    penalty[-1, -1] = 0
+    lambdas = torch.as_tensor(lambdas, dtype=x.dtype, device=x.device)
+    #(K, L, T, D, D) systems
+    systems = gram_train.unsqueeze(1) + (lambdas.view(1, -1, 1) * n_train.unsqueeze(1))[..., None, None] * penalty
+    coef = torch.linalg.solve(systems, xty_train.unsqueeze(1).expand(-1, len(lambdas), -1, -1).unsqueeze(-1)).squeeze(-1)
+
+    predictions = torch.einsum('nd,kltd->kltn', x, coef) # (K, L, T, N)
+    test = (onehot.T[:, None, :] * w.T[None]).unsqueeze(1) # (K, 1, T, N)
+    n_test = test.sum(dim=-1).clamp(min=1)
+    residuals = (predictions - y.T) ** 2
+    sse = (residuals * test).sum(dim=-1)
+    y_mean = (y.T * test).sum(dim=-1) / n_test
+    sst = (((y.T - y_mean.unsqueeze(-1)) ** 2) * test).sum(dim=-1).clamp(min=1e-12)
+    return {'r2': 1 - sse / sst, 'rmse': (sse / n_test).sqrt()}
+
+
+def batched_lbfgs(objective, w, max_iter=100, history_size=10, tolerance=1e-5, max_backtracks=20):
+    """
+    Minimize B independent problems with L-BFGS, all evaluated at once.
+
+    Parameters:
+    objective (callable): (B, ...) parameters -> (B,) losses; problem b must depend only on w[b].
+    w (torch.Tensor): (B, ...) initial parameters.
+    max_iter (int): Maximum number of iterations.
+    history_size (int): Curvature pairs kept per problem.
+    tolerance (float): A problem stops once the max-norm of its gradient is below this.
+    max_backtracks (int): Step halvings of the Armijo backtracking per iteration.
+
+    Returns:
+    tuple: (parameters, (B,) gradient norms at the solution).
+    """
+    def evaluate(w):
+        with torch.enable_grad():
+            w = w.detach().requires_grad_(True)
+            losses = objective(w)
+            grad, = torch.autograd.grad(losses.sum(), w) #problems are independent: the summed loss gives each its gradient
+        return losses.detach(), grad.flatten(1)
+
+    shape = w.shape
+    w = w.detach().flatten(1).clone()
+    dot = lambda a, b: (a * b).sum(dim=1)
+    loss, grad = evaluate(w.view(shape))
+    history = [] #(s, y, rho) of the last iterations, rho = 0 where the pair is not used
+    active = grad.abs().amax(dim=1) > tolerance
+    for _ in range(max_iter):
+        if not active.any():
+            break
+        #two-loop recursion, every product per problem
+        q = grad.clone()
+        alphas = []
+        for s_, y_, rho in reversed(history):
+            alpha = rho * dot(s_, q)
+            q -= alpha[:, None] * y_
+            alphas.append(alpha)
+        if history:
+            s_, y_, rho = history[-1]
+            gamma = torch.where(rho > 0, dot(s_, y_) / dot(y_, y_).clamp(min=1e-20), torch.ones_like(rho))
+        else:
+            gamma = 1 / grad.norm(dim=1).clamp(min=1) #first step of length at most 1
+        r = gamma[:, None] * q
+        for (s_, y_, rho), alpha in zip(history, reversed(alphas)):
+            beta = rho * dot(y_, r)
+            r += (alpha - beta)[:, None] * s_
+        direction = -r
+        slope = dot(grad, direction)
+        not_descent = slope >= 0
+        direction[not_descent] = -grad[not_descent]
+        slope = torch.where(not_descent, -dot(grad, grad), slope)
+        direction[~active] = 0
+
+        #Armijo backtracking with a step size per problem
+        step = active.to(w.dtype)
+        pending = active.clone()
+        new_w, new_loss, new_grad = w, loss, grad
+        for _ in range(max_backtracks):
+            trial_w = w + step[:, None] * direction
+            trial_loss, trial_grad = evaluate(trial_w.view(shape))
+            accept = pending & (trial_loss <= loss + 1e-4 * step * slope)
+            new_w = torch.where(accept[:, None], trial_w, new_w)
+            new_loss = torch.where(accept, trial_loss, new_loss)
+            new_grad = torch.where(accept[:, None], trial_grad, new_grad)
+            pending &= ~accept
+            if not pending.any():
+                break
+            step = torch.where(pending, step / 2, step)
+        active &= ~pending #no decrease found: the problem is at the precision limit
+
+        s_, y_ = new_w - w, new_grad - grad
+        sy = dot(s_, y_)
+        history.append((s_, y_, torch.where(sy > 1e-10, 1 / sy.clamp(min=1e-10), torch.zeros_like(sy))))
+        history = history[-history_size:]
+        w, loss, grad = new_w, new_loss, new_grad
+        active &= grad.abs().amax(dim=1) > tolerance
+    return w.view(shape), grad.norm(dim=1)
+
+
+def logistic_probes(x, y, fold, n_folds, lambdas, n_classes=None, max_iter=100):
+    """
+    L2-regularized multinomial logistic regressions for all folds and penalties, fitted together with batched_lbfgs.
+
+    Parameters:
+    x (torch.Tensor): (N, D) standardized features with a bias column last, float32.
+    y (torch.Tensor): (N,) class labels, -1 where missing.
+    fold (torch.Tensor): (N,) fold index.
+    lambdas (list): L2 penalties on the weights (not the bias), added to the mean cross-entropy.
+    max_iter (int): L-BFGS iterations.
+
+    Returns:
+    dict: 'accuracy', 'balanced_accuracy' and 'nll' of shape (n_folds, n_lambdas) on the held-out folds, and
+    'grad_norm', the norm of the training-loss gradient at the solution.
+    """
+    n, d = x.shape
+    n_classes = n_classes or int(y.max()) + 1
+    valid = y >= 0
+    labels = y.clamp(min=0)
+    lambdas = torch.as_tensor(lambdas, dtype=x.dtype, device=x.device)
+    n_lambdas = len(lambdas)
+    #problem b = (fold k, penalty l) trains on the valid rows outside fold k
+    train = ((fold.unsqueeze(0) != torch.arange(n_folds, device=x.device).unsqueeze(1)) & valid).to(x.dtype) # (K, N)
+    train = train.repeat_interleave(n_lambdas, dim=0) # (K*L, N)
+    penalties = lambdas.repeat(n_folds)
+    targets = labels.unsqueeze(0).expand(len(train), -1)
+
+    def objective(weights):
+        logits = torch.einsum('nd,bdc->bnc', x, weights)
+        nll = F.cross_entropy(logits.transpose(1, 2), targets, reduction='none')
+        return (nll * train).sum(dim=1) / train.sum(dim=1).clamp(min=1) + penalties * weights[:, :-1].pow(2).sum(dim=(1, 2))
+
+    weights = torch.zeros(n_folds * n_lambdas, d, n_classes, dtype=x.dtype, device=x.device)
+    weights, grad_norm = batched_lbfgs(objective, weights, max_iter=max_iter)
+
+    with torch.no_grad():
+        logits = torch.einsum('nd,bdc->bnc', x, weights).view(n_folds, n_lambdas, n, n_classes)
+        test = ((fold == torch.arange(n_folds, device=x.device).unsqueeze(1)) & valid).to(x.dtype).unsqueeze(1) # (K, 1, N)
+        n_test = test.sum(dim=-1).clamp(min=1)
+        nll = -torch.log_softmax(logits, dim=-1).gather(-1, labels.view(1, 1, n, 1).expand(n_folds, n_lambdas, n, 1)).squeeze(-1)
+        correct = (logits.argmax(dim=-1) == labels).to(x.dtype)
+        class_onehot = F.one_hot(labels, n_classes).to(x.dtype) # (N, C)
+        per_class_total = torch.einsum('kln,nc->klc', test.expand(-1, n_lambdas, -1), class_onehot)
+        per_class_correct = torch.einsum('kln,nc->klc', correct * test, class_onehot)
+        present = per_class_total > 0
+        recall = torch.where(present, per_class_correct / per_class_total.clamp(min=1), torch.zeros_like(per_class_total))
+        return {'accuracy': (correct * test).sum(dim=-1) / n_test,
+                'balanced_accuracy': recall.sum(dim=-1) / present.sum(dim=-1).clamp(min=1),
+                'nll': (nll * test).sum(dim=-1) / n_test,
+                'grad_norm': grad_norm.view(n_folds, n_lambdas)}
+
+
+def _embedding_sources(embeddings):
+    #{name: (halo_ids, (N, D) array)} from store names, EmbeddingStores or (halo_ids, array) pairs
+    if isinstance(embeddings, (str, EmbeddingStore)):
+        embeddings = [embeddings]
+    if not isinstance(embeddings, dict):
+        embeddings = {source if isinstance(source, str) else source.name: source for source in embeddings}
+    sources = {}
+    for name, source in embeddings.items():
+        if isinstance(source, str):
+            source = EmbeddingStore(source)
+        if isinstance(source, EmbeddingStore):
+            source = (source.halo_ids, np.asarray(source.embeddings))
+        sources[name] = source
+    return sources
+
+
+def probe_suite(embeddings, targets, classification_targets=None, n_folds=5, seeds=(0,),
+                ridge_lambdas=(1e-4, 1e-3, 1e-2, 1e-1, 1.0), logistic_lambdas=(1e-4, 1e-3, 1e-2),
+                logistic_max_iter=100, device='cpu'):
+    """
+    Score every embedding on every target with k-fold ridge and logistic probes.
+
+    Parameters:
+    embeddings (str, EmbeddingStore, list or dict): Embedding store name(s) in results/embeddings/, stores, or
+        {name: (halo_ids, (N, D) array)}.
+    targets (DataFrame): Targets indexed by halo id, e.g. catalog_targets(subhalos_df, subhalos_mass_history).
+    classification_targets (list): Integer class-label columns probed with logistic regression, default
+        ['mass_class']; all other columns are probed with ridge regression.
+    n_folds (int): Number of folds.
+    seeds (list): One k-fold split per seed (repeated k-fold).
+    ridge_lambdas, logistic_lambdas (list): Penalties tried, all are reported and the best by mean score is flagged.
+    logistic_max_iter (int): L-BFGS iterations of the logistic probes.
+    device (str): Device for the solves.
+
+    Returns:
+    DataFrame: One row per (embedding, target, probe, lambda): mean and std over folds and seeds of r2/rmse (ridge)
+    or accuracy/balanced_accuracy/nll and the final L-BFGS gradient norm (logistic), number of halos, and `best`.
+    """
+    if classification_targets is None:
+        #only mass_class: other integer columns (e.g. particle counts) are quantities, not class labels
+        classification_targets = [column for column in ('mass_class',) if column in targets.columns]
+    regression_targets = [column for column in targets.columns if column not in classification_targets]
+
+    rows = []
+    for name, (halo_ids, values) in _embedding_sources(embeddings).items():
+        t0 = time.perf_counter()
+        common = pd.Index(halo_ids).isin(targets.index)
+        values = np.asarray(values)[common]
+        halo_ids = np.asarray(halo_ids)[common]
+        target_values = targets.loc[halo_ids]
+
+        x = torch.as_tensor(values, dtype=torch.float64, device=device)
+        x = (x - x.mean(dim=0)) / x.std(dim=0).clamp(min=1e-8)
+        x = torch.cat([x, torch.ones(len(x), 1, dtype=x.dtype, device=device)], dim=1)
+        y_regression = torch.as_tensor(target_values[regression_targets].to_numpy(dtype=float), device=device)
+
+        scores = {}
+        for seed in seeds:
+            fold = kfold_ids(len(x), n_folds, seed).to(device)
+            if regression_targets:
+                ridge = ridge_probes(x, y_regression, fold, n_folds, ridge_lambdas)
+                for t, column in enumerate(regression_targets):
+                    for l, lam in enumerate(ridge_lambdas):
+                        key = (column, 'ridge', lam)
+                        scores.setdefault(key, {'r2': [], 'rmse': []})
+                        scores[key]['r2'].extend(ridge['r2'][:, l, t].tolist())
+                        scores[key]['rmse'].extend(ridge['rmse'][:, l, t].tolist())
+            for column in classification_targets:
+                labels = torch.as_tensor(target_values[column].fillna(-1).to_numpy(dtype=np.int64), device=device)
+                logistic = logistic_probes(x.float(), labels, fold, n_folds, logistic_lambdas, max_iter=logistic_max_iter)
+                for l, lam in enumerate(logistic_lambdas):
+                    key = (column, 'logistic', lam)
+                    scores.setdefault(key, {'accuracy': [], 'balanced_accuracy': [], 'nll': [], 'grad_norm': []})
+                    for metric in scores[key]:
+                        scores[key][metric].extend(logistic[metric][:, l].tolist())
+
+        for (column, probe, lam), metrics in scores.items():
+            row = {'embedding': name, 'target': column, 'probe': probe, 'lambda': lam,
+                   'n_halos': len(x), 'dim': x.shape[1] - 1}
+            for metric, values_ in metrics.items():
+                row[metric] = np.mean(values_)
+                row[metric + '_std'] = np.std(values_)
+            rows.append(row)
+        print(f"Probes of {name}: {len(x)} halos, {len(scores)} (target, penalty) pairs, {time.perf_counter() - t0:.1f} s")
+
+    table = pd.DataFrame(rows)
+    if len(table):
+        table['score'] = table['r2'] if 'r2' in table else np.nan
+        if 'accuracy' in table:
+            table['score'] = table['score'].fillna(table['accuracy'])
+        best = table.groupby(['embedding', 'target'])['score'].transform('max')
+        table['best'] = table['score'] == best
+    return table
@@ -0,0 +1,379 @@
+import pandas as pd
+import torch
+import numpy as np
+import hashlib
+import os
+
+from self_supervised_halos.utils.utils import res_path
+from self_supervised_halos.scripts.embeddings import EmbeddingStore
+similarity_index_path = res_path + 'similarity_index/'
+
+
+#Nearest neighbours of halos in embedding space. Exact search is a blocked matmul with a running top-k (fine up to
+#~1e5-1e6 halos on CPU). For larger catalogs the index can be trained as IVF-PQ: vectors are assigned to coarse
+#k-means cells and their residuals compressed to m one-byte codes; a query scans only the nprobe closest cells with
+#per-cell distance lookup tables and re-ranks the best candidates with the exact vectors. Queries are processed in
+#blocks: the lookup tables of a whole block are one batched product, and the codes of all (query, probed cell) pairs
+#are scored with a single gather.
+
+
+def _sq_norms(x):
+    return (x * x).sum(dim=1)
+
+
+def _pairwise_sq_dist(a, b):
+    return (_sq_norms(a)[:, None] - 2 * a @ b.T + _sq_norms(b)[None, :]).clamp_(min=0)
+
+
+def kmeans(x, n_clusters, n_iter=20, seed=0, block_size=65536):
+    """
+    Lloyd k-means on the rows of x.
+
+    Parameters:
+    x (torch.Tensor): (N, D) data.
+    n_clusters (int): Number of centroids, at most len(x).
+    n_iter (int): Number of iterations.
+    seed (int): Seed of the initial centroids (random rows).
+    block_size (int): Rows assigned at once.
+
+    Returns:
+    torch.Tensor: (n_clusters, D) centroids.
+    """
+    if n_clusters > len(x):
+        raise ValueError(f"k-means with {n_clusters} centroids needs at least as many training vectors, got {len(x)}")
+    generator = torch.Generator().manual_seed(seed)
+    centroids = x[torch.randperm(len(x), generator=generator)[:n_clusters]].clone()
+    for _ in range(n_iter):
+        assign = assign_clusters(x, centroids, block_size)
+        sums = torch.zeros_like(centroids).index_add_(0, assign, x)
+        counts = torch.bincount(assign, minlength=n_clusters).float()
+        empty = counts == 0
+        centroids = torch.where(empty[:, None], centroids, sums / counts.clamp(min=1)[:, None])
+    return centroids
+
+
+def assign_clusters(x, centroids, block_size=65536):
+    return torch.cat([_pairwise_sq_dist(x[i:i + block_size], centroids).argmin(dim=1)
+                      for i in range(0, len(x), block_size)])
+
+
+def vectors_hash(vectors):
+    #fingerprint of an embedding matrix, 16 hex digits
+    return hashlib.blake2b(vectors.detach().cpu().contiguous().numpy().tobytes(), digest_size=8).hexdigest()
+
+
+class SimilarityIndex:
+    """
+    Nearest-neighbour index over halo embeddings.
+
+    embeddings: (N, D) array or tensor, halo_ids: (N,) ids of the rows.
+    metric: 'cosine' (scores are cosine similarities) or 'l2' (scores are negative squared distances).
+    catalog: DataFrame indexed by halo id (e.g. subhalos_df) for the `where` filters of search.
+    """
+    def __init__(self, embeddings, halo_ids, metric='cosine', catalog=None, block_size=65536):
+        if metric not in ('cosine', 'l2'):
+            raise ValueError(f"Unknown metric {metric}")
+        self.metric = metric
+        self.halo_ids = np.asarray(halo_ids, dtype=np.int64)
+        self.rows = {halo_id: row for row, halo_id in enumerate(self.halo_ids.tolist())}
+        self.vectors = self._prepare(torch.as_tensor(np.asarray(embeddings), dtype=torch.float32))
+        self.catalog = catalog
+        self.block_size = block_size
+        self.store_name = None
+        self.ivf = None
+
+    @classmethod
+    def from_store(cls, store, metric='cosine', catalog=None, **kwargs):
+        #store: EmbeddingStore or its name
+        store = EmbeddingStore(store) if isinstance(store, str) else store
+        index = cls(store.embeddings, store.halo_ids, metric=metric, catalog=catalog, **kwargs)
+        index.store_name = store.name
+        return index
+
+    def _prepare(self, x):
+        if self.metric == 'cosine':
+            return torch.nn.functional.normalize(x, dim=1)
+        return x
+
+    def __len__(self):
+        return len(self.halo_ids)
+
+    def filter_mask(self, where):
+        #where: boolean array over the rows, or {column: (min, max)} / {column: value or list of values} on the catalog
+        if where is None:
+            return None
+        if not isinstance(where, dict):
+            return np.asarray(where, dtype=bool)
+        if self.catalog is None:
+            raise ValueError("Filters on catalog columns need a catalog")
+        catalog = self.catalog.reindex(self.halo_ids)
+        mask = np.ones(len(self), dtype=bool)
+        for column, condition in where.items():
+            values = catalog[column].to_numpy()
+            if isinstance(condition, tuple):
+                low, high = condition
+                if low is not None:
+                    mask &= values >= low
+                if high is not None:
+                    mask &= values <= high
+            elif isinstance(condition, (list, set, np.ndarray)):
+                mask &= np.isin(values, list(condition))
+            else:
+                mask &= values == condition
+        return mask
+
+    def search(self, queries, k=10, where=None, exact=None, nprobe=8, refine=4, exclude=None):
+        """
+        k nearest neighbours of a batch of query embeddings.
+
+        Parameters:
+        queries (array or torch.Tensor): (Q, D) embeddings.
+        k (int): Number of neighbours.
+        where: Filter, see filter_mask.
+        exact (bool): Exact search; by default exact unless the IVF-PQ index has been trained.
+        nprobe (int): IVF cells scanned per query (approximate mode).
+        refine (int): Approximate mode: the k*refine best PQ candidates are re-ranked with the exact vectors.
+        exclude (array): (Q,) row of each query to drop from its results (searching by halo id).
+
+        Returns:
+        tuple: (scores (Q, k), halo ids (Q, k)); missing neighbours (too few rows pass the filter) have id -1.
+        """
+        queries = self._prepare(torch.as_tensor(np.asarray(queries), dtype=torch.float32).reshape(-1, self.vectors.shape[1]))
+        mask = self.filter_mask(where)
+        if exact is None:
+            exact = self.ivf is None
+        k_search = k + (exclude is not None)
+        if exact:
+            scores, rows = self._search_exact(queries, k_search, mask)
+        else:
+            scores, rows = self._search_ivf(queries, k_search, mask, nprobe, refine)
+        if exclude is not None:
+            scores, rows = self._drop_rows(scores, rows, np.asarray(exclude), k)
+        ids = np.where(rows >= 0, self.halo_ids[np.clip(rows, 0, None)], -1)
+        return scores, ids
+
+    def search_ids(self, halo_ids, k=10, **kwargs):
+        #neighbours of halos that are in the index, the halo itself is excluded
+        rows = np.array([self.rows[int(halo_id)] for halo_id in halo_ids])
+        return self.search(self.vectors[rows], k=k, exclude=rows, **kwargs)
+
+    def _scores(self, queries, vectors):
+        if self.metric == 'cosine':
+            return queries @ vectors.T
+        return -_pairwise_sq_dist(queries, vectors)
+
+    def _search_exact(self, queries, k, mask=None):
+        #blocked matmul over the rows with a running top-k, memory O(Q * block_size)
+        candidates = torch.arange(len(self)) if mask is None else torch.from_numpy(np.flatnonzero(mask))
+        best_scores = torch.full((len(queries), 0), -float('inf'))
+        best_rows = torch.zeros((len(queries), 0), dtype=torch.long)
+        for start in range(0, len(candidates), self.block_size):
+            block = candidates[start:start + self.block_size]
+            scores = self._scores(queries, self.vectors[block])
+            scores = torch.cat([best_scores, scores], dim=1)
+            rows = torch.cat([best_rows, block.expand(len(queries), -1)], dim=1)
+            best_scores, top = scores.topk(min(k, scores.shape[1]), dim=1)
+            best_rows = rows.gather(1, top)
+        return self._pad(best_scores, best_rows, k)
+
+    def _pad(self, scores, rows, k):
+        scores, rows = scores.numpy(), rows.numpy()
+        if scores.shape[1] < k:
+            n_pad = k - scores.shape[1]
+            scores = np.pad(scores, ((0, 0), (0, n_pad)), constant_values=-np.inf)
+            rows = np.pad(rows, ((0, 0), (0, n_pad)), constant_values=-1)
+        return scores, rows
+
+    def _drop_rows(self, scores, rows, exclude, k):
+        keep = rows != exclude[:, None]
+        #keep the first k entries that are not the query itself
+        order = np.argsort(~keep, axis=1, kind='stable')[:, :k]
+        return np.take_along_axis(scores, order, 1), np.take_along_axis(rows, order, 1)
+
+    def train_ivf(self, n_lists=None, n_subquantizers=8, n_iter=20, n_train=None, seed=0):
+        """
+        Build the approximate IVF-PQ index.
+
+        Parameters:
+        n_lists (int): Number of coarse cells, by default ~4*sqrt(N).
+        n_subquantizers (int): Number of PQ codes per vector (one byte each), must divide the embedding dimension.
+        n_iter (int): k-means iterations.
+        n_train (int): Vectors used to train the quantizers, by default all (at most 256 per centroid). With fewer
+            than 256 training vectors the codebooks (and n_lists) are reduced to n_train centroids.
+        seed (int): Seed of the training sample and the k-means initialization.
+        """
+        n, dim = self.vectors.shape
+        if dim % n_subquantizers:
+            raise ValueError(f"n_subquantizers={n_subquantizers} must divide the embedding dimension {dim}")
+        n_lists = n_lists or max(1, int(4 * np.sqrt(n)))
+        n_train = min(n, n_train or 256 * max(n_lists, 256))
+        n_lists = min(n_lists, n_train)
+        n_codewords = min(256, n_train)
+        if n_codewords < 256:
+            print(f"Only {n_train} training vectors, using {n_codewords} PQ codewords instead of 256")
+        generator = torch.Generator().manual_seed(seed)
+        train = self.vectors[torch.randperm(n, generator=generator)[:n_train]]
+
+        coarse = kmeans(train, n_lists, n_iter=n_iter, seed=seed)
+        dsub = dim // n_subquantizers
+        train_residuals = (train - coarse[assign_clusters(train, coarse)]).view(-1, n_subquantizers, dsub)
+        codebooks = torch.stack([kmeans(train_residuals[:, j], n_codewords, n_iter=n_iter, seed=seed + j)
+                                 for j in range(n_subquantizers)]) # (m, n_codewords, dsub)
+
+        assign, codes = self._encode(self.vectors, coarse, codebooks)
+
+        #inverted lists: rows sorted by cell, cell l holds order[offsets[l]:offsets[l+1]]
+        order = torch.argsort(assign, stable=True)
+        offsets = torch.zeros(n_lists + 1, dtype=torch.long)
+        offsets[1:] = torch.cumsum(torch.bincount(assign, minlength=n_lists), 0)
+        self.ivf = {'coarse': coarse, 'codebooks': codebooks, 'order': order, 'offsets': offsets,
+                    'codes': codes[order], 'list_of_row': assign}
+        print(f"IVF-PQ index: {n_lists} lists, {n_subquantizers} bytes per vector, trained on {n_train} vectors")
+
+    def _encode(self, vectors, coarse, codebooks):
+        #coarse cell and PQ codes of the residual of every vector
+        m, _, dsub = codebooks.shape
+        assign = assign_clusters(vectors, coarse, self.block_size)
+        codes = torch.empty((len(vectors), m), dtype=torch.uint8)
+        for start in range(0, len(vectors), self.block_size):
+            residuals = (vectors[start:start + self.block_size] - coarse[assign[start:start + self.block_size]])
+            residuals = residuals.view(-1, m, dsub)
+            codes[start:start + self.block_size] = torch.stack(
+                [_pairwise_sq_dist(residuals[:, j], codebooks[j]).argmin(dim=1) for j in range(m)], dim=1).to(torch.uint8)
+        return assign, codes
+
+    def add(self, embeddings, halo_ids):
+        """
+        Append halos to the index.
+
+        With a trained IVF-PQ index the new vectors are encoded with the existing quantizers and appended to the end
+        of their inverted lists, nothing is retrained. Retrain (train_ivf) once the added halos are no longer
+        represented by the training sample.
+
+        Parameters:
+        embeddings (array or torch.Tensor): (Q, D) embeddings.
+        halo_ids (array): (Q,) ids of the new rows.
+        """
+        vectors = self._prepare(torch.as_tensor(np.asarray(embeddings), dtype=torch.float32).reshape(-1, self.vectors.shape[1]))
+        halo_ids = np.asarray(halo_ids, dtype=np.int64)
+        n_old = len(self)
+        self.rows.update({halo_id: n_old + row for row, halo_id in enumerate(halo_ids.tolist())})
+        self.halo_ids = np.concatenate([self.halo_ids, halo_ids])
+        self.vectors = torch.cat([self.vectors, vectors])
+        self.store_name = None #the index no longer matches the store, save() keeps the vectors
+        if self.ivf is None:
+            return
+        ivf = self.ivf
+        assign, codes = self._encode(vectors, ivf['coarse'], ivf['codebooks'])
+        #old entries are already sorted by cell, a stable sort puts the new ones at the end of each list
+        list_of_position = torch.cat([ivf['list_of_row'][ivf['order']], assign])
+        merge = torch.argsort(list_of_position, stable=True)
+        ivf['order'] = torch.cat([ivf['order'], n_old + torch.arange(len(vectors))])[merge]
+        ivf['codes'] = torch.cat([ivf['codes'], codes])[merge]
+        ivf['list_of_row'] = torch.cat([ivf['list_of_row'], assign])
+        ivf['offsets'][1:] = torch.cumsum(torch.bincount(ivf['list_of_row'], minlength=len(ivf['coarse'])), 0)
+
+    def _search_ivf(self, queries, k, mask, nprobe, refine):
+        if not len(queries):
+            return self._pad(torch.empty((0, 0)), torch.empty((0, 0), dtype=torch.long), k)
+        coarse = self.ivf['coarse']
+        nprobe = min(nprobe, len(coarse))
+        #queries per block so that a block scans (and holds lookup-table entries for) about 32 * block_size codes
+        m, n_codewords, _ = self.ivf['codebooks'].shape
+        list_size = max(1, len(self) // len(coarse), m * n_codewords)
+        query_block = max(1, 32 * self.block_size // (nprobe * list_size))
+        mask = torch.from_numpy(mask) if mask is not None else None
+        results = [self._search_ivf_block(queries[start:start + query_block], k, mask, nprobe, refine)
+                   for start in range(0, len(queries), query_block)]
+        width = min(k, max(scores.shape[1] for scores, _ in results))
+        scores = torch.cat([torch.nn.functional.pad(s, (0, width - s.shape[1]), value=-float('inf')) for s, _ in results])
+        rows = torch.cat([torch.nn.functional.pad(r, (0, width - r.shape[1]), value=-1) for _, r in results])
+        return self._pad(scores, rows, k)
+
+    def _search_ivf_block(self, queries, k, mask, nprobe, refine):
+        ivf = self.ivf
+        coarse, codebooks, offsets = ivf['coarse'], ivf['codebooks'], ivf['offsets']
+        m, n_codewords, dsub = codebooks.shape
+        n_queries = len(queries)
+        probes = _pairwise_sq_dist(queries, coarse).topk(nprobe, dim=1, largest=False).indices # (Q, nprobe)
+
+        #distance tables of every query residual to every codeword: (Q * nprobe, m, n_codewords)
+        residuals = (queries[:, None, :] - coarse[probes]).view(n_queries * nprobe, m, dsub)
+        luts = ((residuals * residuals).sum(dim=-1, keepdim=True) - 2 * torch.einsum('pjd,jcd->pjc', residuals, codebooks)
+                + (codebooks * codebooks).sum(dim=-1)[None])
+
+        #all codes of the probed cells, pair p = q * nprobe + probe; sorted by query
+        lists = probes.reshape(-1)
+        sizes = offsets[lists + 1] - offsets[lists]
+        pair = torch.repeat_interleave(torch.arange(len(lists)), sizes)
+        first = torch.cumsum(sizes, 0) - sizes
+        positions = offsets[lists][pair] + torch.arange(len(pair)) - first[pair]
+        rows = ivf['order'][positions]
+        if mask is not None:
+            keep = mask[rows]
+            positions, rows, pair = positions[keep], rows[keep], pair[keep]
+        codes = ivf['codes'][positions].long()
+        approx = luts[pair[:, None], torch.arange(m)[None, :], codes].sum(dim=1)
+
+        #per-query candidate lists padded to the longest one
+        query_of = pair // nprobe
+        counts = torch.bincount(query_of, minlength=n_queries)
+        width = int(counts.max()) if len(counts) else 0
+        slot = torch.arange(len(pair)) - (torch.cumsum(counts, 0) - counts)[query_of]
+        padded = torch.full((n_queries, width), float('inf'))
+        padded[query_of, slot] = approx
+        padded_rows = torch.full((n_queries, width), -1, dtype=torch.long)
+        padded_rows[query_of, slot] = rows
+
+        n_candidates = min(width, k * max(refine, 1))
+        approx, top = padded.topk(n_candidates, dim=1, largest=False)
+        candidates = padded_rows.gather(1, top)
+        valid = candidates >= 0
+        if refine:
+            vectors = self.vectors[candidates.clamp(min=0)]
+            if self.metric == 'cosine':
+                scores = (vectors * queries[:, None, :]).sum(dim=-1)
+            else:
+                scores = -((vectors - queries[:, None, :]) ** 2).sum(dim=-1)
+        else:
+            scores = -approx
+            if self.metric == 'cosine':
+                scores = 1 + scores / 2 #unit vectors: cos = 1 - d^2/2
+        scores = scores.masked_fill(~valid, -float('inf'))
+        scores, top = scores.topk(min(k, n_candidates), dim=1)
+        return scores, candidates.gather(1, top)
+
+    def save(self, name):
+        #embeddings of an index built from a store are not duplicated, they are read back from the store
+        os.makedirs(similarity_index_path, exist_ok=True)
+        state = {'metric': self.metric, 'halo_ids': self.halo_ids, 'store_name': self.store_name,
+                 'vectors': None if self.store_name else self.vectors, 'vectors_hash': vectors_hash(self.vectors),
+                 'ivf': self.ivf, 'block_size': self.block_size}
+        filename = similarity_index_path + name + '.pth'
+        torch.save(state, filename + '.tmp')
+        os.replace(filename + '.tmp', filename)
+
+    @classmethod
+    def load(cls, name, catalog=None):
+        state = torch.load(similarity_index_path + name + '.pth', weights_only=False)
+        if state['store_name']:
+            store = EmbeddingStore(state['store_name'])
+            if not np.array_equal(store.halo_ids, state['halo_ids']):
+                raise ValueError(f"Embedding store {state['store_name']} changed since the index was built, rebuild it")
+            index = cls.from_store(store, metric=state['metric'], catalog=catalog, block_size=state['block_size'])
+            #same halos but recomputed embeddings (e.g. a new checkpoint) would silently invalidate the IVF codes
+            if state.get('vectors_hash') != vectors_hash(index.vectors):
+                raise ValueError(f"Embeddings in store {state['store_name']} changed since the index was built, rebuild it")
+        else:
+            index = cls(state['vectors'], state['halo_ids'], metric=state['metric'], catalog=catalog, block_size=state['block_size'])
+        index.ivf = state['ivf']
+        return index
+
+    def neighbours_dataframe(self, halo_ids, k=10, **kwargs):
+        #long table (halo_id, rank, neighbour_id, score), with catalog columns of the neighbours if there is a catalog
+        scores, ids = self.search_ids(halo_ids, k=k, **kwargs)
+        df = pd.DataFrame({'halo_id': np.repeat(np.asarray(halo_ids), k), 'rank': np.tile(np.arange(1, k + 1), len(halo_ids)),
+                           'neighbour_id': ids.ravel(), 'score': scores.ravel()})
+        if self.catalog is not None:
+            df = df.join(self.catalog, on='neighbour_id')
+        return df
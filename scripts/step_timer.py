@@ -0,0 +1,168 @@
+import torch
+import numpy as np
+import pandas as pd
+import time
+import os
+import resource
+import threading
+from contextlib import nullcontext
+
+
+_null_phase = nullcontext()
+
+
+def batch_size_of(batch):
+    #first dimension of the first tensor/array found in a (nested) batch
+    if isinstance(batch, (torch.Tensor, np.ndarray)):
+        return batch.shape[0]
+    if isinstance(batch, (list, tuple)):
+        for item in batch:
+            size = batch_size_of(item)
+            if size:
+                return size
+    return 0
+
+
+def peak_memory_mb(device):
+    if str(device).startswith('cuda') and torch.cuda.is_available():
+        return torch.cuda.max_memory_allocated() / 2**20
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 2**10 #linux reports kB
+
+
+class _Phase:
+    def __init__(self, timer, name):
+        self.timer = timer
+        self.name = name
+
+    def __enter__(self):
+        self.timer._sync()
+        self.timer._stack.append([self.name, time.perf_counter(), 0.0])
+        return self
+
+    def __exit__(self, *exc):
+        self.timer._sync()
+        name, start, child_time = self.timer._stack.pop()
+        elapsed = time.perf_counter() - start
+        #phases are exclusive: time of nested phases is not counted twice
+        self.timer._current[name] = self.timer._current.get(name, 0.0) + elapsed - child_time
+        if self.timer._stack:
+            self.timer._stack[-1][2] += elapsed
+        return False
+
+
+class StepTimer:
+    """
+    Per-step timing of the training loop phases (data, to_device, transform, forward, backward, optimizer),
+    samples/sec and peak memory, with an optional torch.profiler trace for a window of steps.
+    When disabled, phase() returns a shared no-op context manager and iterate() yields from the loader directly.
+    """
+    def __init__(self, enabled=False, device='cpu', profile_steps=None, profile_dir=None):
+        self.reset(enabled=enabled, device=device, profile_steps=profile_steps, profile_dir=profile_dir)
+
+    def reset(self, enabled=False, device='cpu', profile_steps=None, profile_dir=None):
+        self.enabled = enabled
+        self.device = device
+        self.profile_steps = profile_steps #(first_step, last_step), global step indices, inclusive
+        self.profile_dir = profile_dir
+        self.steps = []
+        self.global_step = 0
+        self._stack = []
+        self._current = {}
+        self._step_start = None
+        self._profiler = None
+        self._thread = threading.get_ident() #phases are only recorded on the training thread, not in prefetch threads
+
+    def _sync(self):
+        if str(self.device).startswith('cuda') and torch.cuda.is_available():
+            torch.cuda.synchronize()
+
+    def phase(self, name):
+        if not self.enabled or threading.get_ident() != self._thread:
+            return _null_phase
+        return _Phase(self, name)
+
+    def iterate(self, loader, epoch=0):
+        if not self.enabled:
+            yield from loader
+            return
+        iterator = iter(loader)
+        while True:
+            self._begin_step()
+            try:
+                with self.phase('data'):
+                    batch = next(iterator)
+            except StopIteration:
+                self._current = {}
+                if self._profiler is not None and self.global_step == self.profile_steps[0]:
+                    #started for a step that never came, nothing to save
+                    self._profiler.__exit__(None, None, None)
+                    self._profiler = None
+                return
+            yield batch
+            self._end_step(batch_size_of(batch), epoch)
+
+    def _begin_step(self):
+        self._current = {}
+        self._step_start = time.perf_counter()
+        if self.profile_steps and self.global_step == self.profile_steps[0]:
+            self._profiler = torch.profiler.profile(
+                activities=[torch.profiler.ProfilerActivity.CPU] +
+                           ([torch.profiler.ProfilerActivity.CUDA] if torch.cuda.is_available() else []),
+                record_shapes=True, profile_memory=True)
+            self._profiler.__enter__()
+
+    def _end_step(self, n_samples, epoch):
+        self._sync()
+        step_time = time.perf_counter() - self._step_start
+        record = {'epoch': epoch, 'step': self.global_step, 'n_samples': n_samples,
+                  'step_time': step_time,
+                  'samples_per_sec': n_samples / step_time if step_time > 0 else np.nan,
+                  'peak_mem_mb': peak_memory_mb(self.device)}
+        record.update({f'time_{name}': value for name, value in self._current.items()})
+        self.steps.append(record)
+
+        if self._profiler is not None and self.global_step == self.profile_steps[1]:
+            self._stop_profiler(self.global_step)
+        self.global_step += 1
+
+    def _stop_profiler(self, last_step):
+        self._profiler.__exit__(None, None, None)
+        profile_dir = self.profile_dir or '.'
+        os.makedirs(profile_dir, exist_ok=True)
+        trace_file = os.path.join(profile_dir, f'trace_steps_{self.profile_steps[0]}_{last_step}.json')
+        self._profiler.export_chrome_trace(trace_file)
+        print(f"Profiler trace saved to {trace_file}")
+        print(self._profiler.key_averages().table(sort_by='self_cpu_time_total', row_limit=15))
+        self._profiler = None
+
+    def close(self):
+        #end of training: a profiler window reaching past the last step is stopped and its trace saved
+        if self._profiler is not None:
+            if self.global_step > self.profile_steps[0]:
+                self._stop_profiler(self.global_step - 1)
+            else:
+                self._profiler.__exit__(None, None, None)
+                self._profiler = None
+
+    def to_dataframe(self):
+        return pd.DataFrame(self.steps)
+
+    def epoch_summary(self, epoch):
+        #mean over the steps of an epoch; samples_per_sec is total samples / total step time
+        steps = [s for s in self.steps if s['epoch'] == epoch]
+        if not steps:
+            return {}
+        df = pd.DataFrame(steps)
+        summary = {col: df[col].mean() for col in df.columns if col.startswith('time_') or col == 'step_time'}
+        summary['samples_per_sec'] = df['n_samples'].sum() / df['step_time'].sum()
+        summary['peak_mem_mb'] = df['peak_mem_mb'].max()
+        return summary
+
+    def export(self, filename):
+        #.json or .csv, per-step records
+        df = self.to_dataframe()
+        if filename.endswith('.json'):
+            df.to_json(filename, orient='records', indent=1)
+        else:
+            df.to_csv(filename, index=False)
+        print(f"Step timing saved to {filename}")
@@ -0,0 +1,184 @@
+import pandas as pd
+import numpy as np
+import torch
+import time
+import os
+import math
+import itertools
+
+import torch.multiprocessing as mp
+from torch.utils.data import DataLoader
+
+from self_supervised_halos.utils.utils import res_path
+sweeps_path = res_path + 'sweeps/'
+
+
+#Hyperparameter sweeps over BaseModel subclasses without a copy of the training script per run.
+#The dataset is loaded once (HaloDataset.share_memory) and handed to a pool of worker processes,
+#each trial runs with its own torch thread budget and all results go to one table.
+
+
+def expand_grid(grid):
+    #{'lr': [1e-3, 1e-2], 'batch_size': [64]} -> [{'lr': 1e-3, 'batch_size': 64}, {'lr': 1e-2, 'batch_size': 64}]
+    keys = list(grid.keys())
+    return [dict(zip(keys, values)) for values in itertools.product(*[grid[key] for key in keys])]
+
+
+_worker_data = {}
+
+
+def _init_worker(train_ds, val_ds, threads_per_trial):
+    #runs once per worker process: datasets arrive as shared-memory tensors
+    torch.set_num_threads(threads_per_trial)
+    _worker_data['train_ds'] = train_ds
+    _worker_data['val_ds'] = val_ds
+
+
+def _run_trial(build_model, trial_id, params, num_epochs, state_file, device, seed):
+    params = dict(params)
+    batch_size = params.pop('batch_size', 128)
+    torch.manual_seed(seed + trial_id)
+    np.random.seed(seed + trial_id)
+
+    model = build_model(**params)
+    model.model.to(device)
+    if os.path.exists(state_file):
+        #continuation of a trial promoted to the next rung of successive halving
+        checkpoint = torch.load(state_file)
+        model.eager_model.load_state_dict(checkpoint['model_state_dict'])
+        model.optimizer.load_state_dict(checkpoint['optimizer_state_dict'])
+        if model.scheduler:
+            model.scheduler.load_state_dict(checkpoint['scheduler_state_dict'])
+        model.history = checkpoint['history']
+
+    train_loader = DataLoader(_worker_data['train_ds'], batch_size=batch_size, shuffle=True)
+    val_ds = _worker_data['val_ds']
+    val_loader = DataLoader(val_ds, batch_size=batch_size, shuffle=False) if val_ds is not None else None
+
+    t0 = time.time()
+    model.training_loop(train_loader, val_loader, num_epochs=num_epochs, device=device)
+    elapsed = time.time() - t0
+
+    torch.save({
+        'model_state_dict': model.eager_model.state_dict(),
+        'optimizer_state_dict': model.optimizer.state_dict(),
+        'scheduler_state_dict': model.scheduler.state_dict() if model.scheduler else None,
+        'history': model.history,
+    }, state_file)
+
+    history = model.history
+    row = {'trial': trial_id, **params, 'batch_size': batch_size,
+           'epochs': len(history['train_loss']), 'train_loss': history['train_loss'][-1],
+           'learning_rate': history['learning_rate'][-1], 'time_s': elapsed}
+    if history['val_loss']:
+        row['val_loss'] = history['val_loss'][-1]
+        row['best_val_loss'] = min(history['val_loss'])
+    return row
+
+
+class Sweep:
+    """
+    Run a hyperparameter grid concurrently.
+
+    build_model: module-level function (it is pickled to the workers) taking the grid parameters
+        except 'batch_size' as keyword arguments and returning a BaseModel subclass instance.
+    grid: dict of lists, see expand_grid; 'batch_size' is used for the DataLoaders.
+    train_ds, val_ds: datasets (or random_split subsets) of a HaloDataset, call dataset.share_memory() first.
+    n_workers, threads_per_trial: concurrent trials and torch threads of each; by default the cores are split evenly.
+    halving_eta: if set, successive halving: all trials train for min_epochs, the best 1/eta of them
+        continue to min_epochs*eta epochs, and so on until num_epochs.
+    """
+    def __init__(self, build_model, grid, train_ds, val_ds=None,
+                 num_epochs=5, n_workers=4, threads_per_trial=None,
+                 halving_eta=None, min_epochs=1, metric='val_loss',
+                 device='cpu', seed=42, name='sweep'):
+        self.build_model = build_model
+        self.trials = expand_grid(grid)
+        self.train_ds = train_ds
+        self.val_ds = val_ds
+        self.num_epochs = num_epochs
+        self.n_workers = min(n_workers, len(self.trials))
+        self.threads_per_trial = threads_per_trial or max(1, (os.cpu_count() or 1) // self.n_workers)
+        self.halving_eta = halving_eta
+        self.min_epochs = min_epochs
+        self.metric = metric if val_ds is not None else 'train_loss'
+        self.device = device
+        self.seed = seed
+        self.name = name
+        self.state_dir = sweeps_path + name + '/'
+
+    def rung_epochs(self):
+        #cumulative number of epochs at each rung
+        if not self.halving_eta:
+            return [self.num_epochs]
+        epochs = []
+        budget = self.min_epochs
+        while budget < self.num_epochs:
+            epochs.append(budget)
+            budget *= self.halving_eta
+        return epochs + [self.num_epochs]
+
+    def run(self):
+        os.makedirs(self.state_dir, exist_ok=True)
+        for trial_id in range(len(self.trials)):
+            state_file = self._state_file(trial_id)
+            if os.path.exists(state_file):
+                os.remove(state_file) #stale state of a previous sweep with the same name
+
+        ctx = mp.get_context('spawn')
+        rows = []
+        active = list(range(len(self.trials)))
+        done_epochs = 0
+        rungs = self.rung_epochs()
+        with ctx.Pool(self.n_workers, initializer=_init_worker,
+                      initargs=(self.train_ds, self.val_ds, self.threads_per_trial)) as pool:
+            for rung, rung_epochs in enumerate(rungs):
+                print(f"Sweep {self.name}: rung {rung}, {len(active)} trials, {rung_epochs} epochs")
+                jobs = [pool.apply_async(_run_trial, (self.build_model, trial_id, self.trials[trial_id],
+                                                      rung_epochs - done_epochs, self._state_file(trial_id),
+                                                      self.device, self.seed))
+                        for trial_id in active]
+                rung_rows = []
+                for trial_id, job in zip(active, jobs):
+                    try:
+                        row = job.get()
+                    except Exception as e:
+                        print(f"Trial {trial_id} {self.trials[trial_id]} failed: {e}")
+                        row = {'trial': trial_id, **self.trials[trial_id], 'error': str(e)}
+                    row['rung'] = rung
+                    rung_rows.append(row)
+                rows.extend(rung_rows)
+                done_epochs = rung_epochs
+
+                if rung < len(rungs) - 1:
+                    active = self._promote(rung_rows)
+
+        results = pd.DataFrame(rows)
+        last_rung = results.groupby('trial')['rung'].transform('max')
+        results['stopped_early'] = last_rung < len(rungs) - 1
+        self.results = results
+        results.to_csv(sweeps_path + self.name + '.csv', index=False)
+        return results
+
+    def _promote(self, rung_rows):
+        finished = [row for row in rung_rows if not np.isnan(row.get(self.metric, np.nan))]
+        finished.sort(key=lambda row: row[self.metric])
+        n_keep = max(1, math.ceil(len(rung_rows) / self.halving_eta))
+        return sorted(row['trial'] for row in finished[:n_keep])
+
+    def _state_file(self, trial_id):
+        return self.state_dir + f'trial_{trial_id}.pth'
+
+    def best(self):
+        #parameters of the best trial among those that trained for the full number of epochs
+        results = self.results
+        if 'epochs' in results and self.metric in results:
+            final = results[(results['epochs'] == self.num_epochs) & results[self.metric].notna()]
+        else:
+            final = results.iloc[:0] #every trial failed, the result rows only have 'error'
+        if not len(final):
+            failed = results[results['error'].notna()] if 'error' in results else results.iloc[:0]
+            errors = '\n'.join(f"  trial {row['trial']} (rung {row['rung']}): {row['error']}" for _, row in failed.iterrows())
+            raise RuntimeError(f"Sweep {self.name}: no trial finished {self.num_epochs} epochs"
+                               + (f", errors:\n{errors}" if errors else ""))
+        return final.sort_values(self.metric).iloc[0]
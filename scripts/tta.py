@@ -0,0 +1,131 @@
+import pandas as pd
+import torch
+import numpy as np
+from tqdm import tqdm
+import itertools
+import time
+
+from self_supervised_halos.scripts.evaluation import ClassificationEvaluator
+
+
+#Test-time augmentation with exact symmetries (no interpolation): the 8 flips/rotations of the square (D4) for maps,
+#times the three projections when the dataset gives all of them (choose_all_2d=True), and the 24 rotations (48 with
+#reflections) of the cube for 3d. All views of a batch go through the network as one wide batch and the logits
+#are averaged.
+
+
+def d4_views(x):
+    #(B, C, H, W) -> list of 8 tensors
+    views = []
+    for flipped in (x, x.flip(-1)):
+        views.extend(torch.rot90(flipped, k, dims=(-2, -1)) for k in range(4))
+    return views
+
+
+def _permutation_sign(perm):
+    sign = 1
+    for i, j in itertools.combinations(range(len(perm)), 2):
+        if perm[i] > perm[j]:
+            sign = -sign
+    return sign
+
+
+def cube_views(x, reflections=False):
+    #(B, C, D, H, W) -> list of 24 rotations (48 symmetries with reflections): axis permutations times axis flips,
+    #rotations are the combinations with determinant +1
+    views = []
+    for perm in itertools.permutations(range(3)):
+        for flips in itertools.product((False, True), repeat=3):
+            det = _permutation_sign(perm) * (-1) ** sum(flips)
+            if det < 0 and not reflections:
+                continue
+            view = x.permute(0, 1, *(2 + p for p in perm))
+            flip_dims = [2 + i for i, flip in enumerate(flips) if flip]
+            views.append(view.flip(flip_dims) if flip_dims else view)
+    return views
+
+
+def tta_views(x, input_index=0, cube_reflections=False):
+    """
+    Stack the symmetric views of a batch into one wide batch.
+
+    Parameters:
+    x (torch.Tensor): (B, C, H, W) maps, (B, 3, C, H, W) all projections (input_index 0) or (B, C, D, H, W) cubes.
+    input_index (int): 0 - 2d maps, 1 - 3d cubes.
+    cube_reflections (bool): Use all 48 cube symmetries instead of the 24 rotations.
+
+    Returns:
+    tuple: (n_views * B, ...) tensor, view-major, and n_views.
+    """
+    if input_index == 0:
+        projections = x.unbind(dim=1) if x.dim() == 5 else [x]
+        views = [view for projection in projections for view in d4_views(projection)]
+    else:
+        views = cube_views(x, reflections=cube_reflections)
+    return torch.cat(views, dim=0), len(views)
+
+
+def tta_logits(model, x, input_index=0, cube_reflections=False, chunk_size=None):
+    #logits averaged over the views; chunk_size limits the number of samples per forward if memory is short
+    wide, n_views = tta_views(x, input_index, cube_reflections)
+    with model.autocast():
+        if chunk_size:
+            logits = torch.cat([model(chunk).float() for chunk in torch.split(wide, chunk_size)])
+        else:
+            logits = model(wide).float()
+    return logits.view(n_views, x.shape[0], -1).mean(dim=0)
+
+
+def _sync(device):
+    if str(device).startswith('cuda'):
+        torch.cuda.synchronize()
+
+
+def compare_tta(model, dataloader, device='cpu', input_index=0, cube_reflections=False, chunk_size=None):
+    """
+    Evaluate a classifier with and without test-time augmentation in one pass over the loader.
+
+    The plain prediction uses the first projection in its original orientation. Forward time is measured separately
+    for both; data loading is shared and not counted.
+
+    Returns:
+    tuple: (report DataFrame with accuracy, top-k, NLL, ECE and samples/sec of both modes, {'plain': evaluator, 'tta': evaluator})
+    """
+    evaluators = {'plain': ClassificationEvaluator(), 'tta': ClassificationEvaluator()}
+    forward_time = {'plain': 0.0, 'tta': 0.0}
+    n_views = None
+    model.model.eval()
+    with torch.inference_mode():
+        for batch in tqdm(dataloader, desc="TTA evaluation"):
+            inputs, targets = batch
+            x = inputs[input_index].to(device).float()
+            plain_x = x[:, 0] if (input_index == 0 and x.dim() == 5) else x
+
+            _sync(device)
+            t0 = time.perf_counter()
+            with model.autocast():
+                logits = model(plain_x).float()
+            _sync(device)
+            t1 = time.perf_counter()
+            tta = tta_logits(model, x, input_index, cube_reflections, chunk_size)
+            _sync(device)
+            t2 = time.perf_counter()
+
+            forward_time['plain'] += t1 - t0
+            forward_time['tta'] += t2 - t1
+            n_views = n_views or tta_views(x[:1], input_index, cube_reflections)[1]
+            evaluators['plain'].update(logits, targets[1], masses=targets[0], halo_ids=targets[2])
+            evaluators['tta'].update(tta, targets[1], masses=targets[0], halo_ids=targets[2])
+
+    rows = []
+    for mode, evaluator in evaluators.items():
+        results = evaluator.all_reduce().results()
+        rows.append({'mode': mode, 'n_views': 1 if mode == 'plain' else n_views,
+                     'accuracy': results['accuracy'], 'top3_accuracy': results.get('top3_accuracy'),
+                     'balanced_accuracy': results['balanced_accuracy'], 'nll': results['nll'], 'ece': results['ece'],
+                     'samples_per_sec': results['n_samples'] / max(forward_time[mode], 1e-12)})
+    report = pd.DataFrame(rows).set_index('mode')
+    report['accuracy_gain'] = report['accuracy'] - report.loc['plain', 'accuracy']
+    report['relative_cost'] = report.loc['plain', 'samples_per_sec'] / report['samples_per_sec']
+    print(report.to_string())
+    return report, evaluators
@@ -0,0 +1,105 @@
+import torch
+import numpy as np
+import random
+from tqdm import tqdm
+
+from self_supervised_halos.scripts.prefetch import PreparedBatch
+from self_supervised_halos.scripts.checkpoint import get_rng_state, set_rng_state
+
+
+#Fixed validation set for BaseModel.training_loop (see BaseModel.set_validation_cache): the validation loader is
+#augmented once with prepare_batch under a fixed seed, the prepared batches are stored as one tensor block per
+#batch element, and every epoch evaluates on the same views without loading or augmenting anything.
+
+
+class _Leaf:
+    #position of a tensor in the flattened batch
+    def __init__(self, index):
+        self.index = index
+
+
+def _flatten(obj, leaves):
+    if isinstance(obj, torch.Tensor):
+        leaves.append(obj)
+        return _Leaf(len(leaves) - 1)
+    if isinstance(obj, (list, tuple)):
+        return type(obj)(_flatten(item, leaves) for item in obj)
+    return obj
+
+
+def _unflatten(spec, leaves):
+    if isinstance(spec, _Leaf):
+        return leaves[spec.index]
+    if isinstance(spec, (list, tuple)):
+        return type(spec)(_unflatten(item, leaves) for item in spec)
+    return spec
+
+
+class ValidationCache:
+    """
+    Validation loader replacement holding pre-augmented batches.
+
+    Batch boundaries of the original loader are kept (contrastive views are view-major within a batch), so the
+    validation loss is the same average over the same batches as without the cache, only with fixed augmentations.
+    Memory: the whole augmented validation set, e.g. 2 views of 64x64 float32 maps are 32 kB per halo.
+
+    Parameters:
+    loader (DataLoader): Validation loader.
+    prepare_fn (callable): batch -> PreparedBatch, e.g. BaseModel.prepare_batch with the device bound.
+    seed (int): Seed of the augmentations (and of the random projections chosen by HaloDataset).
+    storage_device (str): Where the block is kept, 'cpu' or the training device if it fits.
+    device (str): Device the batches are moved to when iterating.
+    """
+    def __init__(self, loader, prepare_fn, seed=0, storage_device='cpu', device='cpu'):
+        self.loader = loader
+        self.seed = seed
+        self.storage_device = storage_device
+        self.device = device
+        self.batch_size = getattr(loader, 'batch_size', None)
+        self.spec = None
+        self.blocks = []
+        self.offsets = []
+        self._build(prepare_fn)
+
+    def _build(self, prepare_fn):
+        state = get_rng_state()
+        random.seed(self.seed)
+        np.random.seed(self.seed)
+        torch.manual_seed(self.seed) #also seeds CUDA and the DataLoader workers
+        chunks, sizes = None, []
+        try:
+            with torch.no_grad():
+                for batch in tqdm(self.loader, desc="Caching validation views"):
+                    leaves = []
+                    spec = _flatten(tuple(prepare_fn(batch)), leaves)
+                    if self.spec is None:
+                        self.spec = spec
+                        chunks = [[] for _ in leaves]
+                    for chunk, leaf in zip(chunks, leaves):
+                        leaf = leaf.detach().to(self.storage_device)
+                        chunk.append(leaf if leaf.dim() else leaf.unsqueeze(0))
+                    sizes.append([leaf.shape[0] if leaf.dim() else 1 for leaf in leaves])
+        finally:
+            set_rng_state(state)
+        if chunks is None:
+            return
+        self.blocks = [torch.cat(chunk, dim=0) for chunk in chunks]
+        self.offsets = np.concatenate([np.zeros((1, len(chunks)), dtype=np.int64), np.cumsum(sizes, axis=0)])
+        self._scalar = [leaf.dim() == 0 for leaf in leaves]
+
+    @property
+    def nbytes(self):
+        return sum(block.numel() * block.element_size() for block in self.blocks)
+
+    def __len__(self):
+        return len(self.offsets) - 1 if len(self.offsets) else 0
+
+    def __iter__(self):
+        non_blocking = str(self.device).startswith('cuda')
+        for i in range(len(self)):
+            leaves = []
+            for j, block in enumerate(self.blocks):
+                leaf = block[self.offsets[i, j]:self.offsets[i + 1, j]]
+                leaf = leaf[0] if self._scalar[j] else leaf
+                leaves.append(leaf.to(self.device, non_blocking=non_blocking))
+            yield PreparedBatch(_unflatten(self.spec, leaves))
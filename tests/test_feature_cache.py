@@ -0,0 +1,36 @@
+import torch
+
+from self_supervised_halos.scripts.feature_cache import _describe
+
+
+class CropRotation:
+    #plain augmentation object with the default repr, like utils.dataloader.BatchedCropRotation2d
+    def __init__(self, size=64, scale=(0.7, 0.99), degrees=180):
+        self.size = size
+        self.scale = scale
+        self.degrees = degrees
+
+    def __call__(self, x):
+        return x
+
+
+class Compose:
+    def __init__(self, transforms):
+        self.transforms = transforms
+
+    def __call__(self, x):
+        for t in self.transforms:
+            x = t(x)
+        return x
+
+
+def test_identical_transforms_have_the_same_fingerprint():
+    first = Compose([CropRotation(size=64), torch.flip])
+    second = Compose([CropRotation(size=64), torch.flip])
+    assert first is not second
+    assert _describe(first) == _describe(second)
+    assert 'object at 0x' not in str(_describe(first))
+
+
+def test_transform_parameters_change_the_fingerprint():
+    assert _describe(CropRotation(size=64)) != _describe(CropRotation(size=32))
@@ -0,0 +1,50 @@
+import math
+
+import torch
+import torch.nn.functional as F
+
+from self_supervised_halos.scripts.losses import queue_supcon_loss
+
+
+def moco_infonce(query, key, queue, ignore_keys, temperature):
+    #hand-computed MoCo InfoNCE: -log exp(q.k+ / t) / (exp(q.k+ / t) + sum over negatives of exp(q.k- / t)),
+    #negatives are the other batch keys except the ignored one and the queue
+    contrast = torch.cat([key, queue], dim=0)
+    losses = []
+    for i in range(len(query)):
+        positive = math.exp(float(query[i] @ key[i]) / temperature)
+        denominator = 0.0
+        for j in range(len(contrast)):
+            if j == int(ignore_keys[i]):
+                continue
+            denominator += math.exp(float(query[i] @ contrast[j]) / temperature)
+        losses.append(-math.log(positive / denominator))
+    return sum(losses) / len(losses)
+
+
+def test_unlabeled_queue_loss_is_moco_infonce():
+    torch.manual_seed(0)
+    batch_size, dim, temperature = 4, 8, 0.2
+    query = F.normalize(torch.randn(2 * batch_size, dim), dim=1)
+    own_keys = F.normalize(query + 0.05 * torch.randn_like(query), dim=1)
+    #as in ConstrativeLearningModel.momentum_queue_loss: the positive of view 1 is the key of view 2 and vice versa
+    key = torch.roll(own_keys, batch_size, dims=0)
+    queue = F.normalize(torch.randn(16, dim), dim=1)
+    ignore_keys = (torch.arange(2 * batch_size) + batch_size) % (2 * batch_size)
+
+    loss = queue_supcon_loss(query, key, queue=queue, temperature=temperature, base_temperature=temperature,
+                             ignore_keys=ignore_keys)
+    expected = moco_infonce(query, key, queue, ignore_keys, temperature)
+    assert abs(loss.item() - expected) < 1e-5
+
+
+def test_ignored_key_is_not_a_negative():
+    #the own-view key is a near-duplicate of the query: ignoring it must lower the loss
+    torch.manual_seed(0)
+    batch_size, dim = 4, 8
+    query = F.normalize(torch.randn(2 * batch_size, dim), dim=1)
+    key = torch.roll(query, batch_size, dims=0)
+    ignore_keys = (torch.arange(2 * batch_size) + batch_size) % (2 * batch_size)
+    with_duplicate = queue_supcon_loss(query, key)
+    without_duplicate = queue_supcon_loss(query, key, ignore_keys=ignore_keys)
+    assert without_duplicate < with_duplicate
@@ -0,0 +1,22 @@
+import torch
+
+from self_supervised_halos.scripts.probe_suite import batched_lbfgs
+
+
+def test_batched_lbfgs_solves_each_problem():
+    #independent quadratics 0.5 (w - c)^T A (w - c) with curvatures spread over four orders of magnitude:
+    #a shared step size or stopping test would leave the badly scaled problems unconverged
+    torch.manual_seed(0)
+    n_problems, dim = 6, 5
+    scales = torch.logspace(-2, 2, n_problems, dtype=torch.float64)
+    basis = torch.linalg.qr(torch.randn(n_problems, dim, dim, dtype=torch.float64)).Q
+    curvature = basis @ torch.diag_embed(scales[:, None] * torch.linspace(1, 10, dim, dtype=torch.float64)) @ basis.transpose(1, 2)
+    centers = torch.randn(n_problems, dim, dtype=torch.float64)
+
+    def objective(w):
+        diff = w - centers
+        return 0.5 * torch.einsum('bi,bij,bj->b', diff, curvature, diff)
+
+    w, grad_norm = batched_lbfgs(objective, torch.zeros(n_problems, dim, dtype=torch.float64), max_iter=200, tolerance=1e-9)
+    assert torch.allclose(w, centers, atol=1e-6)
+    assert (grad_norm < 1e-8).all()
@@ -35,6 +35,7 @@ class HaloDataset(torch.utils.data.Dataset):
     def __init__(self, root_dir, subhalos_df,
                  load_2d=True, load_3d=False, load_mass=False,
                  choose_two_2d = False,
+                 choose_all_2d = False,
                  DEBUG_LIMIT_FILES=None):
         self.root_dir = root_dir
         self.subhalos_df = subhalos_df
@@ -51,6 +52,7 @@ class HaloDataset(torch.utils.data.Dataset):
         self.load_3d = load_3d
         self.load_mass = load_mass
         self.choose_two_2d = choose_two_2d
+        self.choose_all_2d = choose_all_2d #return all three projections stacked as (3, 1, H, W), for multi-view training
 
 
         self.halos_ids = [int(file.split('_')[-2].split('.')[0]) for file in self.files_2d]
@@ -101,6 +103,39 @@ class HaloDataset(torch.utils.data.Dataset):
 
         return data_dict
 
+    def share_memory(self):
+        #pack the preloaded arrays into shared-memory tensors: processes started with torch.multiprocessing
+        #(e.g. the trials of scripts.sweep) then receive the data without copying it or re-reading the npz files
+        self.shared_data = {}
+        for kind, data_kind in self.loaded_data.items():
+            halo_ids = list(data_kind.keys())
+            for key in data_kind[halo_ids[0]].keys():
+                stacked = torch.from_numpy(np.stack([data_kind[halo_id][key] for halo_id in halo_ids]))
+                self.shared_data[(kind, key)] = (halo_ids, stacked.share_memory_())
+        self.loaded_data = self._unpack_shared_data()
+        return self
+
+    def _unpack_shared_data(self):
+        #same dict structure as preload_data, with numpy views into the shared tensors
+        data_dict = {}
+        for (kind, key), (halo_ids, stacked) in self.shared_data.items():
+            data_kind = data_dict.setdefault(kind, {})
+            arrays = stacked.numpy()
+            for i, halo_id in enumerate(halo_ids):
+                data_kind.setdefault(halo_id, {})[key] = arrays[i]
+        return data_dict
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        if state.get('shared_data') is not None:
+            state['loaded_data'] = None #rebuilt from the shared tensors after unpickling
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        if self.loaded_data is None:
+            self.loaded_data = self._unpack_shared_data()
+
     def __len__(self):
         return len(self.halos_ids)
 
@@ -118,6 +153,9 @@ class HaloDataset(torch.utils.data.Dataset):
         halo_id = self.halos_ids[idx]
         data_2d = self.loaded_data['2d'][halo_id]
 
+        if self.choose_all_2d:
+            return np.stack([np.expand_dims(data_2d[f'map_2d_{proj}'], axis=0) for proj in ['xy', 'xz', 'yz']])
+
         choose_two = self.choose_two_2d
 
         # Select a random projection(s)
@@ -221,6 +259,53 @@ img2d_transform= transforms.Compose([
 ])
 
 
+class BatchedCropRotation2d:
+    """
+    RandomResizedCrop + RandomRotation with independent random parameters for every image of the batch,
+    done as one affine_grid/grid_sample call. torchvision transforms applied to a batch tensor draw one set
+    of parameters for the whole batch.
+    Corners that are rotated in from outside the crop are set to `fill`, as in img2d_transform.
+    """
+    def __init__(self, size=64, scale=(0.7, 0.99), ratio=(3/4, 4/3), degrees=180, fill=0.0):
+        self.size = size
+        self.scale = scale
+        self.ratio = ratio
+        self.degrees = degrees
+        self.fill = fill
+
+    def __call__(self, images):
+        # images: (batch_size, channels, H, W)
+        batch_size, channels = images.shape[:2]
+        device = images.device
+
+        area = torch.empty(batch_size, device=device).uniform_(*self.scale)
+        log_ratio = torch.empty(batch_size, device=device).uniform_(np.log(self.ratio[0]), np.log(self.ratio[1]))
+        ratio = torch.exp(log_ratio)
+        crop_w = torch.sqrt(area * ratio).clamp(max=1.0)
+        crop_h = torch.sqrt(area / ratio).clamp(max=1.0)
+        center_x = (torch.rand(batch_size, device=device) * 2 - 1) * (1 - crop_w)
+        center_y = (torch.rand(batch_size, device=device) * 2 - 1) * (1 - crop_h)
+        angle = (torch.rand(batch_size, device=device) * 2 - 1) * np.deg2rad(self.degrees)
+
+        # rotate the output grid in the normalized coordinates of the crop ...
+        zeros = torch.zeros_like(angle)
+        rotation = torch.stack([
+            torch.stack([torch.cos(angle), -torch.sin(angle), zeros], dim=1),
+            torch.stack([torch.sin(angle), torch.cos(angle), zeros], dim=1),
+        ], dim=1)
+        grid = F.affine_grid(rotation, (batch_size, channels, self.size, self.size), align_corners=False)
+        inside = (grid.abs() <= 1).all(dim=-1).unsqueeze(1)
+
+        # ... then map the crop into the coordinates of the full image
+        grid = grid * torch.stack([crop_w, crop_h], dim=1).view(-1, 1, 1, 2) + torch.stack([center_x, center_y], dim=1).view(-1, 1, 1, 2)
+        out = F.grid_sample(images.float(), grid, mode='bilinear', padding_mode='zeros', align_corners=False)
+        return out.masked_fill(~inside, self.fill)
+
+
+img2d_view_transform = BatchedCropRotation2d(size=64, scale=(0.7, 0.99), degrees=180)
+img2d_local_view_transform = BatchedCropRotation2d(size=32, scale=(0.2, 0.5), degrees=180)
+
+
 
 # # Define the 3D transformations, via chatgpt
 # def random_resized_crop_3d(image, output_size, scale=(0.7, 0.99)):